@@ -0,0 +1,326 @@
+import asyncio
+import json
+import os
+import struct
+import tempfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import docker
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    msg = "privateer2.aio needs aiohttp; install with 'privateer2[async]'"
+    raise ImportError(msg) from None
+
+from privateer2.util import (
+    ChunkReader,
+    LogBuffer,
+    _log_line,
+    files_from_tar,
+    tar_files,
+)
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+# tarfile can only read archives synchronously, so they are spooled
+# first, to a temporary file once they are larger than this.
+ARCHIVE_MEMORY_MAX = 1024 * 1024
+
+
+# A minimal asyncio client for the parts of the Docker Engine API that
+# privateer uses, so that many container operations can be driven
+# concurrently from one process. Use as
+#
+#   async with async_docker_client() as cl:
+#       await asyncio.gather(...)
+#
+# The functions below follow their synchronous namesakes in util.py
+# and service.py. Unlike those, requests made here are not timed by
+# the profiler; only the bytes of archives read from volumes are
+# counted. Nothing in the command line uses this client yet.
+class AsyncDocker:
+    def __init__(self, session):
+        self._session = session
+        self._images = set()
+
+    async def request(self, method, path, *, expect=(200,), **kwargs):
+        response = await self._session.request(method, path, **kwargs)
+        if response.status not in expect:
+            body = await response.text()
+            response.release()
+            try:
+                body = json.loads(body)["message"]
+            except (ValueError, KeyError):
+                pass
+            msg = f"Docker error {response.status} for {method} {path}: {body}"
+            raise Exception(msg)
+        return response
+
+    async def json(self, method, path, **kwargs):
+        response = await self.request(method, path, **kwargs)
+        async with response:
+            return await response.json()
+
+    async def discard(self, method, path, **kwargs):
+        response = await self.request(method, path, **kwargs)
+        async with response:
+            await response.read()
+
+    async def image_exists(self, name):
+        response = await self.request(
+            "GET", f"/images/{name}/json", expect=(200, 404)
+        )
+        async with response:
+            return response.status == 200  # noqa: PLR2004
+
+    async def ensure_image(self, name):
+        if name in self._images:
+            return
+        if not await self.image_exists(name):
+            print(f"Pulling {name}")
+            await self.pull_image(name)
+        self._images.add(name)
+
+    async def pull_image(self, name):
+        repo, tag = docker.utils.parse_repository_tag(name)
+        if tag and tag.startswith("sha256:"):
+            params = {"fromImage": f"{repo}@{tag}"}
+        else:
+            params = {"fromImage": repo, "tag": tag or "latest"}
+        response = await self.request("POST", "/images/create", params=params)
+        async with response:
+            async for line in response.content:
+                status = json.loads(line)
+                if "error" in status:
+                    msg = f"Failed to pull '{name}': {status['error']}"
+                    raise Exception(msg)
+        self._images.add(name)
+
+    async def volume_exists(self, name):
+        response = await self.request(
+            "GET", f"/volumes/{name}", expect=(200, 404)
+        )
+        async with response:
+            return response.status == 200  # noqa: PLR2004
+
+    async def volume_create(self, name):
+        return await self.json(
+            "POST", "/volumes/create", json={"Name": name}, expect=(201,)
+        )
+
+    async def container_if_exists(self, name):
+        response = await self.request(
+            "GET", f"/containers/{name}/json", expect=(200, 404)
+        )
+        async with response:
+            if response.status == 404:  # noqa: PLR2004
+                return None
+            return await response.json()
+
+    async def container_create(self, image, *, name=None, **kwargs):
+        params = {"name": name} if name else None
+        body = container_config(image, **kwargs)
+        res = await self.json(
+            "POST",
+            "/containers/create",
+            params=params,
+            json=body,
+            expect=(201,),
+        )
+        return res["Id"]
+
+    async def container_start(self, cid):
+        await self.discard(
+            "POST", f"/containers/{cid}/start", expect=(204, 304)
+        )
+
+    async def container_wait(self, cid):
+        res = await self.json("POST", f"/containers/{cid}/wait")
+        return res["StatusCode"]
+
+    async def container_stop(self, cid):
+        await self.discard("POST", f"/containers/{cid}/stop", expect=(204, 304))
+
+    async def container_remove(self, cid):
+        await self.discard("DELETE", f"/containers/{cid}", expect=(204,))
+
+    async def container_logs(self, cid):
+        params = {"follow": "1", "stdout": "1", "stderr": "1"}
+        response = await self.request(
+            "GET", f"/containers/{cid}/logs", params=params
+        )
+        async with response:
+            async for chunk in demux_log_stream(response.content):
+                yield chunk
+
+    async def put_archive(self, cid, path, data):
+        await self.discard(
+            "PUT",
+            f"/containers/{cid}/archive",
+            params={"path": str(path)},
+            data=data,
+            headers={"Content-Type": "application/x-tar"},
+        )
+
+    async def get_archive(self, cid, path):
+        response = await self.request(
+            "GET", f"/containers/{cid}/archive", params={"path": str(path)}
+        )
+        async with response:
+            chunks = response.content.iter_chunked(ARCHIVE_CHUNK_SIZE)
+            async for chunk in chunks:
+                yield chunk
+
+
+@asynccontextmanager
+async def async_docker_client(socket=None):
+    socket = socket or _docker_socket()
+    connector = aiohttp.UnixConnector(path=socket)
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(
+        "http://docker", connector=connector, timeout=timeout
+    ) as session:
+        yield AsyncDocker(session)
+
+
+def _docker_socket():
+    host = os.environ.get("DOCKER_HOST", f"unix://{DOCKER_SOCKET}")
+    if not host.startswith("unix://"):
+        msg = f"Only unix sockets are supported (DOCKER_HOST is '{host}')"
+        raise Exception(msg)
+    return host[len("unix://") :]
+
+
+# Translate the arguments we pass to docker-py's containers.run into
+# the body expected by the Engine API's container create endpoint.
+def container_config(
+    image,
+    *,
+    command=None,
+    mounts=None,
+    ports=None,
+    working_dir=None,
+    auto_remove=False,
+):
+    host_config = {"AutoRemove": auto_remove}
+    ret = {"Image": image, "HostConfig": host_config}
+    if command:
+        ret["Cmd"] = command
+    if working_dir:
+        ret["WorkingDir"] = working_dir
+    if mounts:
+        host_config["Mounts"] = [dict(m) for m in mounts]
+    if ports:
+        ret["ExposedPorts"] = {k: {} for k in ports}
+        host_config["PortBindings"] = {
+            k: [{"HostPort": str(v)}] for k, v in ports.items()
+        }
+    return ret
+
+
+# Without a tty, docker multiplexes stdout and stderr into frames of
+# an 8 byte header (stream type, padding, big-endian payload size)
+# followed by the payload.
+async def demux_log_stream(reader):
+    while True:
+        try:
+            header = await reader.readexactly(8)
+        except asyncio.IncompleteReadError:
+            return
+        _, size = struct.unpack(">BxxxL", header)
+        yield await reader.readexactly(size)
+
+
+async def run_container_with_command(
+    cl, display, image, *, live=False, callback=None, **kwargs
+):
+    await cl.ensure_image(image)
+    cid = await cl.container_create(image, **kwargs)
+    name = kwargs.get("name") or cid[:12]
+    await cl.container_start(cid)
+    if live:
+        print(f"{display} command started. Container logs:")
+    else:
+        print(f"{display} command started. To stream progress, run:")
+        print(f"  docker logs -f {name}")
+    logs = LogBuffer(20)
+    async for chunk in cl.container_logs(cid):
+        for line in logs.add(chunk):
+            _log_line(line, logs, name, live, callback)
+    for line in logs.flush():
+        _log_line(line, logs, name, live, callback)
+    status = await cl.container_wait(cid)
+    if status == 0:
+        if live:
+            print(f"{display} completed successfully!")
+        else:
+            print(f"{display} completed successfully! Container logs:")
+            print("\n".join(logs.tail(10)))
+        await cl.container_remove(cid)
+    else:
+        if live:
+            print("An error occured!")
+        else:
+            print("An error occured! Container logs:")
+            print("\n".join(logs.tail(20)))
+        msg = f"{display} failed; see {name} logs for details"
+        raise Exception(msg)
+
+
+async def files_to_volume(cl, volume, files):
+    dest = Path("/dest")
+    mounts = [docker.types.Mount(str(dest), volume, type="volume")]
+    async with _transient_container(cl, "alpine", mounts) as cid:
+        await cl.put_archive(cid, dest, tar_files(files))
+
+
+async def files_from_volume(cl, volume, paths):
+    src = Path("/src")
+    mounts = [docker.types.Mount(str(src), volume, type="volume")]
+    with tempfile.SpooledTemporaryFile(ARCHIVE_MEMORY_MAX) as f:
+        async with _transient_container(cl, "alpine", mounts) as cid:
+            async for chunk in cl.get_archive(cid, src):
+                f.write(chunk)
+        f.seek(0)
+        chunks = iter(lambda: f.read(ARCHIVE_CHUNK_SIZE), b"")
+        return files_from_tar(ChunkReader(chunks), src.name, paths)
+
+
+@asynccontextmanager
+async def _transient_container(cl, image, mounts):
+    await cl.ensure_image(image)
+    cid = await cl.container_create(image, mounts=mounts)
+    try:
+        yield cid
+    finally:
+        await cl.container_remove(cid)
+
+
+async def service_start(
+    cl, name, container_name, image, *, mounts=None, ports=None, command=None
+):
+    if await cl.container_if_exists(container_name):
+        msg = f"Container '{container_name}' for '{name}' already running"
+        raise Exception(msg)
+    await cl.ensure_image(image)
+    print(f"Starting server '{name}' as container '{container_name}'")
+    cid = await cl.container_create(
+        image,
+        auto_remove=True,
+        name=container_name,
+        mounts=mounts,
+        ports=ports,
+        command=command,
+    )
+    await cl.container_start(cid)
+
+
+async def service_stop(cl, name, container_name):
+    container = await cl.container_if_exists(container_name)
+    if container:
+        if container["State"]["Status"] == "running":
+            await cl.container_stop(container["Id"])
+    else:
+        print(f"Container '{container_name}' for '{name}' does not exist")
@@ -13,11 +13,11 @@ def backup_command(name, volume, server):
     ]
 
 
-def backup(cfg, name, volume, *, server=None, dry_run=False):
+def backup(cfg, name, volume, *, server=None, dry_run=False, progress=False):
     machine = check(cfg, name, quiet=True)
     server = match_value(server, cfg.list_servers(), "server")
     volume = match_value(volume, machine.backup, "volume")
-    image = f"mrcide/privateer-client:{cfg.tag}"
+    image = cfg.image("client")
     src = f"/privateer/volumes/{volume}"
     mounts = [
         docker.types.Mount(
@@ -43,7 +43,7 @@ def backup(cfg, name, volume, *, server=None, dry_run=False):
     else:
         print(f"Backing up '{volume}' from '{name}' to '{server}'")
         run_container_with_command(
-            "Backup", image, command=command, mounts=mounts
+            "Backup", image, command=command, mounts=mounts, live=progress
         )
         # TODO: also copy over some metadata at this point, via
         # ssh; probably best to write tiny utility in the client
@@ -0,0 +1,138 @@
+import json
+import os
+import shlex
+import time
+
+import docker
+from privateer2.check import check
+from privateer2.util import docker_client, ensure_image
+
+BENCHMARK_FILE = ".privateer_benchmark.json"
+BENCHMARK_TTL = 24 * 60 * 60
+
+
+def benchmark_servers(cfg, name, root, *, size=10_000_000, timeout=30):
+    machine = check(cfg, name, quiet=True)
+    if not cfg.is_client(name):
+        msg = "Only clients can benchmark servers"
+        raise Exception(msg)
+    image = cfg.image("client")
+    mounts = [
+        docker.types.Mount(
+            "/privateer/keys", machine.key_volume, type="volume", read_only=True
+        )
+    ]
+    names = cfg.list_servers()
+    command = ["bash", "-c", benchmark_script(names, size, timeout)]
+    print(f"benchmarking {len(names)} server(s)...", flush=True)
+    ensure_image(image)
+    output = docker_client().containers.run(
+        image, mounts=mounts, command=command, remove=True
+    )
+    result = parse_benchmark(output.decode("utf-8"), names, size)
+    for server in cfg.servers:
+        res = result[server.name]
+        prefix = f"benchmarking '{server.name}' ({server.hostname})"
+        if res["status"] == "ok":
+            print(
+                f"{prefix}...OK handshake {res['handshake']:.3f}s, "
+                f"rtt {res['rtt']:.3f}s, "
+                f"throughput {res['throughput'] / 1e6:.1f} MB/s"
+            )
+        else:
+            print(f"{prefix}...ERROR")
+    write_benchmark(root, name, result)
+    return result
+
+
+# Servers are measured one after the other so that they do not compete
+# for bandwidth. For each we time: a fresh ssh connection (handshake),
+# a command over the now-open master connection (rtt), and sending
+# 'size' bytes over that connection (throughput).
+def benchmark_script(names, size, timeout):
+    ret = ["now() { date +%s%N; }"]
+    for name in names:
+        nm = shlex.quote(name)
+        cm = f"-o ControlPath=/tmp/cm-{len(ret)}"
+        ret.append(
+            f"t0=$(now); "
+            f"timeout {timeout} ssh -n -o BatchMode=yes "
+            f"-o ConnectTimeout={timeout} -o ControlMaster=yes "
+            f"-o ControlPersist={timeout} {cm} {nm} true; code=$?; "
+            f"t1=$(now); t2=$t1; t3=$t1; "
+            f"if [ $code -eq 0 ]; then "
+            f"timeout {timeout} ssh -n {cm} {nm} true; "
+            f"t2=$(now); "
+            f"head -c {size} /dev/zero | "
+            f"timeout {timeout} ssh {cm} {nm} 'cat > /dev/null' || code=$?; "
+            f"t3=$(now); "
+            f"ssh -n {cm} -O exit {nm} 2> /dev/null; "
+            f"fi; "
+            f'printf "%s\\t%s\\t%s\\t%s\\t%s\\n" {nm} "$code" '
+            '"$(( (t1 - t0) / 1000 ))" "$(( (t2 - t1) / 1000 ))" '
+            '"$(( (t3 - t2) / 1000 ))"'
+        )
+    return "\n".join(ret)
+
+
+def parse_benchmark(output, names, size):
+    ret = {nm: {"status": "error"} for nm in names}
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 5 or parts[0] not in ret:  # noqa: PLR2004
+            continue
+        name, code, handshake, rtt, transfer = parts
+        if code != "0":
+            continue
+        transfer = max(int(transfer), 1) / 1e6
+        ret[name] = {
+            "status": "ok",
+            "handshake": int(handshake) / 1e6,
+            "rtt": int(rtt) / 1e6,
+            "throughput": size / transfer,
+        }
+    return ret
+
+
+def write_benchmark(root, name, result):
+    path = os.path.join(root, BENCHMARK_FILE)
+    data = _read_benchmark_file(path)
+    data[name] = {"time": time.time(), "servers": result}
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def read_benchmark(root, name, *, ttl=BENCHMARK_TTL):
+    data = _read_benchmark_file(os.path.join(root, BENCHMARK_FILE))
+    entry = data.get(name)
+    if not entry or time.time() - entry["time"] > ttl:
+        return None
+    return entry["servers"]
+
+
+def _read_benchmark_file(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# Pick the healthy server with the best throughput, breaking ties on
+# round trip time.
+def choose_server(cfg, name, root, *, ttl=BENCHMARK_TTL):
+    result = read_benchmark(root, name, ttl=ttl)
+    if result is None:
+        msg = (
+            f"No recent benchmark for '{name}'; "
+            "run 'privateer2 check --benchmark' first"
+        )
+        raise Exception(msg)
+    healthy = [
+        (-v["throughput"], v["rtt"], k)
+        for k, v in result.items()
+        if cfg.is_server(k) and v["status"] == "ok"
+    ]
+    if not healthy:
+        msg = f"No healthy servers in benchmark for '{name}'"
+        raise Exception(msg)
+    return min(healthy)[2]
@@ -1,50 +1,111 @@
+import base64
+import shlex
+
 import docker
-from privateer2.util import string_from_volume
+from privateer2.profile import phase
+from privateer2.util import (
+    LABEL_NAME,
+    docker_client,
+    ensure_image,
+    string_from_volume,
+    volume_labels,
+)
 
 
 def check(cfg, name, *, connection=False, quiet=False):
     machine = cfg.machine_config(name)
     vol = machine.key_volume
-    try:
-        docker.from_env().volumes.get(vol)
-    except docker.errors.NotFound:
-        msg = f"'{name}' looks unconfigured"
-        raise Exception(msg) from None
-    found = string_from_volume(vol, "name")
+    with phase("check"):
+        try:
+            volume = docker_client().volumes.get(vol)
+        except docker.errors.NotFound:
+            msg = f"'{name}' looks unconfigured"
+            raise Exception(msg) from None
+        # Volumes configured by older versions have no labels, and we
+        # need to look in the volume itself.
+        found = volume_labels(volume).get(LABEL_NAME)
+        if found is None:
+            found = string_from_volume(vol, "name")
     if found != name:
         msg = f"Configuration is for '{found}', not '{name}'"
         raise Exception(msg)
     if not quiet:
         print(f"Volume '{vol}' looks configured as '{name}'")
-    if connection and name in cfg.list_clients():
-        _check_connections(cfg, machine)
+    if connection and cfg.is_client(name):
+        with phase("connections"):
+            _check_connections(cfg, machine)
     return machine
 
 
-def _check_connections(cfg, machine):
-    image = f"mrcide/privateer-client:{cfg.tag}"
+def _check_connections(cfg, machine, *, timeout=10):
+    image = cfg.image("client")
     mounts = [
         docker.types.Mount(
             "/privateer/keys", machine.key_volume, type="volume", read_only=True
         )
     ]
-    cl = docker.from_env()
-    result = {}
+    names = cfg.list_servers()
+    print(f"checking connections to {len(names)} server(s)...", flush=True)
+    command = ["bash", "-c", connection_probe_script(names, timeout)]
+    ensure_image(image)
+    output = docker_client().containers.run(
+        image, mounts=mounts, command=command, remove=True
+    )
+    result = parse_connection_probes(output.decode("utf-8"), names, timeout)
     for server in cfg.servers:
-        print(
-            f"checking connection to '{server.name}' ({server.hostname})...",
-            end="",
-            flush=True,
-        )
-        try:
-            command = ["ssh", server.name, "cat", "/privateer/keys/name"]
-            cl.containers.run(
-                image, mounts=mounts, command=command, remove=True
-            )
-            result[server.name] = True
-            print("OK")
-        except docker.errors.ContainerError as e:
-            result[server.name] = False
-            print("ERROR")
-            print(e.stderr.decode("utf-8").strip())
+        res = result[server.name]
+        prefix = f"checking connection to '{server.name}' ({server.hostname})"
+        if res["status"] == "ok":
+            print(f"{prefix}...OK ({res['latency']:.3f}s)")
+        else:
+            print(f"{prefix}...{res['status'].upper()}")
+            print(res["error"])
     return result
+
+
+# Probe every server from a single container; each ssh runs in the
+# background, so the whole check takes as long as the slowest server
+# (or the timeout). Each probe prints one tab-separated line of name,
+# exit code, time in ms and base64-encoded output.
+def connection_probe_script(names, timeout):
+    ret = []
+    for name in names:
+        nm = shlex.quote(name)
+        ssh = (
+            f"timeout {timeout} ssh -o BatchMode=yes "
+            f"-o ConnectTimeout={timeout} {nm} cat /privateer/keys/name"
+        )
+        ret.append(
+            f"(t0=$(date +%s%N); out=$({ssh} 2>&1); code=$?; "
+            "t1=$(date +%s%N); "
+            f'printf "%s\\t%s\\t%s\\t%s\\n" {nm} "$code" '
+            '"$(( (t1 - t0) / 1000000 ))" '
+            '"$(printf %s "$out" | base64 -w0)") &'
+        )
+    ret.append("wait")
+    return "\n".join(ret)
+
+
+def parse_connection_probes(output, names, timeout):
+    ret = {
+        nm: {"status": "error", "latency": None, "error": "no result"}
+        for nm in names
+    }
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 4 or parts[0] not in ret:  # noqa: PLR2004
+            continue
+        name, code, ms, out = parts
+        out = base64.b64decode(out).decode("utf-8", errors="replace").strip()
+        latency = int(ms) / 1000
+        if code == "124":
+            res = {"status": "timeout", "error": f"timed out after {timeout}s"}
+        elif code != "0":
+            res = {"status": "error", "error": out}
+        elif out != name:
+            msg = f"server identifies as '{out}', not '{name}'"
+            res = {"status": "error", "error": msg}
+        else:
+            res = {"status": "ok", "error": None}
+        ret[name] = {**res, "latency": latency}
+    return ret
@@ -1,20 +1,29 @@
 """Usage:
   privateer2 --version
   privateer2 [options] pull
-  privateer2 [options] keygen (<name> | --all)
-  privateer2 [options] configure <name>
-  privateer2 [options] check [--connection]
+  privateer2 [options] keygen (<name> | --all | --missing)
+  privateer2 [options] configure (<name>... | --all-local) [--check]
+  privateer2 [options] check [--connection | --benchmark | --watch]
   privateer2 [options] backup <volume> [--server=NAME]
   privateer2 [options] restore <volume> [--server=NAME] [--source=NAME]
   privateer2 [options] export <volume> [--to-dir=PATH] [--source=NAME]
   privateer2 [options] import <tarfile> <volume>
-  privateer2 [options] server (start | stop | status)
+  privateer2 [options] server (start | stop | status | reload)
   privateer2 [options] schedule (start | stop | status)
+  privateer2 [options] schedule plan [--apply]
 
 Options:
   --path=PATH  The path to the configuration, or directory with privateer.json
   --as=NAME    The machine to run the command as
   --dry-run    Do nothing, but print docker commands
+  --progress   Print backup/restore logs as they are produced
+  --profile    Print a breakdown of where time was spent on exit
+  --profile-json=PATH  Write the timing breakdown as json to PATH
+  --interval=SECONDS   Time between checks with --watch [default: 60]
+  --freshness-interval=SECONDS  Time between backup age checks [default: 3600]
+  --metrics-port=PORT  Port to serve metrics on with --watch [default: 9100]
+  --window=MINUTES     Window to spread scheduled backups over [default: 60]
+  --duration=MINUTES   Expected time of backups with no timeout [default: 15]
 
 Commentary:
   In all the above '--as' (or <name>) refers to the name of the client
@@ -29,37 +38,93 @@ Commentary:
   tar file of a local volume, which is suitable for importing with
   'import'.
 
+  Several machines that share this host (each with its own key
+  volume) can be configured at once by listing their names, or with
+  '--all-local' to reconfigure every machine already configured here.
+  The identity used by other commands is only recorded when a single
+  machine is configured.
+
+  Running 'configure --check' reports whether the key volume matches
+  the configuration and the keys in the vault, without changing it.
+
+  Running 'check --benchmark' measures the connection to each server
+  and remembers the results for a day; pass '--server=auto' to
+  'backup' or 'restore' to use the fastest server from these results.
+
+  Running 'check --watch' repeats the checks forever, serving the
+  results for Prometheus at http://127.0.0.1:PORT/metrics. The age of
+  backups on each server is checked less often, as this looks at every
+  file backed up.
+
   The server and schedule commands start background containers that
   run forever (with the 'start' option). Check in on them with
-  'status' or stop them with 'stop'.
+  'status' or stop them with 'stop'. After adding clients, 'server
+  reload' updates a running server's keys without restarting it.
+
+  Running 'schedule plan' staggers the scheduled backups of all
+  clients so that fewer run against each server at once, showing the
+  peak number of concurrent backups per server before and after. Add
+  '--apply' to write the new schedules into the configuration, then
+  run 'configure' on each client.
 """
 
+import importlib
 import os
 
 import docopt
 
-import docker
 import privateer2.__about__ as about
-from privateer2.backup import backup
-from privateer2.check import check
-from privateer2.config import read_config
-from privateer2.configure import configure
-from privateer2.keys import keygen, keygen_all
-from privateer2.restore import restore
-from privateer2.schedule import schedule_start, schedule_status, schedule_stop
-from privateer2.server import server_start, server_status, server_stop
-from privateer2.tar import export_tar, export_tar_local, import_tar
+from privateer2.profile import format_profile, profiling, write_profile
+
+# Commands are imported only once we know which one is wanted, so
+# that (for example) '--version' does not pay for loading docker,
+# hvac and cryptography, and 'server status' does not load the
+# key generation or scheduling code.
+_COMMANDS = {
+    "backup": "privateer2.backup",
+    "benchmark_servers": "privateer2.benchmark",
+    "check": "privateer2.check",
+    "choose_server": "privateer2.benchmark",
+    "configure": "privateer2.configure",
+    "configure_many": "privateer2.configure",
+    "export_tar": "privateer2.tar",
+    "export_tar_local": "privateer2.tar",
+    "import_tar": "privateer2.tar",
+    "keygen": "privateer2.keys",
+    "keygen_all": "privateer2.keys",
+    "keygen_missing": "privateer2.keys",
+    "pull_images": "privateer2.util",
+    "read_config": "privateer2.config",
+    "restore": "privateer2.restore",
+    "schedule_plan": "privateer2.plan",
+    "schedule_start": "privateer2.schedule",
+    "schedule_status": "privateer2.schedule",
+    "schedule_stop": "privateer2.schedule",
+    "server_reload": "privateer2.server",
+    "server_start": "privateer2.server",
+    "server_status": "privateer2.server",
+    "server_stop": "privateer2.server",
+    "watch": "privateer2.watch",
+}
+
+
+def __getattr__(name):
+    if name not in _COMMANDS:
+        msg = f"module '{__name__}' has no attribute '{name}'"
+        raise AttributeError(msg)
+    value = getattr(importlib.import_module(_COMMANDS[name]), name)
+    globals()[name] = value
+    return value
+
+
+# Look up a command, preferring anything already bound here (which
+# includes replacements made in tests).
+def _command(name):
+    return globals()[name] if name in globals() else __getattr__(name)
 
 
 def pull(cfg):
-    img = [
-        f"mrcide/privateer-client:{cfg.tag}",
-        f"mrcide/privateer-server:{cfg.tag}",
-    ]
-    cl = docker.from_env()
-    for nm in img:
-        print(f"pulling '{nm}'")
-        cl.images.pull(nm)
+    _command("pull_images")([cfg.image("client"), cfg.image("server")])
 
 
 def _dont_use(name, opts, cmd):
@@ -82,8 +147,14 @@ def _find_identity(name, root_config):
         return f.read().strip()
 
 
+def _find_server(server, cfg, name, root_config):
+    if server == "auto":
+        return _command("choose_server")(cfg, name, root_config)
+    return server
+
+
 def _do_configure(cfg, name, root):
-    configure(cfg, name)
+    _command("configure")(cfg, name)
     with open(os.path.join(root, ".privateer_identity"), "w") as f:
         f.write(f"{name}\n")
 
@@ -106,7 +177,27 @@ class Call:
 
 def _parse_argv(argv):
     opts = docopt.docopt(__doc__, argv)
-    return _parse_opts(opts)
+    call = _parse_opts(opts)
+    if opts["--profile"] or opts["--profile-json"]:
+        call = Call(
+            _run_profiled,
+            call=call,
+            show=opts["--profile"],
+            path=opts["--profile-json"],
+        )
+    return call
+
+
+def _run_profiled(call, show, path):
+    with profiling() as profile:
+        try:
+            return call.run()
+        finally:
+            data = profile.data()
+            if show:
+                print("\n".join(format_profile(data)))
+            if path:
+                write_profile(data, path)
 
 
 def _path_config(path):
@@ -129,7 +220,7 @@ def _parse_opts(opts):
         _dont_use("--as", opts, "import")
         _dont_use("--path", opts, "import")
         return Call(
-            import_tar,
+            _command("import_tar"),
             volume=opts["<volume>"],
             tarfile=opts["<tarfile>"],
             dry_run=dry_run,
@@ -138,7 +229,7 @@ def _parse_opts(opts):
         _dont_use("--as", opts, "export --local")
         _dont_use("--path", opts, "export --local")
         return Call(
-            export_tar_local,
+            _command("export_tar_local"),
             volume=opts["<volume>"],
             to_dir=opts["--to-dir"],
             dry_run=dry_run,
@@ -146,51 +237,95 @@ def _parse_opts(opts):
 
     path_config = _path_config(opts["--path"])
     root_config = os.path.dirname(path_config)
-    cfg = read_config(path_config)
+    cfg = _command("read_config")(path_config)
     if opts["keygen"]:
         _dont_use("--as", opts, "keygen")
         if opts["--all"]:
-            return Call(keygen_all, cfg=cfg)
+            return Call(_command("keygen_all"), cfg=cfg)
+        elif opts["--missing"]:
+            return Call(_command("keygen_missing"), cfg=cfg)
         else:
-            return Call(keygen, cfg=cfg, name=opts["<name>"])
+            return Call(_command("keygen"), cfg=cfg, name=opts["<name>"][0])
     elif opts["configure"]:
         _dont_use("--as", opts, "configure")
+        names = opts["<name>"]
+        if opts["--all-local"] or len(names) > 1:
+            return Call(
+                _command("configure_many"),
+                cfg=cfg,
+                names=None if opts["--all-local"] else names,
+                check=opts["--check"],
+            )
+        if opts["--check"]:
+            return Call(
+                _command("configure"), cfg=cfg, name=names[0], check=True
+            )
         return Call(
             _do_configure,
             cfg=cfg,
-            name=opts["<name>"],
+            name=names[0],
             root=root_config,
         )
     elif opts["pull"]:
         _dont_use("--as", opts, "configure")
         return Call(pull, cfg=cfg)
+    elif opts["schedule"] and opts["plan"]:
+        _dont_use("--as", opts, "schedule plan")
+        return Call(
+            _command("schedule_plan"),
+            cfg=cfg,
+            path=path_config,
+            window=int(opts["--window"]),
+            duration=int(opts["--duration"]),
+            apply=opts["--apply"],
+        )
     else:
         name = _find_identity(opts["--as"], root_config)
-        if opts["check"]:
+        if opts["check"] and opts["--benchmark"]:
+            return Call(
+                _command("benchmark_servers"),
+                cfg=cfg,
+                name=name,
+                root=root_config,
+            )
+        elif opts["check"] and opts["--watch"]:
+            return Call(
+                _command("watch"),
+                cfg=cfg,
+                name=name,
+                interval=int(opts["--interval"]),
+                freshness_interval=int(opts["--freshness-interval"]),
+                port=int(opts["--metrics-port"]),
+            )
+        elif opts["check"]:
             connection = opts["--connection"]
-            return Call(check, cfg=cfg, name=name, connection=connection)
+            return Call(
+                _command("check"), cfg=cfg, name=name, connection=connection
+            )
         elif opts["backup"]:
             return Call(
-                backup,
+                _command("backup"),
                 cfg=cfg,
                 name=name,
                 volume=opts["<volume>"],
-                server=opts["--server"],
+                server=_find_server(opts["--server"], cfg, name, root_config),
                 dry_run=dry_run,
+                progress=opts["--progress"],
             )
         elif opts["restore"]:
             return Call(
-                restore,
+                _command("restore"),
                 cfg=cfg,
                 name=name,
                 volume=opts["<volume>"],
-                server=opts["--server"],
+                server=_find_server(opts["--server"], cfg, name, root_config),
                 source=opts["--source"],
                 dry_run=dry_run,
+                progress=opts["--progress"],
             )
         elif opts["export"]:
             return Call(
-                export_tar,
+                _command("export_tar"),
                 cfg=cfg,
                 name=name,
                 volume=opts["<volume>"],
@@ -200,18 +335,30 @@ def _parse_opts(opts):
             )
         elif opts["server"]:
             if opts["start"]:
-                return Call(server_start, cfg=cfg, name=name, dry_run=dry_run)
+                return Call(
+                    _command("server_start"),
+                    cfg=cfg,
+                    name=name,
+                    dry_run=dry_run,
+                )
             elif opts["stop"]:
-                return Call(server_stop, cfg=cfg, name=name)
+                return Call(_command("server_stop"), cfg=cfg, name=name)
+            elif opts["reload"]:
+                return Call(_command("server_reload"), cfg=cfg, name=name)
             else:
-                return Call(server_status, cfg=cfg, name=name)
+                return Call(_command("server_status"), cfg=cfg, name=name)
         elif opts["schedule"]:
             if opts["start"]:
-                return Call(schedule_start, cfg=cfg, name=name, dry_run=dry_run)
+                return Call(
+                    _command("schedule_start"),
+                    cfg=cfg,
+                    name=name,
+                    dry_run=dry_run,
+                )
             elif opts["stop"]:
-                return Call(schedule_stop, cfg=cfg, name=name)
+                return Call(_command("schedule_stop"), cfg=cfg, name=name)
             else:
-                return Call(schedule_status, cfg=cfg, name=name)
+                return Call(_command("schedule_status"), cfg=cfg, name=name)
         else:
             msg = "Invalid cli call -- privateer bug"
             raise Exception(msg)
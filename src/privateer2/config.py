@@ -1,27 +1,39 @@
-import json
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
-from privateer2.util import match_value
-from privateer2.vault import vault_client
+KEY_TYPES = ["rsa", "ed25519"]
+CONCURRENCY_POLICIES = ["forbid", "replace", "allow"]
 
 
+# Parsing the json with pydantic (rather than the json module) avoids
+# building an intermediate dict, which matters with large fleets.
 def read_config(path):
     with open(path) as f:
-        return Config(**json.loads(f.read().strip()))
+        return Config.model_validate_json(f.read())
 
 
 class ScheduleJob(BaseModel):
     server: str
     volume: str
     schedule: str
+    concurrency_policy: Optional[str] = None
+    timeout: Optional[int] = None
 
 
+# 'concurrency_policy' says what happens when a job is due while its
+# previous run is still going, and 'volume_policy' the same for
+# different jobs backing up the same volume; either may 'forbid' the
+# new run, 'replace' the old one, or 'allow' both. At most
+# 'max_concurrent' jobs run at once, with others waiting their turn.
 class Schedule(BaseModel):
     port: Optional[int] = None
     container: str = "privateer_scheduler"
     jobs: List[ScheduleJob]
+    concurrency_policy: str = "forbid"
+    volume_policy: str = "forbid"
+    timeout: Optional[int] = None
+    max_concurrent: Optional[int] = None
 
 
 class Server(BaseModel):
@@ -31,6 +43,7 @@ class Server(BaseModel):
     key_volume: str
     data_volume: str
     container: str
+    key_type: Optional[str] = None
 
 
 class Client(BaseModel):
@@ -38,6 +51,7 @@ class Client(BaseModel):
     backup: List[str] = []
     key_volume: str = "privateer_keys"
     schedule: Optional[Schedule] = None
+    key_type: Optional[str] = None
 
 
 class Volume(BaseModel):
@@ -48,8 +62,13 @@ class Volume(BaseModel):
 class Vault(BaseModel):
     url: str
     prefix: str
+    pubkey_cache_ttl: int = 0
+    secrets_cache_ttl: int = 0
+    kv_version: int = 1
 
     def client(self):
+        from privateer2.vault import vault_client  # noqa: PLC0415
+
         return vault_client(self.url)
 
 
@@ -59,10 +78,26 @@ class Config(BaseModel):
     volumes: List[Volume]
     vault: Vault
     tag: str = "latest"
+    digests: Dict[str, str] = {}
+    key_type: str = "rsa"
+    _index: Dict[str, dict] = PrivateAttr(default_factory=dict)
 
     def model_post_init(self, __context):
         _check_config(self)
 
+    # Lookup tables by name, built when the configuration is validated.
+    # Anything that adds, removes or renames machines or volumes, or
+    # changes what a client backs up, must call this afterwards.
+    def reindex(self):
+        self._index = _build_index(self)
+        return self._index
+
+    def is_server(self, name):
+        return isinstance(self._index["machines"].get(name), Server)
+
+    def is_client(self, name):
+        return isinstance(self._index["machines"].get(name), Client)
+
     def list_servers(self):
         return [x.name for x in self.servers]
 
@@ -72,29 +107,67 @@ class Config(BaseModel):
     def list_volumes(self):
         return [x.name for x in self.volumes]
 
+    def image(self, what):
+        name = f"mrcide/privateer-{what}"
+        digest = self.digests.get(what)
+        if digest:
+            return f"{name}@{digest}"
+        return f"{name}:{self.tag}"
+
+    def machine_key_type(self, name):
+        return self.machine_config(name).key_type or self.key_type
+
     def machine_config(self, name):
-        for el in self.servers + self.clients:
-            if el.name == name:
-                return el
+        ret = self._index["machines"].get(name)
+        if ret is not None:
+            return ret
         valid = self.list_servers() + self.list_clients()
         valid_str = ", ".join(f"'{x}'" for x in valid)
         msg = f"Invalid configuration '{name}', must be one of {valid_str}"
         raise Exception(msg)
 
 
+# Lookup tables for a configuration, so that finding a machine or
+# volume by name, or the clients backing up a volume, does not need a
+# scan over the whole fleet. Where names are duplicated the first one
+# wins, as with a scan. These are plain dictionaries of the models
+# themselves, so configurations still compare equal by value.
+def _build_index(cfg):
+    backed_up_by = {}
+    for cl in cfg.clients:
+        for v in cl.backup:
+            backed_up_by.setdefault(v, []).append(cl)
+    return {
+        "servers": _by_name(cfg.servers),
+        "clients": _by_name(cfg.clients),
+        "machines": _by_name(cfg.servers + cfg.clients),
+        "volumes": _by_name(cfg.volumes),
+        "backed_up_by": backed_up_by,
+    }
+
+
+def _by_name(els):
+    ret = {}
+    for el in els:
+        ret.setdefault(el.name, el)
+    return ret
+
+
 # this could be put elsewhere; we find the plausible sources (original
 # clients) that backed up a source to any server.
 def find_source(cfg, volume, source):
-    if volume not in cfg.list_volumes():
+    from privateer2.util import match_value  # noqa: PLC0415
+
+    vol = cfg._index["volumes"].get(volume)
+    if vol is None:
         msg = f"Unknown volume '{volume}'"
         raise Exception(msg)
-    for v in cfg.volumes:
-        if v.name == volume and v.local:
-            if source is not None:
-                msg = f"'{volume}' is a local source, so 'source' must be empty"
-                raise Exception(msg)
-            return None
-    pos = [cl.name for cl in cfg.clients if volume in cl.backup]
+    if vol.local:
+        if source is not None:
+            msg = f"'{volume}' is a local source, so 'source' must be empty"
+            raise Exception(msg)
+        return None
+    pos = [cl.name for cl in cfg._index["backed_up_by"].get(volume, [])]
     return match_value(source, pos, "source")
 
 
@@ -103,39 +176,84 @@ def _check_config(cfg):
     clients = cfg.list_clients()
     _check_not_duplicated(servers, "servers")
     _check_not_duplicated(clients, "clients")
-    err = set(cfg.list_servers()).intersection(set(cfg.list_clients()))
+    index = cfg.reindex()
+    err = [x for x in servers if x in index["clients"]]
     if err:
         err_str = ", ".join(f"'{nm}'" for nm in err)
         msg = f"Invalid machine listed as both a client and a server: {err_str}"
         raise Exception(msg)
-    vols_local = [x.name for x in cfg.volumes if x.local]
-    vols_all = [x.name for x in cfg.volumes]
     for cl in cfg.clients:
         for v in cl.backup:
-            if v not in vols_all:
+            vol = index["volumes"].get(v)
+            if vol is None:
                 msg = f"Client '{cl.name}' backs up unknown volume '{v}'"
                 raise Exception(msg)
-            if v in vols_local:
+            if vol.local:
                 msg = f"Client '{cl.name}' backs up local volume '{v}'"
                 raise Exception(msg)
         if cl.schedule:
+            _check_schedule(cl.name, cl.schedule)
+            backup = set(cl.backup)
             for j in cl.schedule.jobs:
-                if j.server not in servers:
+                if j.server not in index["servers"]:
                     msg = (
                         f"Client '{cl.name}' scheduling backup to "
                         f"unknown server '{j.server}'"
                     )
                     raise Exception(msg)
-                if j.volume not in cl.backup:
+                if j.volume not in backup:
                     msg = (
                         f"Client '{cl.name}' scheduling backup of "
                         f"volume '{j.volume}', which it does not back up"
                     )
                     raise Exception(msg)
+    for k, v in cfg.digests.items():
+        if k not in ["client", "server"]:
+            msg = f"Invalid image '{k}' in digests: use 'client' or 'server'"
+            raise Exception(msg)
+        if not v.startswith("sha256:"):
+            msg = f"Invalid digest for '{k}': must start with 'sha256:'"
+            raise Exception(msg)
+    key_types = [("the configuration", cfg.key_type)] + [
+        (f"'{x.name}'", x.key_type) for x in cfg.servers + cfg.clients
+    ]
+    for where, key_type in key_types:
+        if key_type is not None and key_type not in KEY_TYPES:
+            valid = ", ".join(f"'{x}'" for x in KEY_TYPES)
+            msg = (
+                f"Invalid key_type '{key_type}' for {where}: use one of {valid}"
+            )
+            raise Exception(msg)
     if cfg.vault.prefix.startswith("/secret"):
         cfg.vault.prefix = cfg.vault.prefix[7:]
 
 
+def _check_schedule(name, schedule):
+    policies = [
+        ("concurrency_policy", schedule.concurrency_policy),
+        ("volume_policy", schedule.volume_policy),
+    ] + [("concurrency_policy", j.concurrency_policy) for j in schedule.jobs]
+    for what, policy in policies:
+        if policy is not None and policy not in CONCURRENCY_POLICIES:
+            valid = ", ".join(f"'{x}'" for x in CONCURRENCY_POLICIES)
+            msg = (
+                f"Invalid {what} '{policy}' for client '{name}': "
+                f"use one of {valid}"
+            )
+            raise Exception(msg)
+    limits = [
+        ("timeout", schedule.timeout),
+        ("max_concurrent", schedule.max_concurrent),
+    ] + [("timeout", j.timeout) for j in schedule.jobs]
+    for what, value in limits:
+        if value is not None and value < 1:
+            msg = (
+                f"Invalid {what} '{value}' for client '{name}': "
+                "must be positive"
+            )
+            raise Exception(msg)
+
+
 def _check_not_duplicated(els, name):
     if len(els) > len(set(els)):
         msg = f"Duplicated elements in {name}"
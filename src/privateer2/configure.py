@@ -1,41 +1,234 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
 import docker
-from privateer2.keys import keys_data
-from privateer2.util import string_to_volume
+from privateer2.keys import (
+    KEY_FILENAMES,
+    key_filename,
+    key_fingerprint,
+    keys_data,
+)
+from privateer2.profile import phase
+from privateer2.util import (
+    LABEL_NAME,
+    _text_to_bytes,
+    docker_client,
+    files_from_container,
+    files_from_volume,
+    files_to_container,
+    volume_container,
+    volume_if_exists,
+    volume_labels,
+)
 from privateer2.yacron import generate_yacron_yaml
 
 
-def configure(cfg, name):
-    cl = docker.from_env()
-    keys = keys_data(cfg, name)
-    schedule = generate_yacron_yaml(cfg, name)
+# Only the files whose contents differ from those already in the
+# volume are written; the comparison needs a single read of the
+# volume, from the same container that we then write with.
+def configure(cfg, name, *, check=False):
+    keys = keys_data(cfg, name, verify=check)
+    return _configure(cfg, name, keys, check=check)
+
+
+# Configure several machines that run on this host (by default, all
+# those whose key volumes are already here). Keys are read up front,
+# with one vault login and one read of the public keys shared by all
+# machines, after which the volumes are written in parallel. Failures
+# are collected and reported together.
+def configure_many(cfg, names=None, *, check=False):
+    if names is None:
+        names = local_machines(cfg)
+        if not names:
+            msg = "No configured machines found on this host"
+            raise Exception(msg)
+    vols = {}
+    for name in names:
+        vol = cfg.machine_config(name).key_volume
+        if vol in vols:
+            msg = (
+                f"Machines '{vols[vol]}' and '{name}' share key volume "
+                f"'{vol}', so can't both be configured here"
+            )
+            raise Exception(msg)
+        vols[vol] = name
+    keys = {name: keys_data(cfg, name, verify=check) for name in names}
+    errors = {}
+    with ThreadPoolExecutor() as pool:
+        running = {
+            pool.submit(_configure, cfg, name, keys[name], check=check): name
+            for name in names
+        }
+        for f in as_completed(running):
+            try:
+                f.result()
+            except Exception as e:
+                errors[running[f]] = e
+    if errors:
+        for name in names:
+            if name in errors:
+                print(f"Failed to configure '{name}': {errors[name]}")
+        failed = ", ".join(f"'{x}'" for x in names if x in errors)
+        msg = f"Failed to configure {failed}"
+        raise Exception(msg)
+
+
+# Machines whose key volume exists on this host and is configured as
+# that machine.
+def local_machines(cfg):
+    ret = []
+    found = {}
+    for m in cfg.servers + cfg.clients:
+        if m.key_volume not in found:
+            found[m.key_volume] = _volume_identity(m.key_volume)
+        if found[m.key_volume] == m.name:
+            ret.append(m.name)
+    return ret
+
+
+def _volume_identity(vol):
+    volume = volume_if_exists(vol)
+    if volume is None:
+        return None
+    name = volume_labels(volume).get(LABEL_NAME)
+    if name is None:
+        name = files_from_volume(vol, ["name"])["name"]
+    return name
+
+
+def _configure(cfg, name, keys, *, check=False):
+    cl = docker_client()
     vol = cfg.machine_config(name).key_volume
-    cl.volumes.create(vol)
+    files = key_volume_files(cfg, name, keys)
+    if check:
+        return _check_drift(cl, vol, name, files)
     print(f"Copying keypair for '{name}' to volume '{vol}'")
-    string_to_volume(
-        keys["public"], vol, "id_rsa.pub", uid=0, gid=0, mode=0o644
-    )
-    string_to_volume(keys["private"], vol, "id_rsa", uid=0, gid=0, mode=0o600)
+    with phase("write volume"):
+        _create_key_volume(cl, vol, name)
+        dest = Path("/dest")
+        with volume_container(vol, dest) as container:
+            changed, stale = _changed_files(container, dest, files)
+            if changed:
+                update = {k: files[k] for k in changed}
+                files_to_container(container, dest, update)
+        if stale:
+            _remove_files(vol, dest, stale)
+    if changed or stale:
+        for path in changed:
+            print(f"  updated '{path}'")
+        for path in stale:
+            print(f"  removed '{path}'")
+    else:
+        print("  all files already up to date")
+    return changed + stale
+
+
+def key_volume_files(cfg, name, keys):
+    schedule = generate_yacron_yaml(cfg, name)
+    key = key_filename(keys["public"])
+    files = {
+        f"{key}.pub": (keys["public"], 0o644, 0, 0),
+        key: (keys["private"], 0o600, 0, 0),
+    }
     if keys["authorized_keys"]:
-        print("Authorising public keys")
-        string_to_volume(
-            keys["authorized_keys"],
-            vol,
-            "authorized_keys",
-            uid=0,
-            gid=0,
-            mode=0o600,
-        )
+        files["authorized_keys"] = (keys["authorized_keys"], 0o600, 0, 0)
     if keys["known_hosts"]:
-        print("Recognising servers")
-        string_to_volume(
-            keys["known_hosts"], vol, "known_hosts", uid=0, gid=0, mode=0o600
-        )
+        files["known_hosts"] = (keys["known_hosts"], 0o600, 0, 0)
     if keys["config"]:
-        print("Adding ssh config")
-        string_to_volume(
-            keys["config"], vol, "config", uid=0, gid=0, mode=0o600
-        )
+        files["config"] = (keys["config"], 0o600, 0, 0)
     if schedule:
-        print("Adding yacron schedule")
-        string_to_volume(schedule, vol, "yacron.yml", uid=0, gid=0)
-    string_to_volume(name, vol, "name", uid=0, gid=0)
+        files["yacron.yml"] = (schedule, 0o600, 0, 0)
+    fingerprint = (
+        f"config {files_fingerprint(files)}\n"
+        f"key {key_fingerprint(keys['public'])}\n"
+    )
+    files["fingerprint"] = (fingerprint, 0o644, 0, 0)
+    # Written last, as this marks the volume as configured
+    files["name"] = (name, 0o600, 0, 0)
+    return files
+
+
+# Returns the files that need writing, and any keys of another type
+# that are still in the volume (left there when a machine's key type
+# changes; sshd would go on loading an old host key).
+def _changed_files(container, path, files):
+    other = [
+        x for k in KEY_FILENAMES for x in (k, f"{k}.pub") if x not in files
+    ]
+    found = files_from_container(container, path, [*files, *other])
+    changed = [
+        k
+        for k, v in files.items()
+        if found[k] is None or _hash(found[k]) != _hash(v[0])
+    ]
+    return changed, [x for x in other if found[x] is not None]
+
+
+# A container that is only created can't run anything, so files are
+# removed from a short-lived one, after the new keys are in place.
+def _remove_files(vol, path, files):
+    mounts = [docker.types.Mount(str(path), vol, type="volume")]
+    command = ["rm", "-f", *[str(path / x) for x in files]]
+    docker_client().containers.run(
+        "alpine", command=command, mounts=mounts, remove=True
+    )
+
+
+def _hash(text):
+    return hashlib.sha256(_text_to_bytes(text)).hexdigest()
+
+
+def _check_drift(cl, vol, name, files):
+    try:
+        volume = cl.volumes.get(vol)
+    except docker.errors.NotFound:
+        msg = f"Volume '{vol}' for '{name}' does not exist"
+        raise Exception(msg) from None
+    src = Path("/src")
+    with volume_container(vol, src) as container:
+        changed, stale = _changed_files(container, src, files)
+    changed += [f"{x} (old key type)" for x in stale]
+    if volume_labels(volume).get(LABEL_NAME, name) != name:
+        changed.append("(name label)")
+    if changed:
+        print(f"Volume '{vol}' for '{name}' differs from configuration:")
+        for path in changed:
+            print(f"  {path}")
+        msg = f"Configuration of '{name}' has drifted"
+        raise Exception(msg)
+    print(f"Volume '{vol}' for '{name}' is up to date")
+    return changed
+
+
+# Depends only on what this machine's volume should contain, so that
+# edits elsewhere in the configuration leave it alone.
+def files_fingerprint(files):
+    ret = hashlib.sha256()
+    for path in sorted(files):
+        ret.update(f"{path}\0{_hash(files[path][0])}\0".encode())
+    return ret.hexdigest()
+
+
+# Labels can only be set when a volume is created, so we only label
+# volumes with what never changes: the machine they belong to. A
+# volume labelled for another machine is left for the user to remove,
+# as it may hold the only copy of that machine's keys. Volumes
+# created before labels existed stay unlabelled, and 'check' falls
+# back on reading their 'name' file.
+def _create_key_volume(cl, vol, name):
+    try:
+        volume = cl.volumes.get(vol)
+    except docker.errors.NotFound:
+        cl.volumes.create(vol, labels={LABEL_NAME: name})
+        return
+    prev = volume_labels(volume).get(LABEL_NAME, name)
+    if prev != name:
+        msg = (
+            f"Volume '{vol}' belongs to '{prev}', can't configure it "
+            f"as '{name}': docker volume labels can't be changed, so it "
+            f"stays labelled as '{prev}'. The keys are kept in the vault, "
+            f"so if '{prev}' no longer uses it, remove it with "
+            f"'docker volume rm {vol}' and configure '{name}' again"
+        )
+        raise Exception(msg)
@@ -1,32 +1,141 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+
 from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from privateer2.profile import phase
+from privateer2.store import open_store
+
+# All public keys are also kept together in one secret under the
+# prefix, so that a machine's peers' keys can be read in one request.
+PUBKEYS_SECRET = "_public"
+PUBKEYS_CACHE_DIR = os.path.join("~", ".cache", "privateer")
+# The names ssh expects for the private key of each type we support.
+KEY_FILENAMES = ["id_rsa", "id_ed25519"]
+
+# Public keys already read in this process, per vault url and prefix.
+_PUBKEYS = {}
+_PUBKEYS_LOCK = threading.Lock()
 
 
 def keygen(cfg, name):
-    _keygen(cfg, name, cfg.vault.client())
+    with phase("vault login"):
+        store = open_store(cfg.vault)
+    public = _keygen(cfg, name, store)
+    _update_pubkeys(cfg, store, {name: public})
 
 
 def keygen_all(cfg):
-    vault = cfg.vault.client()
-    for name in cfg.list_servers() + cfg.list_clients():
-        _keygen(cfg, name, vault)
+    with phase("vault login"):
+        store = open_store(cfg.vault)
+    _keygen_many(cfg, cfg.list_servers() + cfg.list_clients(), store)
+
+
+# Only create keys for machines that have none, finding these by
+# listing the secrets under the prefix in a single request.
+def keygen_missing(cfg):
+    with phase("vault login"):
+        store = open_store(cfg.vault)
+    with phase("keys"):
+        found = set(store.list())
+    names = cfg.list_servers() + cfg.list_clients()
+    missing = [x for x in names if x not in found]
+    if not missing:
+        print("All machines already have keys")
+        return
+    _keygen_many(cfg, missing, store)
+
+
+# Keys are generated in a process pool (this is cpu bound) and written
+# to the vault from a thread pool as each one becomes ready. A failure
+# for one machine does not stop the others; we report all of them at
+# the end, after recording the public keys that were written.
+def _keygen_many(cfg, names, store):
+    timings = {}
+    errors = {}
+    public = {}
+    with phase("keygen"):
+        with ProcessPoolExecutor() as pool, ThreadPoolExecutor() as io:
+            generating = {
+                pool.submit(_timed, _create_keypair, cfg.machine_key_type(n)): n
+                for n in names
+            }
+            writing = {}
+            for f in as_completed(generating):
+                name = generating[f]
+                try:
+                    data, timings[name] = f.result()
+                except Exception as e:
+                    errors[name] = e
+                    continue
+                w = io.submit(_timed, store.write, name, data)
+                writing[w] = (name, data["public"])
+            for f in as_completed(writing):
+                name, key = writing[f]
+                try:
+                    _, elapsed = f.result()
+                except Exception as e:
+                    errors[name] = e
+                    continue
+                public[name] = key
+                timings[name] = (timings[name], elapsed)
+    for name in names:
+        if name in public:
+            t_keygen, t_write = timings[name]
+            print(
+                f"Wrote keypair for {name} "
+                f"(keygen {t_keygen:.3f}s, write {t_write:.3f}s)"
+            )
+        else:
+            print(f"Failed to create keypair for {name}: {errors[name]}")
+    if public:
+        _update_pubkeys(cfg, store, public)
+    if errors:
+        failed = ", ".join(f"'{x}'" for x in names if x in errors)
+        msg = f"Failed to create keypairs for {failed}"
+        raise Exception(msg)
+
 
+# With 'verify', every public key is read from its machine's own
+# secret and checked against the aggregated secret, rather than
+# trusting the aggregate (this costs a request per machine).
+def keys_data(cfg, name, *, verify=False):
+    with phase("vault login"):
+        store = open_store(cfg.vault)
+    with phase("keys"):
+        return _keys_data(cfg, name, store, verify=verify)
 
-def keys_data(cfg, name):
-    vault = cfg.vault.client()
-    response = vault.secrets.kv.v1.read_secret(f"{cfg.vault.prefix}/{name}")
+
+def _keys_data(cfg, name, store, *, verify=False):
+    data = store.read(name)
+    if data is None:
+        msg = f"No keys found for '{name}'; did you forget to run keygen?"
+        raise Exception(msg)
+    public = store.read(PUBKEYS_SECRET) or {}
+    if name in public and public[name] != data["public"]:
+        raise Exception(_stale_pubkeys_message([name]))
     ret = {
         "name": name,
-        **response["data"],
+        **data,
         "authorized_keys": None,
         "known_hosts": None,
         "config": None,
     }
-    if name in cfg.list_servers():
-        keys = _get_pubkeys(vault, cfg.vault.prefix, cfg.list_clients())
+    if cfg.is_server(name):
+        keys = _get_pubkeys(cfg, store, cfg.list_clients(), verify=verify)
         ret["authorized_keys"] = "".join([f"{v}\n" for v in keys.values()])
-    if name in cfg.list_clients():
-        keys = _get_pubkeys(vault, cfg.vault.prefix, cfg.list_servers())
+    if cfg.is_client(name):
+        keys = _get_pubkeys(cfg, store, cfg.list_servers(), verify=verify)
         known_hosts = []
         config = []
         for s in cfg.servers:
@@ -40,29 +149,125 @@ def keys_data(cfg, name):
     return ret
 
 
-def _keygen(cfg, name, vault):
-    data = _create_keypair()
-    path = f"{cfg.vault.prefix}/{name}"
-    # TODO: The docs are here:
-    # https://hvac.readthedocs.io/en/stable/usage/secrets_engines/kv_v1.html
-    # They do not indicate if this will error if the write fails though.
+def _keygen(cfg, name, store):
+    with phase("keygen"):
+        data = _create_keypair(cfg.machine_key_type(name))
     print(f"Writing keypair for {name}")
-    _r = vault.secrets.kv.v1.create_or_update_secret(path, secret=data)
+    with phase("write keys"):
+        store.write(name, data)
+    return data["public"]
 
 
-def _get_pubkeys(vault, prefix, nms):
-    return {
-        nm: vault.secrets.kv.v1.read_secret(f"{prefix}/{nm}")["data"]["public"]
-        for nm in nms
-    }
+def _timed(f, *args):
+    t0 = time.perf_counter()
+    ret = f(*args)
+    return ret, time.perf_counter() - t0
+
+
+def _get_pubkeys(cfg, store, nms, *, verify=False):
+    cache = _pubkey_cache(cfg)
+    missing = nms if verify else [nm for nm in nms if nm not in cache]
+    if missing:
+        cache.update(_read_pubkeys(store, missing, verify=verify))
+        _write_pubkey_cache_file(cfg, cache)
+    return {nm: cache[nm] for nm in nms}
 
 
-def _create_keypair():
-    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+# Keys generated before the aggregated secret existed (or by older
+# versions of privateer) are read one at a time, as are all keys when
+# verifying the aggregate.
+def _read_pubkeys(store, nms, *, verify=False):
+    ret = store.read(PUBKEYS_SECRET) or {}
+    stale = []
+    for nm in nms:
+        if verify or nm not in ret:
+            data = store.read(nm)
+            if data is None:
+                msg = f"No keys found for '{nm}'; did you forget to run keygen?"
+                raise Exception(msg)
+            if nm in ret and ret[nm] != data["public"]:
+                stale.append(nm)
+            ret[nm] = data["public"]
+    if stale:
+        raise Exception(_stale_pubkeys_message(stale))
+    return ret
+
+
+# The aggregate is only out of step with a machine's own secret if
+# something else wrote that secret (e.g., an older privateer), or if
+# two processes updated the aggregate at once. Peers configured from
+# it would then be given the wrong key, so we refuse to continue.
+def _stale_pubkeys_message(nms):
+    nms_str = ", ".join(f"'{x}'" for x in nms)
+    return (
+        f"Public keys for {nms_str} in '{PUBKEYS_SECRET}' do not match "
+        "their own secrets; run keygen for these machines again"
+    )
+
+
+# Threads in this process take turns to update the aggregate. Two
+# processes updating it at once may still lose one set of changes;
+# keys missing from it are then read individually, and stale keys are
+# caught by the checks above.
+def _update_pubkeys(cfg, store, public):
+    with _PUBKEYS_LOCK:
+        data = store.read(PUBKEYS_SECRET) or {}
+        data.update(public)
+        with phase("write keys"):
+            store.write(PUBKEYS_SECRET, data)
+        cache = _pubkey_cache(cfg)
+        cache.update(public)
+        _write_pubkey_cache_file(cfg, cache)
+
+
+def _pubkey_cache(cfg):
+    key = (cfg.vault.url, cfg.vault.prefix)
+    if key not in _PUBKEYS:
+        _PUBKEYS[key] = _read_pubkey_cache_file(cfg)
+    return _PUBKEYS[key]
+
+
+# Public keys can also be cached on disk for 'pubkey_cache_ttl'
+# seconds (off by default), which saves the reads when configuring
+# several machines from one host in quick succession.
+def _pubkey_cache_file(cfg):
+    key = f"{cfg.vault.url}{cfg.vault.prefix}".encode()
+    name = f"pubkeys-{hashlib.sha256(key).hexdigest()[:16]}.json"
+    return os.path.join(os.path.expanduser(PUBKEYS_CACHE_DIR), name)
+
+
+def _read_pubkey_cache_file(cfg):
+    path = _pubkey_cache_file(cfg)
+    if not cfg.vault.pubkey_cache_ttl or not os.path.exists(path):
+        return {}
+    if time.time() - os.path.getmtime(path) > cfg.vault.pubkey_cache_ttl:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_pubkey_cache_file(cfg, data):
+    if not cfg.vault.pubkey_cache_ttl:
+        return
+    path = _pubkey_cache_file(cfg)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def _create_keypair(key_type="rsa"):
+    # OpenSSH can't read ed25519 keys in PKCS8 format, but we keep
+    # using that for rsa keys, as we always have.
+    if key_type == "ed25519":
+        key = ed25519.Ed25519PrivateKey.generate()
+        fmt = crypto_serialization.PrivateFormat.OpenSSH
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        fmt = crypto_serialization.PrivateFormat.PKCS8
 
     private = key.private_bytes(
         crypto_serialization.Encoding.PEM,
-        crypto_serialization.PrivateFormat.PKCS8,
+        fmt,
         crypto_serialization.NoEncryption(),
     ).decode("UTF-8")
 
@@ -76,3 +281,19 @@ def _create_keypair():
     )
 
     return {"public": public, "private": private}
+
+
+# The same format as 'ssh-keygen -l' (sha256 of the key blob).
+def key_fingerprint(public):
+    blob = base64.b64decode(public.split()[1])
+    digest = base64.b64encode(hashlib.sha256(blob).digest()).decode("UTF-8")
+    return f"SHA256:{digest.rstrip('=')}"
+
+
+# Keys are written to the volume under the names that ssh expects for
+# their type; we find the type from the key itself rather than the
+# configuration, so that volumes always match what is in the vault.
+def key_filename(public):
+    if public.startswith("ssh-ed25519 "):
+        return "id_ed25519"
+    return "id_rsa"
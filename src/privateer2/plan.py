@@ -0,0 +1,143 @@
+import hashlib
+import json
+
+CRON_ALIASES = {
+    "@midnight": "0 0 * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+
+MINUTES_PER_DAY = 24 * 60
+
+
+# Spread the scheduled backups to each server through a window of
+# 'window' minutes, so that clients that all copied the same schedule
+# do not all connect at once. Only jobs that run at a fixed minute
+# and hour can be moved; each is moved within the window its current
+# start falls in, so planning an already planned configuration
+# changes nothing.
+def schedule_plan(cfg, path, *, window=60, duration=15, apply=False):
+    plan = plan_schedules(cfg, window=window, duration=duration)
+    if not plan:
+        print("No scheduled jobs to plan")
+        return plan
+    servers = sorted({x["server"] for x in plan})
+    print(f"Planned {len(plan)} job(s) across {len(servers)} server(s):")
+    for server in servers:
+        before = peak_concurrency(plan, server, "before")
+        after = peak_concurrency(plan, server, "after")
+        print(f"  {server}: peak {before} -> {after} concurrent backups")
+    changed = [x for x in plan if x["before"] != x["after"]]
+    for x in changed:
+        print(
+            f"  {x['client']} '{x['volume']}' to {x['server']}: "
+            f"'{x['before']}' -> '{x['after']}'"
+        )
+    if not changed:
+        print("All schedules are already planned")
+    elif apply:
+        _write_plan(path, changed)
+        print(f"Wrote schedules to '{path}'; now rerun 'configure' on clients")
+    else:
+        print(f"Run again with '--apply' to write these schedules to '{path}'")
+    return plan
+
+
+# Returns one entry per scheduled job, with its schedule 'before' and
+# 'after' planning. Longer jobs are placed first, each at the offset
+# in its window where the server is least busy, with ties going to
+# the earliest offset. Jobs are taken in an order fixed by a hash of
+# client and volume, so the plan depends only on the configuration.
+def plan_schedules(cfg, *, window=60, duration=15):
+    ret = []
+    for cl in cfg.clients:
+        if not cl.schedule:
+            continue
+        for i, job in enumerate(cl.schedule.jobs):
+            timeout = job.timeout or cl.schedule.timeout
+            ret.append(
+                {
+                    "client": cl.name,
+                    "job": i,
+                    "server": job.server,
+                    "volume": job.volume,
+                    "duration": -(-timeout // 60) if timeout else duration,
+                    "before": job.schedule,
+                    "after": job.schedule,
+                }
+            )
+    load = {}
+    movable = []
+    for x in ret:
+        cron = _parse_cron(x["before"])
+        if cron is not None:
+            start = cron[0] + cron[1] * 60
+            movable.append((x, cron, start, start - start % window))
+    movable.sort(key=lambda el: (-el[0]["duration"], _job_hash(el[0])))
+    for x, cron, prev, base in movable:
+        busy = load.setdefault(x["server"], [0] * MINUTES_PER_DAY)
+        d = x["duration"]
+        start = base + min(
+            range(min(window, MINUTES_PER_DAY - base)),
+            key=lambda off: (_busiest(busy, base + off, d), off),
+        )
+        for t in range(start, start + d):
+            busy[t % MINUTES_PER_DAY] += 1
+        if start != prev:
+            time = [str(start % 60), str(start // 60)]
+            x["after"] = " ".join([*time, *cron[2:]])
+    return ret
+
+
+# The worst case number of backups running at once against 'server',
+# treating every job as running every day.
+def peak_concurrency(plan, server, which):
+    busy = [0] * MINUTES_PER_DAY
+    for x in plan:
+        cron = _parse_cron(x[which])
+        if x["server"] != server or cron is None:
+            continue
+        start = cron[0] + cron[1] * 60
+        for t in range(start, start + x["duration"]):
+            busy[t % MINUTES_PER_DAY] += 1
+    return max(busy)
+
+
+def _busiest(busy, start, n):
+    return max(busy[t % MINUTES_PER_DAY] for t in range(start, start + n))
+
+
+def _job_hash(x):
+    key = f"{x['client']}/{x['volume']}/{x['job']}".encode()
+    return hashlib.sha256(key).hexdigest()
+
+
+# Returns (minute, hour, day of month, month, day of week) for
+# schedules that start at a fixed time of day, otherwise None.
+def _parse_cron(schedule):
+    fields = CRON_ALIASES.get(schedule, schedule).split()
+    if len(fields) != 5:  # noqa: PLR2004
+        return None
+    if not fields[0].isdigit() or not fields[1].isdigit():
+        return None
+    minute, hour = int(fields[0]), int(fields[1])
+    if minute > 59 or hour > 23:  # noqa: PLR2004
+        return None
+    return (minute, hour, *fields[2:])
+
+
+# Edit the json directly, rather than writing out our model of it, so
+# that anything we do not know about in the file is kept.
+def _write_plan(path, changed):
+    with open(path) as f:
+        data = json.load(f)
+    clients = {x["name"]: x for x in data["clients"]}
+    for x in changed:
+        job = clients[x["client"]]["schedule"]["jobs"][x["job"]]
+        job["schedule"] = x["after"]
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
+        f.write("\n")
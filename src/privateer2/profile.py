@@ -0,0 +1,177 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+_PROFILE = None
+
+
+# Collects timings of phases (sections of a command that we mark with
+# 'phase') and of every http request made to docker and vault while
+# profiling is active. Requests are attributed to the innermost phase
+# running at the time in the same thread; work handed to other
+# threads counts against that thread's own phases.
+class Profile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.calls = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current_phase(self):
+        return "/".join(self._stack) or "(other)"
+
+    def add_phase(self, name, elapsed):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def record(self, kind, name, elapsed, size):
+        key = (self.current_phase(), kind, name)
+        with self._lock:
+            count, total, total_size = self.calls.get(key, (0, 0.0, 0))
+            self.calls[key] = (count + 1, total + elapsed, total_size + size)
+
+    # Bytes of a response body that were streamed after the call itself
+    # was recorded.
+    def add_bytes(self, kind, name, size):
+        key = (self.current_phase(), kind, name)
+        with self._lock:
+            count, total, total_size = self.calls.get(key, (0, 0.0, 0))
+            self.calls[key] = (count, total, total_size + size)
+
+    def data(self):
+        total = time.perf_counter() - self.start
+        with self._lock:
+            phase_times = list(self.phases.items())
+            all_calls = dict(self.calls)
+        phases = []
+        for name, elapsed in phase_times:
+            calls = [
+                v
+                for k, v in all_calls.items()
+                if k[0] == name or k[0].startswith(f"{name}/")
+            ]
+            phases.append(
+                {
+                    "name": name,
+                    "time": elapsed,
+                    "calls": sum(x[0] for x in calls),
+                    "call_time": sum(x[1] for x in calls),
+                    "bytes": sum(x[2] for x in calls),
+                }
+            )
+        calls = [
+            {
+                "phase": k[0],
+                "kind": k[1],
+                "name": k[2],
+                "count": v[0],
+                "time": v[1],
+                "bytes": v[2],
+            }
+            for k, v in all_calls.items()
+        ]
+        return {"total": total, "phases": phases, "calls": calls}
+
+
+@contextmanager
+def profiling():
+    global _PROFILE  # noqa: PLW0603
+    prev = _PROFILE
+    try:
+        _PROFILE = Profile()
+        yield _PROFILE
+    finally:
+        _PROFILE = prev
+
+
+@contextmanager
+def phase(name):
+    profile = _PROFILE
+    if profile is None:
+        yield
+        return
+    profile._stack.append(name)
+    key = profile.current_phase()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(key, time.perf_counter() - t0)
+        profile._stack.pop()
+
+
+def record_bytes(kind, name, size):
+    if _PROFILE is not None:
+        _PROFILE.add_bytes(kind, name, size)
+
+
+# Attach to a requests session (both the docker and hvac clients are
+# built on these) so that every request is recorded. The time is that
+# until the response headers arrive, and the size is the request body
+# plus the declared response length. Streamed responses have no
+# length; readers of those report their bytes with 'record_bytes'.
+def instrument_session(session, kind):
+    def hook(response, *args, **kwargs):  # noqa: ARG001
+        if _PROFILE is not None:
+            request = response.request
+            name = f"{request.method} {_request_path(kind, request.url)}"
+            size = _body_size(request.body) + int(
+                response.headers.get("Content-Length", 0)
+            )
+            elapsed = response.elapsed.total_seconds()
+            _PROFILE.record(kind, name, elapsed, size)
+
+    session.hooks["response"].append(hook)
+    return session
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return 0
+
+
+# Collapse container/image/volume names and secret paths so that
+# calls can be grouped by endpoint.
+def _request_path(kind, url):
+    path = urlparse(url).path
+    if kind == "vault":
+        return re.sub("^(/v1/[^/]+)/.+$", "\\1/*", path)
+    path = re.sub("^/v[0-9.]+/", "/", path)
+    m = re.match("^/(containers|images|volumes)/(.+?)(/[a-z]+)?$", path)
+    if m and m.group(2) not in ["create", "json", "prune"]:
+        return f"/{m.group(1)}/*{m.group(3) or ''}"
+    return path
+
+
+def format_profile(data):
+    ret = [f"Total time: {data['total']:.3f}s", "", "Phases:"]
+    for p in data["phases"]:
+        ret.append(
+            f"  {p['name']}: {p['time']:.3f}s "
+            f"({p['calls']} calls, {p['call_time']:.3f}s, {p['bytes']} bytes)"
+        )
+    ret += ["", "Calls:"]
+    for c in sorted(data["calls"], key=lambda x: -x["time"]):
+        ret.append(
+            f"  [{c['phase']}] {c['kind']} {c['name']}: "
+            f"{c['count']} calls, {c['time']:.3f}s, {c['bytes']} bytes"
+        )
+    return ret
+
+
+def write_profile(data, path):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
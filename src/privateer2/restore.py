@@ -4,12 +4,21 @@ from privateer2.config import find_source
 from privateer2.util import match_value, mounts_str, run_container_with_command
 
 
-def restore(cfg, name, volume, *, server=None, source=None, dry_run=False):
+def restore(
+    cfg,
+    name,
+    volume,
+    *,
+    server=None,
+    source=None,
+    dry_run=False,
+    progress=False,
+):
     machine = check(cfg, name, quiet=True)
     server = match_value(server, cfg.list_servers(), "server")
     volume = match_value(volume, cfg.list_volumes(), "volume")
     source = find_source(cfg, volume, source)
-    image = f"mrcide/privateer-client:{cfg.tag}"
+    image = cfg.image("client")
     dest_mount = f"/privateer/volumes/{volume}"
     mounts = [
         docker.types.Mount(
@@ -39,5 +48,5 @@ def restore(cfg, name, volume, *, server=None, source=None, dry_run=False):
         print(f"Restoring '{volume}' from '{server}'; data originally")
         print(f"from '{source}'")
         run_container_with_command(
-            "Restore", image, command=command, mounts=mounts
+            "Restore", image, command=command, mounts=mounts, live=progress
         )
@@ -25,7 +25,7 @@ def schedule_start(cfg, name, *, dry_run=False):
     service_start(
         name,
         machine.schedule.container,
-        image=f"mrcide/privateer-client:{cfg.tag}",
+        image=cfg.image("client"),
         mounts=mounts,
         ports={f"{port}/tcp": port} if port else None,
         command=["yacron", "-c", "/privateer/keys/yacron.yml"],
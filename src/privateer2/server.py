@@ -1,6 +1,7 @@
 import docker
 from privateer2.check import check
 from privateer2.service import service_start, service_status, service_stop
+from privateer2.util import container_if_exists
 
 
 def server_start(cfg, name, *, dry_run=False):
@@ -27,7 +28,7 @@ def server_start(cfg, name, *, dry_run=False):
     service_start(
         name,
         machine.container,
-        image=f"mrcide/privateer-server:{cfg.tag}",
+        image=cfg.image("server"),
         mounts=mounts,
         ports={"22/tcp": machine.port},
         dry_run=dry_run,
@@ -43,3 +44,27 @@ def server_stop(cfg, name):
 def server_status(cfg, name):
     machine = check(cfg, name, quiet=False)
     service_status(machine.container)
+
+
+# Refresh the key volume of a running server in place. sshd reads
+# authorized_keys afresh for every connection, so new clients are
+# accepted straight away; only new host keys need sshd to reload,
+# which it does on SIGHUP without dropping existing connections.
+def server_reload(cfg, name):
+    from privateer2.configure import configure  # noqa: PLC0415
+
+    machine = check(cfg, name, quiet=True)
+    if not cfg.is_server(name):
+        msg = f"'{name}' is not a server"
+        raise Exception(msg)
+    changed = configure(cfg, name)
+    container = container_if_exists(machine.container)
+    if not container or container.status != "running":
+        print(f"Server '{name}' is not running; changes apply on next start")
+        return
+    host_keys = ["id_rsa", "id_ed25519"]
+    if any(x in host_keys for x in changed):
+        container.kill(signal="SIGHUP")
+        print(f"Asked sshd in '{machine.container}' to reload host keys")
+    else:
+        print(f"Server '{name}' will use the new keys for new connections")
@@ -1,7 +1,8 @@
-import docker
+from privateer2.profile import phase
 from privateer2.util import (
     container_exists,
     container_if_exists,
+    docker_client,
     ensure_image,
     mounts_str,
     ports_str,
@@ -50,16 +51,16 @@ def service_start(
 
     ensure_image(image)
     print(f"Starting server '{name}' as container '{container_name}'")
-    client = docker.from_env()
-    client.containers.run(
-        image,
-        auto_remove=True,
-        detach=True,
-        name=container_name,
-        mounts=mounts,
-        ports=ports,
-        command=command,
-    )
+    with phase("start"):
+        docker_client().containers.run(
+            image,
+            auto_remove=True,
+            detach=True,
+            name=container_name,
+            mounts=mounts,
+            ports=ports,
+            command=command,
+        )
 
 
 def service_stop(name, container_name):
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import hvac
+from cryptography.fernet import Fernet
+
+from privateer2.vault import vault_client
+
+SECRETS_KEY_ENVVAR = "PRIVATEER_SECRETS_KEY"
+SECRETS_CACHE_DIR = os.path.join("~", ".cache", "privateer")
+
+# Stores already opened in this process, so that we log in (and read
+# any secret) at most once however many machines we act on.
+_STORES = {}
+
+
+# Secrets (each a dict of strings) are kept in one of several
+# backends, all of which offer the same three methods:
+#
+#   read(name) -> dict, or None if there is no such secret
+#   write(name, data)
+#   list() -> names of all secrets
+#
+# 'open_store' picks the backend from the vault configuration: a
+# 'file://' url is a local encrypted file, anything else is a vault
+# server using the configured kv engine version. Whatever the backend,
+# reads are served from memory after the first.
+#
+# Secrets read from a vault server can also be kept on disk for
+# 'secrets_cache_ttl' seconds (off by default), encrypted with the
+# same key as the file backend, so that configuring again soon after
+# does not need the vault at all. Changes made to the vault by others
+# are not seen until the cached copy expires.
+def open_store(vault):
+    key = (vault.url, vault.prefix, vault.kv_version)
+    if key not in _STORES:
+        if vault.url.startswith("file://"):
+            backend = FileStore(_file_store_path(vault.url), _secrets_key())
+        elif vault.kv_version == 2:  # noqa: PLR2004
+            backend = VaultKV2Store(vault_client(vault.url), vault.prefix)
+        else:
+            backend = VaultKV1Store(vault_client(vault.url), vault.prefix)
+        if vault.secrets_cache_ttl and not isinstance(backend, FileStore):
+            local = FileStore(_secrets_cache_file(vault), _secrets_key())
+            cache = ExpiringStore(local, vault.secrets_cache_ttl)
+            backend = CachedStore(backend, cache)
+        _STORES[key] = CachedStore(backend)
+    return _STORES[key]
+
+
+# Only absolute paths are accepted ('file:///path/to/secrets'); in
+# 'file://secrets' the name would be read as a host, and a relative
+# path would depend on where privateer happens to be run from.
+def _file_store_path(url):
+    parsed = urlparse(url)
+    if parsed.netloc not in ["", "localhost"] or parsed.path in ["", "/"]:
+        msg = (
+            f"Invalid url '{url}': use an absolute path to the secrets "
+            "file, as in 'file:///path/to/secrets'"
+        )
+        raise Exception(msg)
+    return parsed.path
+
+
+def _secrets_cache_file(vault):
+    key = f"{vault.url}{vault.prefix}/v{vault.kv_version}".encode()
+    name = f"secrets-{hashlib.sha256(key).hexdigest()[:16]}.enc"
+    path = os.path.join(os.path.expanduser(SECRETS_CACHE_DIR), name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _secrets_key():
+    key = os.environ.get(SECRETS_KEY_ENVVAR)
+    if not key:
+        msg = f"Set '{SECRETS_KEY_ENVVAR}' to a Fernet key to use a local file"
+        raise Exception(msg)
+    return key
+
+
+class VaultKV1Store:
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def read(self, name):
+        try:
+            res = self.client.secrets.kv.v1.read_secret(f"{self.prefix}/{name}")
+        except hvac.exceptions.InvalidPath:
+            return None
+        return res["data"]
+
+    def write(self, name, data):
+        path = f"{self.prefix}/{name}"
+        # TODO: The docs are here:
+        # https://hvac.readthedocs.io/en/stable/usage/secrets_engines/kv_v1.html
+        # They do not indicate if this will error if the write fails though.
+        self.client.secrets.kv.v1.create_or_update_secret(path, secret=data)
+
+    def list(self):
+        try:
+            res = self.client.secrets.kv.v1.list_secrets(self.prefix)
+        except hvac.exceptions.InvalidPath:
+            return []
+        return res["data"]["keys"]
+
+
+class VaultKV2Store:
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def read(self, name):
+        try:
+            res = self.client.secrets.kv.v2.read_secret_version(
+                path=f"{self.prefix}/{name}", raise_on_deleted_version=True
+            )
+        except hvac.exceptions.InvalidPath:
+            return None
+        return res["data"]["data"]
+
+    def write(self, name, data):
+        self.client.secrets.kv.v2.create_or_update_secret(
+            path=f"{self.prefix}/{name}", secret=data
+        )
+
+    def list(self):
+        try:
+            res = self.client.secrets.kv.v2.list_secrets(path=self.prefix)
+        except hvac.exceptions.InvalidPath:
+            return []
+        return res["data"]["keys"]
+
+
+# All secrets in one json file, encrypted with a key taken from the
+# environment. Writes replace the whole file.
+class FileStore:
+    def __init__(self, path, key):
+        self.path = path
+        self.fernet = Fernet(key)
+        self._lock = threading.Lock()
+
+    def read(self, name):
+        return self._read_all().get(name)
+
+    def write(self, name, data):
+        with self._lock:
+            dat = self._read_all()
+            dat[name] = dict(data)
+            tmp = f"{self.path}.tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.fernet.encrypt(json.dumps(dat).encode()))
+            os.replace(tmp, self.path)
+
+    def list(self):
+        return list(self._read_all().keys())
+
+    def _read_all(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "rb") as f:
+            return json.loads(self.fernet.decrypt(f.read()))
+
+
+# Secrets held in memory only; useful as a stand-in for the other
+# backends (e.g., in tests and benchmarks) and as the cache below.
+class MemoryStore:
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    def read(self, name):
+        ret = self.data.get(name)
+        return None if ret is None else dict(ret)
+
+    def write(self, name, data):
+        self.data[name] = dict(data)
+
+    def list(self):
+        return list(self.data.keys())
+
+
+# Secrets kept for 'ttl' seconds from when they were written, after
+# which they read as missing; used as the on-disk cache above.
+class ExpiringStore:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+
+    def read(self, name):
+        ret = self.backend.read(name)
+        if ret is None or time.time() - ret["time"] > self.ttl:
+            return None
+        return dict(ret["data"])
+
+    def write(self, name, data):
+        self.backend.write(name, {"time": time.time(), "data": dict(data)})
+
+    def list(self):
+        return [x for x in self.backend.list() if self.read(x) is not None]
+
+
+# Reads go to the backend only the first time each secret is wanted,
+# and writes go to both. Secrets found to be missing are not cached.
+# The cache is held in memory unless another store is given.
+class CachedStore:
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = MemoryStore() if cache is None else cache
+
+    def read(self, name):
+        ret = self.cache.read(name)
+        if ret is None:
+            ret = self.backend.read(name)
+            if ret is not None:
+                self.cache.write(name, ret)
+        return ret
+
+    def write(self, name, data):
+        self.backend.write(name, data)
+        self.cache.write(name, data)
+
+    def list(self):
+        return self.backend.list()
@@ -4,6 +4,7 @@ import docker
 from privateer2.check import check
 from privateer2.config import find_source
 from privateer2.util import (
+    docker_client,
     isotimestamp,
     mounts_str,
     run_container_with_command,
@@ -79,7 +80,7 @@ def import_tar(volume, tarfile, *, dry_run=False):
         print(f"  docker volume create {volume}")
         print(f"  {' '.join(cmd)}")
     else:
-        docker.from_env().volumes.create(volume)
+        docker_client().volumes.create(volume)
         run_container_with_command(
             "Import",
             image,
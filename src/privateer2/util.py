@@ -1,17 +1,48 @@
+import collections
 import datetime
+import io
 import os
 import os.path
 import random
 import re
 import string
 import tarfile
-import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 
 import tzlocal
 
 import docker
+from privateer2.profile import instrument_session, phase, record_bytes
+
+_DOCKER_CLIENT = None
+_IMAGES_PRESENT = set()
+
+# Label recorded on key volumes by 'configure', so that a volume's
+# identity can be read without starting a container.
+LABEL_NAME = "privateer.name"
+
+
+def docker_client():
+    global _DOCKER_CLIENT  # noqa: PLW0603
+    if _DOCKER_CLIENT is None:
+        _DOCKER_CLIENT = docker.from_env()
+        instrument_session(_DOCKER_CLIENT.api, "docker")
+    return _DOCKER_CLIENT
+
+
+@contextmanager
+def transient_docker_client(client):
+    global _DOCKER_CLIENT, _IMAGES_PRESENT  # noqa: PLW0603
+    prev = (_DOCKER_CLIENT, _IMAGES_PRESENT)
+    try:
+        _DOCKER_CLIENT = client
+        _IMAGES_PRESENT = set()
+        yield client
+    finally:
+        _DOCKER_CLIENT, _IMAGES_PRESENT = prev
 
 
 def unique(x):
@@ -25,34 +56,103 @@ def unique(x):
 
 
 def string_to_volume(text, volume, path, **kwargs):
-    if isinstance(text, list):
-        text = "".join(x + "\n" for x in text)
     ensure_image("alpine")
     dest = Path("/dest")
     mounts = [docker.types.Mount(str(dest), volume, type="volume")]
-    cl = docker.from_env()
-    container = cl.containers.create("alpine", mounts=mounts)
+    container = docker_client().containers.create("alpine", mounts=mounts)
     try:
         string_to_container(text, container, dest / path, **kwargs)
     finally:
         container.remove()
 
 
+# Write several files into a volume using a single container and a
+# single archive; 'files' maps a path within the volume to a tuple of
+# (content, mode, uid, gid), where any of mode/uid/gid may be None.
+def files_to_volume(volume, files):
+    dest = Path("/dest")
+    with volume_container(volume, dest) as container:
+        files_to_container(container, dest, files)
+
+
+def files_to_container(container, path, files):
+    container.put_archive(str(path), tar_files(files))
+
+
+def tar_files(files):
+    f = io.BytesIO()
+    with tarfile.open(mode="w", fileobj=f) as t:
+        for name, (text, mode, uid, gid) in files.items():
+            data = _text_to_bytes(text)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o600
+            info.uid = os.geteuid()
+            info.gid = os.getegid()
+            set_permissions(mode=mode, uid=uid, gid=gid)(info)
+            t.addfile(info, io.BytesIO(data))
+    return f.getvalue()
+
+
+def _text_to_bytes(text):
+    if isinstance(text, list):
+        text = "".join(x + "\n" for x in text)
+    return bytes(text, "utf-8")
+
+
 def string_from_volume(volume, path):
     ensure_image("alpine")
     src = Path("/src")
     mounts = [docker.types.Mount(str(src), volume, type="volume")]
-    cl = docker.from_env()
-    container = cl.containers.create("alpine", mounts=mounts)
+    container = docker_client().containers.create("alpine", mounts=mounts)
     try:
         return string_from_container(container, src / path)
     finally:
         container.remove()
 
 
+# Read several files from a volume with a single container and a
+# single archive transfer. Files that are not found are returned as
+# None.
+def files_from_volume(volume, paths):
+    src = Path("/src")
+    with volume_container(volume, src) as container:
+        return files_from_container(container, src, paths)
+
+
+# A (stopped) container with 'volume' mounted at 'path', for moving
+# archives in and out of the volume; removed on exit.
+@contextmanager
+def volume_container(volume, path):
+    ensure_image("alpine")
+    mounts = [docker.types.Mount(str(path), volume, type="volume")]
+    container = docker_client().containers.create("alpine", mounts=mounts)
+    try:
+        yield container
+    finally:
+        container.remove()
+
+
+def files_from_container(container, path, paths):
+    stream, _ = container.get_archive(str(path))
+    return files_from_tar(ChunkReader(stream), os.path.basename(path), paths)
+
+
+def files_from_tar(fileobj, base, paths):
+    want = {f"{base}/{p}": p for p in paths}
+    ret = dict.fromkeys(paths)
+    with tarfile.open(mode="r|", fileobj=fileobj) as t:
+        for member in t:
+            if member.isfile() and member.name in want:
+                data = t.extractfile(member).read()
+                ret[want[member.name]] = data.decode("utf-8")
+    return ret
+
+
 def string_to_container(text, container, path, **kwargs):
-    with simple_tar_string(text, os.path.basename(path), **kwargs) as tar:
-        container.put_archive(os.path.dirname(path), tar)
+    tar = simple_tar_string(text, os.path.basename(path), **kwargs)
+    container.put_archive(os.path.dirname(path), tar)
 
 
 def string_from_container(container, path):
@@ -60,18 +160,43 @@ def string_from_container(container, path):
 
 
 def bytes_from_container(container, path):
-    stream, status = container.get_archive(path)
-    try:
-        fd, tmp = tempfile.mkstemp(text=False)
-        with os.fdopen(fd, "wb") as f:
-            for d in stream:
-                f.write(d)
-        with open(tmp, "rb") as f:
-            t = tarfile.open(mode="r", fileobj=f)
-            p = t.extractfile(os.path.basename(path))
-            return p.read()
-    finally:
-        os.remove(tmp)
+    stream, _ = container.get_archive(path)
+    name = os.path.basename(path)
+    with tarfile.open(mode="r|", fileobj=ChunkReader(stream)) as t:
+        for member in t:
+            if member.name == name:
+                return t.extractfile(member).read()
+    msg = f"Did not find '{name}' in archive of '{path}'"
+    raise Exception(msg)
+
+
+# Present the chunk iterator returned by docker's get_archive as a
+# file, so that tarfile can read it as a stream. At most one chunk is
+# held in memory at a time. Archives are sent without a length, so we
+# count the bytes as they arrive for the profile.
+ARCHIVE_CALL = "GET /containers/*/archive"
+
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks, name=ARCHIVE_CALL):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+        self._name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            record_bytes("docker", self._name, len(self._buf))
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
 
 
 def set_permissions(mode=None, uid=None, gid=None):
@@ -87,30 +212,8 @@ def set_permissions(mode=None, uid=None, gid=None):
     return ret
 
 
-def simple_tar_string(text, name, **kwargs):
-    text = bytes(text, "utf-8")
-    try:
-        fd, tmp = tempfile.mkstemp(text=True)
-        with os.fdopen(fd, "wb") as f:
-            f.write(text)
-        return simple_tar(tmp, name, **kwargs)
-    finally:
-        os.remove(tmp)
-
-
-def simple_tar(path, name, **kwargs):
-    f = tempfile.NamedTemporaryFile()
-    t = tarfile.open(mode="w", fileobj=f)
-    abs_path = os.path.abspath(path)
-    t.add(
-        abs_path,
-        arcname=name,
-        recursive=False,
-        filter=set_permissions(**kwargs),
-    )
-    t.close()
-    f.seek(0)
-    return f
+def simple_tar_string(text, name, *, mode=None, uid=None, gid=None):
+    return io.BytesIO(tar_files({name: (text, mode, uid, gid)}))
 
 
 @contextmanager
@@ -135,13 +238,52 @@ def _setdictvals(new, container):
     return container
 
 
+# Images only need to be looked up once per process; after that we
+# know they are present (or we pulled them).
 def ensure_image(name):
-    cl = docker.from_env()
+    if name in _IMAGES_PRESENT:
+        return
+    cl = docker_client()
+    with phase("image"):
+        try:
+            cl.images.get(name)
+        except docker.errors.ImageNotFound:
+            print(f"Pulling {name}")
+            cl.images.pull(name)
+    _IMAGES_PRESENT.add(name)
+
+
+# Tags are always re-pulled as they may have moved, but an image
+# pinned by digest that we already have can never change, so there is
+# no need to contact the registry.
+def pull_image(name):
+    if is_digest_ref(name) and image_exists(name):
+        print(f"'{name}' already present")
+    else:
+        print(f"pulling '{name}'")
+        docker_client().images.pull(name)
+    _IMAGES_PRESENT.add(name)
+
+
+def pull_images(names):
+    _in_parallel(pull_image, unique(names))
+
+
+def image_exists(name):
     try:
-        cl.images.get(name)
+        docker_client().images.get(name)
+        return True
     except docker.errors.ImageNotFound:
-        print(f"Pulling {name}")
-        cl.images.pull(name)
+        return False
+
+
+def is_digest_ref(name):
+    return "@sha256:" in name
+
+
+def _in_parallel(f, args):
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(f, args))
 
 
 def container_exists(name):
@@ -150,7 +292,7 @@ def container_exists(name):
 
 def container_if_exists(name):
     try:
-        return docker.from_env().containers.get(name)
+        return docker_client().containers.get(name)
     except docker.errors.NotFound:
         return None
 
@@ -161,21 +303,17 @@ def volume_exists(name):
 
 def volume_if_exists(name):
     try:
-        return docker.from_env().volumes.get(name)
+        return docker_client().volumes.get(name)
     except docker.errors.NotFound:
         return None
 
 
-def rand_str(n=8):
-    return "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
+def volume_labels(volume):
+    return volume.attrs.get("Labels") or {}
 
 
-def log_tail(container, n):
-    logs = container.logs().decode("utf-8").strip().split("\n")
-    if len(logs) > n:
-        return [f"(ommitting {len(logs) - n} lines of logs)"] + logs[-n:]
-    else:
-        return logs
+def rand_str(n=8):
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
 
 
 def mounts_str(mounts):
@@ -224,7 +362,6 @@ def isotimestamp():
 def take_ownership(filename, directory, *, command_only=False):  # tar
     uid = os.geteuid()
     gid = os.getegid()
-    cl = docker.from_env()
     ensure_image("alpine")
     mounts = [docker.types.Mount("/src", directory, type="bind")]
     command = ["chown", f"{uid}.{gid}", filename]
@@ -240,7 +377,7 @@ def take_ownership(filename, directory, *, command_only=False):  # tar
             *command,
         ]
     else:
-        cl.containers.run(
+        docker_client().containers.run(
             "alpine",
             mounts=mounts,
             working_dir="/src",
@@ -249,22 +386,88 @@ def take_ownership(filename, directory, *, command_only=False):  # tar
         )
 
 
-def run_container_with_command(display, image, **kwargs):
-    ensure_image(image)
-    client = docker.from_env()
-    container = client.containers.run(image, **kwargs, detach=True)
-    print(f"{display} command started. To stream progress, run:")
-    print(f"  docker logs -f {container.name}")
-    result = container.wait()
-    if result["StatusCode"] == 0:
-        print(f"{display} completed successfully! Container logs:")
-        print("\n".join(log_tail(container, 10)))
-        container.remove()
-    else:
-        print("An error occured! Container logs:")
-        print("\n".join(log_tail(container, 20)))
-        msg = f"{display} failed; see {container.name} logs for details"
-        raise Exception(msg)
+# Logs are consumed as they are produced, so that memory use does not
+# depend on how chatty the command is; only the last few lines are
+# kept for the summary. With 'live', every line is also printed as it
+# arrives, and 'callback', if given, is called with a dict describing
+# each line.
+def run_container_with_command(
+    display, image, *, live=False, callback=None, **kwargs
+):
+    with phase(display.lower()):
+        ensure_image(image)
+        container = docker_client().containers.run(image, **kwargs, detach=True)
+        if live:
+            print(f"{display} command started. Container logs:")
+        else:
+            print(f"{display} command started. To stream progress, run:")
+            print(f"  docker logs -f {container.name}")
+        logs = LogBuffer(20)
+        for chunk in container.logs(stream=True, follow=True):
+            for line in logs.add(chunk):
+                _log_line(line, logs, container.name, live, callback)
+        for line in logs.flush():
+            _log_line(line, logs, container.name, live, callback)
+        result = container.wait()
+        if result["StatusCode"] == 0:
+            if live:
+                print(f"{display} completed successfully!")
+            else:
+                print(f"{display} completed successfully! Container logs:")
+                print("\n".join(logs.tail(10)))
+            container.remove()
+        else:
+            if live:
+                print("An error occured!")
+            else:
+                print("An error occured! Container logs:")
+                print("\n".join(logs.tail(20)))
+            msg = f"{display} failed; see {container.name} logs for details"
+            raise Exception(msg)
+
+
+def _log_line(line, logs, name, live, callback):
+    if live:
+        print(line, flush=True)
+    if callback:
+        callback({"container": name, "line": line, "n": logs.n})
+
+
+# Collects a stream of log chunks into lines, keeping only the last
+# 'size' of them. Partial lines are held until they are completed, up
+# to 'max_line' bytes.
+class LogBuffer:
+    def __init__(self, size, max_line=65536):
+        self.lines = collections.deque(maxlen=size)
+        self.n = 0
+        self._partial = b""
+        self._max_line = max_line
+
+    def add(self, chunk):
+        data = self._partial + chunk
+        *complete, self._partial = data.split(b"\n")
+        if len(self._partial) > self._max_line:
+            complete.append(self._partial)
+            self._partial = b""
+        for x in complete:
+            yield self._push(x)
+
+    def flush(self):
+        if self._partial:
+            yield self._push(self._partial)
+            self._partial = b""
+
+    def tail(self, n):
+        lines = list(self.lines)[-n:]
+        if self.n > len(lines):
+            return [f"(ommitting {self.n - len(lines)} lines of logs)", *lines]
+        return lines
+
+    def _push(self, data):
+        line = data.decode("utf-8", errors="replace")
+        self.lines.append(line)
+        self.n += 1
+        return line
 
 
 @contextmanager
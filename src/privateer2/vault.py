@@ -1,17 +1,42 @@
+import hashlib
+import json
 import os
 import re
+import time
 
 import hvac
 
+from privateer2.profile import instrument_session
 
+TOKEN_CACHE_DIR = os.path.join("~", ".cache", "privateer")
+# Renew a cached token once it has less than this many seconds left
+TOKEN_RENEW_BELOW = 600
+
+
+# When we have to log in (with a GitHub token, or one typed at the
+# prompt) the resulting vault token is cached on disk, so that later
+# invocations can skip the login until the token expires. A token in
+# VAULT_TOKEN is always used directly.
 def vault_client(addr, token=None):
-    token = _get_vault_token(token)
+    if token is None and "VAULT_TOKEN" not in os.environ:
+        client = _cached_vault_client(addr)
+        if client is not None:
+            return client
+        client = _vault_login(addr, _get_vault_token(token))
+        _write_cached_token(addr, client)
+        return client
+    return _vault_login(addr, _get_vault_token(token))
+
+
+def _vault_login(addr, token):
     if _is_github_token(token):
         print("logging into vault using github")
         client = hvac.Client(addr)
+        instrument_session(client.adapter.session, "vault")
         client.auth.github.login(token)
     else:
         client = hvac.Client(addr, token=token)
+        instrument_session(client.adapter.session, "vault")
     return client
 
 
@@ -32,3 +57,47 @@ def _get_vault_token(token):
 def _is_github_token(token):
     re_gh = re.compile("^ghp_[A-Za-z0-9]{36}$")
     return re_gh.match(token)
+
+
+def _token_cache_path(addr):
+    key = hashlib.sha256(addr.encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(TOKEN_CACHE_DIR), f"vault-{key}")
+
+
+# Check the cached token with a single lookup, which also tells us
+# how long it has left, renewing it if that is not long.
+def _cached_vault_client(addr):
+    path = _token_cache_path(addr)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        dat = json.load(f)
+    expires = dat.get("expires")
+    if dat.get("addr") != addr or (expires and expires < time.time()):
+        return None
+    client = hvac.Client(addr, token=dat["token"])
+    instrument_session(client.adapter.session, "vault")
+    try:
+        info = client.auth.token.lookup_self()["data"]
+    except hvac.exceptions.VaultError:
+        os.remove(path)
+        return None
+    if info["renewable"] and 0 < info["ttl"] < TOKEN_RENEW_BELOW:
+        client.auth.token.renew_self()
+        _write_cached_token(addr, client)
+    return client
+
+
+def _write_cached_token(addr, client):
+    info = client.auth.token.lookup_self()["data"]
+    ttl = info["ttl"]
+    dat = {
+        "addr": addr,
+        "token": client.token,
+        "expires": time.time() + ttl if ttl else None,
+    }
+    path = _token_cache_path(addr)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(dat, f)
@@ -0,0 +1,247 @@
+import base64
+import shlex
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import docker
+from privateer2.check import (
+    check,
+    connection_probe_script,
+    parse_connection_probes,
+)
+from privateer2.util import docker_client, ensure_image
+
+
+def watch(
+    cfg,
+    name,
+    *,
+    interval=60,
+    freshness_interval=3600,
+    host="127.0.0.1",
+    port=9100,
+    timeout=10,
+    iterations=None,
+):
+    machine = check(cfg, name, quiet=True)
+    metrics = Metrics()
+    server = metrics_server(metrics, host, port)
+    print(f"Serving metrics at http://{host}:{server.server_port}/metrics")
+    freshness = BackupFreshness(freshness_interval)
+    probe = None
+    errors = 0
+    try:
+        i = 0
+        while iterations is None or i < iterations:
+            if i > 0:
+                time.sleep(interval)
+            # Anything going wrong here (docker restarting, the probe
+            # container dying) should not stop the watcher; we count
+            # the error and start with a fresh probe next time.
+            try:
+                if probe is None and cfg.is_client(name):
+                    probe = _start_probe_container(cfg, machine)
+                values = watch_once(
+                    cfg, name, probe, timeout=timeout, freshness=freshness
+                )
+            except Exception as e:
+                print(f"Error while checking '{name}': {e}")
+                errors += 1
+                values = []
+                _stop_probe_container(probe)
+                probe = None
+            metrics.update([*values, ("privateer_watch_errors", {}, errors)])
+            i += 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        _stop_probe_container(probe)
+
+
+# One round of checks, returning a list of (metric, labels, value).
+# Identity comes from the volume labels, so costs a single docker
+# call; everything that needs ssh runs inside the long-lived probe
+# container via 'exec', rather than starting a container each time.
+def watch_once(cfg, name, probe, *, timeout=10, freshness=None):
+    if freshness is None:
+        freshness = BackupFreshness(0)
+    ret = []
+    try:
+        check(cfg, name, quiet=True)
+        ok = 1
+    except Exception:
+        ok = 0
+    ret.append(("privateer_identity_ok", {"machine": name}, ok))
+    if probe is None:
+        return ret
+    names = cfg.list_servers()
+    output = _exec(probe, connection_probe_script(names, timeout))
+    probes = parse_connection_probes(output, names, timeout)
+    for server, res in probes.items():
+        labels = {"server": server}
+        up = 1 if res["status"] == "ok" else 0
+        ret.append(("privateer_server_up", labels, up))
+        if res["latency"] is not None:
+            latency = res["latency"]
+            ret.append(("privateer_server_latency_seconds", labels, latency))
+    volumes = cfg.machine_config(name).backup
+    up = [k for k, v in probes.items() if v["status"] == "ok"]
+    now = time.time()
+    if volumes and up and freshness.due(now):
+        script = backup_freshness_script(name, up, volumes, timeout)
+        freshness.update(parse_backup_freshness(_exec(probe, script)), now)
+    for (server, volume), mtime in freshness.found.items():
+        labels = {"server": server, "volume": volume}
+        ret.append(("privateer_backup_newest_file_seconds", labels, mtime))
+        ret.append(("privateer_backup_age_seconds", labels, now - mtime))
+    return ret
+
+
+# Finding the newest file means listing every file backed up to each
+# server, which is too costly to repeat at every check, so it is done
+# every 'interval' seconds and remembered in between. Servers that
+# could not be reached keep their last known result.
+class BackupFreshness:
+    def __init__(self, interval):
+        self.interval = interval
+        self.checked = None
+        self.found = {}
+
+    def due(self, now):
+        return self.checked is None or now - self.checked >= self.interval
+
+    def update(self, found, now):
+        self.found.update(found)
+        self.checked = now
+
+
+def _start_probe_container(cfg, machine):
+    image = cfg.image("client")
+    mounts = [
+        docker.types.Mount(
+            "/privateer/keys", machine.key_volume, type="volume", read_only=True
+        )
+    ]
+    ensure_image(image)
+    return docker_client().containers.run(
+        image,
+        command=["sleep", "infinity"],
+        mounts=mounts,
+        auto_remove=True,
+        detach=True,
+    )
+
+
+def _stop_probe_container(probe):
+    if probe is not None:
+        try:
+            probe.stop(timeout=1)
+        except Exception:  # noqa: S110
+            pass
+
+
+def _exec(container, script):
+    res = container.exec_run(["bash", "-c", script])
+    return res.output.decode("utf-8")
+
+
+# rsync preserves modification times, so the newest file in each
+# backed-up volume on the server tells us how recent the data there
+# is. As with the connection probe, every server is queried at once
+# and reports one tab-separated line of name and base64 output.
+def backup_freshness_script(name, servers, volumes, timeout):
+    remote = "; ".join(
+        f"printf '%s\\t%s\\n' {shlex.quote(v)} "
+        f'"$(find /privateer/volumes/{shlex.quote(name)}/{shlex.quote(v)} '
+        '-type f -exec stat -c %Y {} + 2> /dev/null | sort -n | tail -n 1)"'
+        for v in volumes
+    )
+    ret = []
+    for server in servers:
+        nm = shlex.quote(server)
+        ssh = (
+            f"timeout {timeout} ssh -n -o BatchMode=yes "
+            f"-o ConnectTimeout={timeout} {nm} {shlex.quote(remote)}"
+        )
+        ret.append(
+            f"(out=$({ssh} 2> /dev/null); "
+            f'printf "%s\\t%s\\n" {nm} "$(printf %s "$out" | base64 -w0)") &'
+        )
+    ret.append("wait")
+    return "\n".join(ret)
+
+
+def parse_backup_freshness(output):
+    ret = {}
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 2:  # noqa: PLR2004
+            continue
+        server = parts[0]
+        out = base64.b64decode(parts[1]).decode("utf-8", errors="replace")
+        for el in out.splitlines():
+            volume, _, mtime = el.partition("\t")
+            if mtime.strip().isdigit():
+                ret[(server, volume)] = int(mtime)
+    return ret
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._text = ""
+
+    def update(self, values):
+        text = format_metrics(values, time.time())
+        with self._lock:
+            self._text = text
+
+    def text(self):
+        with self._lock:
+            return self._text
+
+
+# Prometheus text exposition format; samples of the same metric are
+# kept together under one TYPE line.
+def format_metrics(values, now):
+    values = [*values, ("privateer_watch_last_run_seconds", {}, now)]
+    ret = []
+    seen = []
+    for metric, _, _ in values:
+        if metric not in seen:
+            seen.append(metric)
+    for metric in seen:
+        ret.append(f"# TYPE {metric} gauge")
+        for m, labels, value in values:
+            if m == metric:
+                ret.append(f"{m}{_format_labels(labels)} {value}")
+    return "".join(f"{x}\n" for x in ret)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(f'{k}="{v}"' for k, v in labels.items())
+    return f"{{{body}}}"
+
+
+def metrics_server(metrics, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
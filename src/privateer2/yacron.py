@@ -13,25 +13,73 @@ def generate_yacron_yaml(cfg, name):
     if not isinstance(machine, Client) or not machine.schedule:
         return None
 
+    schedule = machine.schedule
     ret = ["defaults:", f'  timezone: "{current_timezone_name()}"']
+    ret += _job_limits(schedule, "  ")
 
-    if machine.schedule.port:
+    if schedule.port:
         ret.append("web:")
         ret.append("  listen:")
-        ret.append(f"    - http://0.0.0.0:{machine.schedule.port}")
+        ret.append(f"    - http://0.0.0.0:{schedule.port}")
 
+    volumes = [job.volume for job in schedule.jobs]
     ret.append("jobs:")
-    for i, job in enumerate(machine.schedule.jobs):
+    for i, job in enumerate(schedule.jobs):
         job_name = f"job-{i + 1}"
         cmd = " ".join(backup_command(name, job.volume, job.server))
+        shared = volumes.count(job.volume) > 1
+        lock = shared and schedule.volume_policy != "allow"
+        if lock or schedule.max_concurrent:
+            cmd = f"exec {cmd}"
+        if schedule.max_concurrent:
+            cmd = _with_slot(cmd, schedule.max_concurrent)
+        if lock:
+            cmd = _with_volume_lock(cmd, job.volume, schedule.volume_policy)
         ret.append(f'  - name: "{job_name}"')
         ret.append(f'    command: "{cmd}"')
         ret.append(f'    schedule: "{job.schedule}"')
+        ret += _job_limits(job, "    ")
 
     _validate_yacron_yaml(ret)
     return ret
 
 
+# yacron handles overlapping runs of one job, and timeouts, itself.
+def _job_limits(x, indent):
+    ret = []
+    if x.concurrency_policy:
+        policy = x.concurrency_policy.capitalize()
+        ret.append(f"{indent}concurrencyPolicy: {policy}")
+    if x.timeout:
+        ret.append(f"{indent}executionTimeout: {x.timeout}")
+    return ret
+
+
+# yacron knows nothing of volumes, so jobs that back up the same
+# volume hold a lock on it while running. The command is exec'd so
+# that the lock holder is the process yacron kills on timeout, and
+# its pid (recorded in the lock file) is the one we replace.
+def _with_volume_lock(cmd, volume, policy):
+    lock = f"/tmp/privateer-volume-{volume}.lock"  # noqa: S108
+    if policy == "forbid":
+        busy = f"{{ echo 'Backup of {volume} already running' >&2; exit 0; }}"
+    else:
+        busy = f"{{ kill $(cat {lock}) 2> /dev/null; flock 9; }}"
+    return f"exec 9<> {lock}; flock -n 9 || {busy}; echo $$ > {lock}; {cmd}"
+
+
+# Nor does it limit the number of jobs running at once, so each job
+# first waits until it can lock one of 'n' slots.
+def _with_slot(cmd, n):
+    slots = " ".join(str(i + 1) for i in range(n))
+    wait = (
+        f"while :; do for i in {slots}; do "
+        "exec 8<> /tmp/privateer-slot-$i.lock; flock -n 8 && break 2; "
+        "done; sleep 10; done"
+    )
+    return f"{wait}; {cmd}"
+
+
 def _validate_yacron_yaml(text):
     text = "".join(f"{x}\n" for x in text)
     try:
@@ -0,0 +1,182 @@
+import asyncio
+import struct
+
+import pytest
+
+import docker
+from privateer2.aio import (
+    async_docker_client,
+    container_config,
+    demux_log_stream,
+    files_from_volume,
+    files_to_volume,
+    run_container_with_command,
+)
+from privateer2.profile import phase, profiling
+from privateer2.util import tar_files
+
+
+class FakeAsyncDocker:
+    def __init__(self, logs, status, archive=None):
+        self.logs = logs
+        self.status = status
+        self.archive = archive or []
+        self.calls = []
+
+    async def ensure_image(self, name):
+        self.calls.append(("ensure_image", name))
+
+    async def container_create(self, image, **kwargs):
+        self.calls.append(("create", image, kwargs))
+        return "abcdef0123456789"
+
+    async def container_start(self, cid):
+        self.calls.append(("start", cid))
+
+    async def container_logs(self, cid):
+        self.calls.append(("logs", cid))
+        for x in self.logs:
+            yield x
+
+    async def container_wait(self, cid):
+        self.calls.append(("wait", cid))
+        return self.status
+
+    async def container_remove(self, cid):
+        self.calls.append(("remove", cid))
+
+    async def get_archive(self, cid, path):
+        self.calls.append(("get_archive", cid, str(path)))
+        for x in self.archive:
+            yield x
+
+
+def _frame(data, stream=1):
+    return struct.pack(">BxxxL", stream, len(data)) + data
+
+
+def test_can_build_container_config():
+    assert container_config("img") == {
+        "Image": "img",
+        "HostConfig": {"AutoRemove": False},
+    }
+    mounts = [docker.types.Mount("/dest", "vol", type="volume", read_only=True)]
+    res = container_config(
+        "img",
+        command=["a", "b"],
+        mounts=mounts,
+        ports={"22/tcp": 10022},
+        working_dir="/src",
+        auto_remove=True,
+    )
+    assert res == {
+        "Image": "img",
+        "Cmd": ["a", "b"],
+        "WorkingDir": "/src",
+        "ExposedPorts": {"22/tcp": {}},
+        "HostConfig": {
+            "AutoRemove": True,
+            "Mounts": [
+                {
+                    "Target": "/dest",
+                    "Source": "vol",
+                    "Type": "volume",
+                    "ReadOnly": True,
+                }
+            ],
+            "PortBindings": {"22/tcp": [{"HostPort": "10022"}]},
+        },
+    }
+
+
+def test_can_demultiplex_log_stream():
+    async def collect():
+        reader = asyncio.StreamReader()
+        reader.feed_data(_frame(b"hello\n") + _frame(b"world\n", 2))
+        reader.feed_eof()
+        return [x async for x in demux_log_stream(reader)]
+
+    assert asyncio.run(collect()) == [b"hello\n", b"world\n"]
+
+
+def test_can_run_command_asynchronously(capsys):
+    cl = FakeAsyncDocker([b"1\n2", b"\n3\n"], 0)
+    asyncio.run(run_container_with_command(cl, "Test", "img", command=["cmd"]))
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines == [
+        "Test command started. To stream progress, run:",
+        "  docker logs -f abcdef012345",
+        "Test completed successfully! Container logs:",
+        "1",
+        "2",
+        "3",
+    ]
+    assert cl.calls == [
+        ("ensure_image", "img"),
+        ("create", "img", {"command": ["cmd"]}),
+        ("start", "abcdef0123456789"),
+        ("logs", "abcdef0123456789"),
+        ("wait", "abcdef0123456789"),
+        ("remove", "abcdef0123456789"),
+    ]
+
+
+def test_can_run_failing_command_asynchronously(capsys):
+    cl = FakeAsyncDocker([b"oops\n"], 1)
+    with pytest.raises(Exception, match="Test failed; see nm logs"):
+        asyncio.run(
+            run_container_with_command(
+                cl, "Test", "img", name="nm", command=["false"]
+            )
+        )
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[0] == "Test command started. To stream progress, run:"
+    assert lines[1] == "  docker logs -f nm"
+    assert lines[2:] == ["An error occured! Container logs:", "oops"]
+    assert ("remove", "abcdef0123456789") not in cl.calls
+
+
+def test_can_read_files_from_streamed_archive_asynchronously():
+    tar = tar_files({"src/a": ("hello", None, None, None)})
+    chunks = [tar[i : i + 100] for i in range(0, len(tar), 100)]
+    cl = FakeAsyncDocker([], 0, chunks)
+    res = asyncio.run(files_from_volume(cl, "vol", ["a", "b"]))
+    assert res == {"a": "hello", "b": None}
+    assert cl.calls[-2:] == [
+        ("get_archive", "abcdef0123456789", "/src"),
+        ("remove", "abcdef0123456789"),
+    ]
+
+
+def test_archives_read_asynchronously_count_their_bytes():
+    tar = tar_files({"src/a": ("hello", None, None, None)})
+    cl = FakeAsyncDocker([], 0, [tar])
+    with profiling() as p:
+        with phase("a"):
+            asyncio.run(files_from_volume(cl, "vol", ["a"]))
+        data = p.data()
+    assert data["calls"] == [
+        {
+            "phase": "a",
+            "kind": "docker",
+            "name": "GET /containers/*/archive",
+            "count": 0,
+            "time": 0.0,
+            "bytes": len(tar),
+        }
+    ]
+
+
+def test_can_copy_files_through_volume_asynchronously(managed_docker):
+    vols = [managed_docker("volume") for _ in range(3)]
+
+    async def roundtrip(cl, vol):
+        await cl.volume_create(vol)
+        await files_to_volume(cl, vol, {"a": (vol, None, None, None)})
+        return await files_from_volume(cl, vol, ["a", "b"])
+
+    async def run():
+        async with async_docker_client() as cl:
+            return await asyncio.gather(*[roundtrip(cl, v) for v in vols])
+
+    assert asyncio.run(run()) == [{"a": v, "b": None} for v in vols]
@@ -65,5 +65,5 @@ def test_can_run_backup(monkeypatch, managed_docker):
         ]
         assert mock_run.call_count == 1
         assert mock_run.call_args == call(
-            "Backup", image, command=command, mounts=mounts
+            "Backup", image, command=command, mounts=mounts, live=False
         )
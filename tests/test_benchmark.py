@@ -0,0 +1,133 @@
+import json
+import time
+from unittest.mock import MagicMock, call
+
+import pytest
+
+import privateer2.benchmark
+from privateer2.benchmark import (
+    benchmark_script,
+    benchmark_servers,
+    choose_server,
+    parse_benchmark,
+    read_benchmark,
+    write_benchmark,
+)
+from privateer2.config import read_config
+
+
+def _ok(throughput, rtt):
+    return {
+        "status": "ok",
+        "handshake": 0.1,
+        "rtt": rtt,
+        "throughput": throughput,
+    }
+
+
+def _cfg_with_servers(*names):
+    cfg = read_config("example/simple.json")
+    for nm in names:
+        server = cfg.servers[0].model_copy()
+        server.name = nm
+        server.hostname = f"{nm}.example.com"
+        cfg.servers.append(server)
+    cfg.reindex()
+    return cfg
+
+
+def test_can_parse_benchmark_output():
+    output = "alice\t0\t120000\t5000\t500000\ncarol\t255\t10\t0\t0\nnoise\n"
+    res = parse_benchmark(output, ["alice", "carol", "dave"], 1000000)
+    assert res == {
+        "alice": {
+            "status": "ok",
+            "handshake": 0.12,
+            "rtt": 0.005,
+            "throughput": 2000000.0,
+        },
+        "carol": {"status": "error"},
+        "dave": {"status": "error"},
+    }
+
+
+def test_benchmark_script_measures_servers_in_turn():
+    script = benchmark_script(["alice", "bob"], 1000, 5).split("\n")
+    assert len(script) == 3
+    assert "ControlPath=/tmp/cm-1 alice true" in script[1]
+    assert "head -c 1000 /dev/zero" in script[1]
+    assert "ControlPath=/tmp/cm-2 bob true" in script[2]
+    assert not script[1].endswith("&")
+
+
+def test_can_cache_benchmark_results(tmp_path):
+    assert read_benchmark(str(tmp_path), "bob") is None
+    write_benchmark(str(tmp_path), "bob", {"alice": _ok(1, 1)})
+    write_benchmark(str(tmp_path), "eve", {"alice": _ok(2, 2)})
+    assert read_benchmark(str(tmp_path), "bob") == {"alice": _ok(1, 1)}
+    assert read_benchmark(str(tmp_path), "eve") == {"alice": _ok(2, 2)}
+    assert read_benchmark(str(tmp_path), "bob", ttl=-1) is None
+
+
+def test_can_choose_fastest_healthy_server(tmp_path):
+    cfg = _cfg_with_servers("carol", "dave")
+    root = str(tmp_path)
+    msg = "No recent benchmark for 'bob'; run 'privateer2 check --benchmark'"
+    with pytest.raises(Exception, match=msg):
+        choose_server(cfg, "bob", root)
+    result = {
+        "alice": _ok(10, 0.2),
+        "carol": _ok(10, 0.1),
+        "dave": {"status": "error"},
+        "eve": _ok(100, 0.01),
+    }
+    write_benchmark(root, "bob", result)
+    assert choose_server(cfg, "bob", root) == "carol"
+    result["alice"]["throughput"] = 20
+    write_benchmark(root, "bob", result)
+    assert choose_server(cfg, "bob", root) == "alice"
+    write_benchmark(root, "bob", {"alice": {"status": "error"}})
+    with pytest.raises(Exception, match="No healthy servers in benchmark"):
+        choose_server(cfg, "bob", root)
+
+
+def test_stale_benchmarks_are_ignored(tmp_path):
+    cfg = read_config("example/simple.json")
+    path = tmp_path / ".privateer_benchmark.json"
+    data = {"bob": {"time": time.time() - 2 * 24 * 60 * 60, "servers": {}}}
+    with path.open("w") as f:
+        json.dump(data, f)
+    with pytest.raises(Exception, match="No recent benchmark for 'bob'"):
+        choose_server(cfg, "bob", str(tmp_path))
+
+
+def test_can_benchmark_servers(capsys, monkeypatch, tmp_path):
+    cfg = _cfg_with_servers("carol")
+    mock_check = MagicMock(return_value=cfg.clients[0])
+    mock_docker_client = MagicMock()
+    monkeypatch.setattr(privateer2.benchmark, "check", mock_check)
+    monkeypatch.setattr(
+        privateer2.benchmark, "docker_client", mock_docker_client
+    )
+    monkeypatch.setattr(privateer2.benchmark, "ensure_image", MagicMock())
+    client = mock_docker_client.return_value
+    client.containers.run.return_value = b"alice\t0\t120000\t5000\t500000\n"
+    res = benchmark_servers(cfg, "bob", str(tmp_path), size=1000000)
+    assert mock_check.call_args == call(cfg, "bob", quiet=True)
+    assert res == parse_benchmark(
+        "alice\t0\t120000\t5000\t500000", ["alice", "carol"], 1000000
+    )
+    assert read_benchmark(str(tmp_path), "bob") == res
+    assert capsys.readouterr().out == (
+        "benchmarking 2 server(s)...\n"
+        "benchmarking 'alice' (alice.example.com)...OK handshake 0.120s, "
+        "rtt 0.005s, throughput 2.0 MB/s\n"
+        "benchmarking 'carol' (carol.example.com)...ERROR\n"
+    )
+
+
+def test_only_clients_can_benchmark(monkeypatch, tmp_path):
+    cfg = read_config("example/simple.json")
+    monkeypatch.setattr(privateer2.benchmark, "check", MagicMock())
+    with pytest.raises(Exception, match="Only clients can benchmark servers"):
+        benchmark_servers(cfg, "alice", str(tmp_path))
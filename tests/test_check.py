@@ -1,11 +1,16 @@
+import base64
 from unittest.mock import MagicMock, call
 
 import pytest
 import vault_dev
 
-import docker
 import privateer2.check
-from privateer2.check import _check_connections, check
+from privateer2.check import (
+    _check_connections,
+    check,
+    connection_probe_script,
+    parse_connection_probes,
+)
 from privateer2.config import read_config
 from privateer2.configure import configure
 from privateer2.keys import keygen_all
@@ -46,47 +51,22 @@ def test_error_on_check_if_unknown_machine():
             check(cfg, "eve")
 
 
-def test_can_check_connections(capsys, monkeypatch, managed_docker):
-    mock_docker = MagicMock()
-    monkeypatch.setattr(privateer2.check, "docker", mock_docker)
-    with vault_dev.Server(export_token=True) as server:
-        cfg = read_config("example/simple.json")
-        cfg.vault.url = server.url()
-        vol_keys_bob = managed_docker("volume")
-        cfg.servers[0].key_volume = managed_docker("volume")
-        cfg.clients[0].key_volume = vol_keys_bob
-        keygen_all(cfg)
-        configure(cfg, "bob")
-        capsys.readouterr()  # flush previous output
-        _check_connections(cfg, cfg.clients[0])
-
-        out = capsys.readouterr().out
-        assert (
-            out == "checking connection to 'alice' (alice.example.com)...OK\n"
-        )
-        assert mock_docker.from_env.called
-        client = mock_docker.from_env.return_value
-        mount = mock_docker.types.Mount
-        assert mount.call_count == 1
-        assert mount.call_args_list[0] == call(
-            "/privateer/keys", vol_keys_bob, type="volume", read_only=True
-        )
-        assert client.containers.run.call_count == 1
-        assert client.containers.run.call_args == call(
-            f"mrcide/privateer-client:{cfg.tag}",
-            mounts=[mount.return_value],
-            command=["ssh", "alice", "cat", "/privateer/keys/name"],
-            remove=True,
-        )
+def _probe_line(name, code, ms, out):
+    out = base64.b64encode(out.encode()).decode()
+    return f"{name}\t{code}\t{ms}\t{out}\n"
 
 
-def test_can_report_connection_failure(capsys, monkeypatch, managed_docker):
+def test_can_check_connections(capsys, monkeypatch, managed_docker):
     mock_docker = MagicMock()
-    mock_docker.errors = docker.errors
-    err = docker.errors.ContainerError("nm", 1, "ssh", "img", b"the reason")
+    mock_docker_client = MagicMock()
+    mock_ensure_image = MagicMock()
     monkeypatch.setattr(privateer2.check, "docker", mock_docker)
-    client = mock_docker.from_env.return_value
-    client.containers.run.side_effect = err
+    monkeypatch.setattr(privateer2.check, "docker_client", mock_docker_client)
+    monkeypatch.setattr(privateer2.check, "ensure_image", mock_ensure_image)
+    client = mock_docker_client.return_value
+    client.containers.run.return_value = _probe_line(
+        "alice", 0, 123, "alice\n"
+    ).encode()
     with vault_dev.Server(export_token=True) as server:
         cfg = read_config("example/simple.json")
         cfg.vault.url = server.url()
@@ -96,29 +76,93 @@ def test_can_report_connection_failure(capsys, monkeypatch, managed_docker):
         keygen_all(cfg)
         configure(cfg, "bob")
         capsys.readouterr()  # flush previous output
-        _check_connections(cfg, cfg.clients[0])
+        res = _check_connections(cfg, cfg.clients[0])
 
+        assert res == {
+            "alice": {"status": "ok", "latency": 0.123, "error": None}
+        }
         out = capsys.readouterr().out
         assert out == (
-            "checking connection to 'alice' (alice.example.com)...ERROR\n"
-            "the reason\n"
+            "checking connections to 1 server(s)...\n"
+            "checking connection to 'alice' (alice.example.com)...OK (0.123s)\n"
         )
-        assert mock_docker.from_env.called
-        client = mock_docker.from_env.return_value
         mount = mock_docker.types.Mount
         assert mount.call_count == 1
         assert mount.call_args_list[0] == call(
             "/privateer/keys", vol_keys_bob, type="volume", read_only=True
         )
+        image = f"mrcide/privateer-client:{cfg.tag}"
+        assert mock_ensure_image.call_args == call(image)
         assert client.containers.run.call_count == 1
         assert client.containers.run.call_args == call(
-            f"mrcide/privateer-client:{cfg.tag}",
+            image,
             mounts=[mount.return_value],
-            command=["ssh", "alice", "cat", "/privateer/keys/name"],
+            command=["bash", "-c", connection_probe_script(["alice"], 10)],
             remove=True,
         )
 
 
+def test_can_report_connection_failure(capsys, monkeypatch):
+    mock_docker_client = MagicMock()
+    monkeypatch.setattr(privateer2.check, "docker_client", mock_docker_client)
+    monkeypatch.setattr(privateer2.check, "ensure_image", MagicMock())
+    client = mock_docker_client.return_value
+    client.containers.run.return_value = (
+        _probe_line("alice", 255, 20, "the reason\n")
+        + _probe_line("carol", 124, 5000, "")
+    ).encode()
+    cfg = read_config("example/simple.json")
+    cfg.servers.append(cfg.servers[0].model_copy())
+    cfg.servers[1].name = "carol"
+    cfg.servers[1].hostname = "carol.example.com"
+    cfg.servers.append(cfg.servers[0].model_copy())
+    cfg.servers[2].name = "dave"
+    cfg.servers[2].hostname = "dave.example.com"
+    cfg.reindex()
+    res = _check_connections(cfg, cfg.clients[0], timeout=5)
+    assert res == {
+        "alice": {"status": "error", "latency": 0.02, "error": "the reason"},
+        "carol": {
+            "status": "timeout",
+            "latency": 5.0,
+            "error": "timed out after 5s",
+        },
+        "dave": {"status": "error", "latency": None, "error": "no result"},
+    }
+    out = capsys.readouterr().out
+    assert out == (
+        "checking connections to 3 server(s)...\n"
+        "checking connection to 'alice' (alice.example.com)...ERROR\n"
+        "the reason\n"
+        "checking connection to 'carol' (carol.example.com)...TIMEOUT\n"
+        "timed out after 5s\n"
+        "checking connection to 'dave' (dave.example.com)...ERROR\n"
+        "no result\n"
+    )
+
+
+def test_connection_probe_checks_server_identity():
+    output = _probe_line("alice", 0, 10, "bob")
+    res = parse_connection_probes(output, ["alice"], 10)
+    assert res == {
+        "alice": {
+            "status": "error",
+            "latency": 0.01,
+            "error": "server identifies as 'bob', not 'alice'",
+        }
+    }
+
+
+def test_connection_probe_script_runs_probes_concurrently():
+    script = connection_probe_script(["alice", "bob"], 3).split("\n")
+    assert len(script) == 3
+    assert script[0].endswith("&")
+    assert "timeout 3 ssh" in script[0]
+    assert " alice cat /privateer/keys/name" in script[0]
+    assert " bob cat /privateer/keys/name" in script[1]
+    assert script[2] == "wait"
+
+
 def test_only_test_connection_for_clients(monkeypatch, managed_docker):
     mock_check = MagicMock()
     monkeypatch.setattr(privateer2.check, "_check_connections", mock_check)
@@ -140,3 +184,37 @@ def test_only_test_connection_for_clients(monkeypatch, managed_docker):
         check(cfg, "bob", connection=True)
         assert mock_check.call_count == 1
         assert mock_check.call_args == call(cfg, cfg.clients[0])
+
+
+def test_check_reads_identity_from_volume_labels(monkeypatch):
+    mock_docker_client = MagicMock()
+    mock_string_from_volume = MagicMock(return_value="alice")
+    monkeypatch.setattr(privateer2.check, "docker_client", mock_docker_client)
+    monkeypatch.setattr(
+        privateer2.check, "string_from_volume", mock_string_from_volume
+    )
+    volume = mock_docker_client.return_value.volumes.get.return_value
+    volume.attrs = {"Labels": {"privateer.name": "alice"}}
+    cfg = read_config("example/simple.json")
+    assert check(cfg, "alice", quiet=True) == cfg.servers[0]
+    assert mock_string_from_volume.call_count == 0
+    volume.attrs = {"Labels": {"privateer.name": "bob"}}
+    with pytest.raises(Exception, match="Configuration is for 'bob'"):
+        check(cfg, "alice", quiet=True)
+    assert mock_string_from_volume.call_count == 0
+
+
+def test_check_falls_back_to_file_for_unlabelled_volumes(monkeypatch):
+    mock_docker_client = MagicMock()
+    mock_string_from_volume = MagicMock(return_value="alice")
+    monkeypatch.setattr(privateer2.check, "docker_client", mock_docker_client)
+    monkeypatch.setattr(
+        privateer2.check, "string_from_volume", mock_string_from_volume
+    )
+    volume = mock_docker_client.return_value.volumes.get.return_value
+    volume.attrs = {"Labels": None}
+    cfg = read_config("example/simple.json")
+    assert check(cfg, "alice", quiet=True) == cfg.servers[0]
+    assert mock_string_from_volume.call_args == call(
+        cfg.servers[0].key_volume, "name"
+    )
@@ -1,9 +1,13 @@
+import json
 import shutil
+import subprocess
+import sys
 from unittest.mock import MagicMock, call
 
 import pytest
 
 import privateer2.cli
+from privateer2.benchmark import write_benchmark
 from privateer2.cli import (
     Call,
     _do_configure,
@@ -11,12 +15,16 @@ from privateer2.cli import (
     _parse_argv,
     _parse_opts,
     _path_config,
+    _run_profiled,
     _show_version,
     main,
     pull,
 )
 from privateer2.config import read_config
-from privateer2.util import transient_working_directory
+from privateer2.util import (
+    transient_docker_client,
+    transient_working_directory,
+)
 
 
 def test_can_create_and_run_call():
@@ -50,6 +58,12 @@ def test_can_parse_keygen_all():
     assert res.kwargs == {"cfg": read_config("example/simple.json")}
 
 
+def test_can_parse_keygen_missing():
+    res = _parse_argv(["keygen", "--path=example/simple.json", "--missing"])
+    assert res.target == privateer2.cli.keygen_missing
+    assert res.kwargs == {"cfg": read_config("example/simple.json")}
+
+
 def test_can_parse_keygen_one():
     res = _parse_argv(["keygen", "--path=example/simple.json", "alice"])
     assert res.target == privateer2.cli.keygen
@@ -157,6 +171,19 @@ def test_can_parse_server_stop(tmp_path):
     }
 
 
+def test_can_parse_server_reload(tmp_path):
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    with open(tmp_path / ".privateer_identity", "w") as f:
+        f.write("alice\n")
+    with transient_working_directory(tmp_path):
+        res = _parse_argv(["server", "reload"])
+    assert res.target == privateer2.cli.server_reload
+    assert res.kwargs == {
+        "cfg": read_config("example/simple.json"),
+        "name": "alice",
+    }
+
+
 def test_can_parse_backup(tmp_path):
     shutil.copy("example/simple.json", tmp_path / "privateer.json")
     with open(tmp_path / ".privateer_identity", "w") as f:
@@ -170,6 +197,7 @@ def test_can_parse_backup(tmp_path):
         "volume": "v",
         "server": None,
         "dry_run": False,
+        "progress": False,
     }
 
 
@@ -178,7 +206,7 @@ def test_can_parse_backup_with_server(tmp_path):
     with open(tmp_path / ".privateer_identity", "w") as f:
         f.write("alice\n")
     with transient_working_directory(tmp_path):
-        res = _parse_argv(["backup", "v", "--server", "alice"])
+        res = _parse_argv(["backup", "v", "--server", "alice", "--progress"])
     assert res.target == privateer2.cli.backup
     assert res.kwargs == {
         "cfg": read_config("example/simple.json"),
@@ -186,6 +214,7 @@ def test_can_parse_backup_with_server(tmp_path):
         "volume": "v",
         "server": "alice",
         "dry_run": False,
+        "progress": True,
     }
 
 
@@ -203,6 +232,7 @@ def test_can_parse_restore(tmp_path):
         "server": None,
         "source": None,
         "dry_run": False,
+        "progress": False,
     }
 
 
@@ -220,6 +250,7 @@ def test_can_parse_complex_restore(tmp_path):
         "server": "alice",
         "source": "bob",
         "dry_run": False,
+        "progress": False,
     }
 
 
@@ -306,18 +337,16 @@ def test_call_main(monkeypatch):
     assert mock_call.return_value.run.call_args == call()
 
 
-def test_run_pull(monkeypatch):
+def test_run_pull():
     cfg = read_config("example/simple.json")
     image_client = f"mrcide/privateer-client:{cfg.tag}"
     image_server = f"mrcide/privateer-server:{cfg.tag}"
-    mock_docker = MagicMock()
-    monkeypatch.setattr(privateer2.cli, "docker", mock_docker)
-    pull(cfg)
-    assert mock_docker.from_env.call_count == 1
-    client = mock_docker.from_env.return_value
+    client = MagicMock()
+    with transient_docker_client(client):
+        pull(cfg)
     assert client.images.pull.call_count == 2
-    assert client.images.pull.call_args_list[0] == call(image_client)
-    assert client.images.pull.call_args_list[1] == call(image_server)
+    assert call(image_client) in client.images.pull.call_args_list
+    assert call(image_server) in client.images.pull.call_args_list
 
 
 def test_clean_path(tmp_path):
@@ -375,3 +404,211 @@ def test_can_parse_schedule_stop(tmp_path):
         "cfg": read_config("example/schedule.json"),
         "name": "bob",
     }
+
+
+def test_can_parse_schedule_plan():
+    cfg = read_config("example/schedule.json")
+    res = _parse_argv(["schedule", "plan", "--path=example/schedule.json"])
+    assert res.target == privateer2.cli.schedule_plan
+    assert res.kwargs == {
+        "cfg": cfg,
+        "path": "example/schedule.json",
+        "window": 60,
+        "duration": 15,
+        "apply": False,
+    }
+    res = _parse_argv(
+        [
+            "schedule",
+            "plan",
+            "--path=example/schedule.json",
+            "--window=30",
+            "--duration=5",
+            "--apply",
+        ]
+    )
+    assert res.kwargs["window"] == 30
+    assert res.kwargs["duration"] == 5
+    assert res.kwargs["apply"]
+    with pytest.raises(
+        Exception, match="Don't use '--as' with 'schedule plan'"
+    ):
+        _parse_argv(
+            ["schedule", "plan", "--path=example/schedule.json", "--as=bob"]
+        )
+
+
+def test_can_parse_profile():
+    res = _parse_argv(["pull", "--path=example/simple.json", "--profile"])
+    assert res.target == privateer2.cli._run_profiled
+    assert res.kwargs == {
+        "call": Call(pull, cfg=read_config("example/simple.json")),
+        "show": True,
+        "path": None,
+    }
+    res = _parse_argv(
+        ["pull", "--path=example/simple.json", "--profile-json=out.json"]
+    )
+    assert res.kwargs == {
+        "call": Call(pull, cfg=read_config("example/simple.json")),
+        "show": False,
+        "path": "out.json",
+    }
+
+
+def test_can_run_profiled_call(capsys, tmp_path):
+    path = tmp_path / "profile.json"
+    _run_profiled(Call(_show_version), show=True, path=str(path))
+    out = capsys.readouterr().out
+    assert out.startswith("privateer ")
+    assert "Total time: " in out
+    assert path.exists()
+
+
+def test_can_parse_check_benchmark(tmp_path):
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    with open(tmp_path / ".privateer_identity", "w") as f:
+        f.write("bob\n")
+    with transient_working_directory(tmp_path):
+        res = _parse_argv(["check", "--benchmark"])
+    assert res.target == privateer2.cli.benchmark_servers
+    assert res.kwargs == {
+        "cfg": read_config("example/simple.json"),
+        "name": "bob",
+        "root": "",
+    }
+
+
+def test_can_parse_automatic_server(tmp_path):
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    with open(tmp_path / ".privateer_identity", "w") as f:
+        f.write("bob\n")
+    with transient_working_directory(tmp_path):
+        with pytest.raises(Exception, match="No recent benchmark for 'bob'"):
+            _parse_argv(["backup", "data", "--server=auto"])
+        result = {
+            "alice": {
+                "status": "ok",
+                "handshake": 0.1,
+                "rtt": 0.1,
+                "throughput": 1,
+            }
+        }
+        write_benchmark("", "bob", result)
+        res = _parse_argv(["backup", "data", "--server=auto"])
+        assert res.kwargs["server"] == "alice"
+        res = _parse_argv(["restore", "data", "--server=auto"])
+        assert res.kwargs["server"] == "alice"
+
+
+def test_can_parse_check_watch(tmp_path):
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    with open(tmp_path / ".privateer_identity", "w") as f:
+        f.write("bob\n")
+    with transient_working_directory(tmp_path):
+        res = _parse_argv(["check", "--watch"])
+        res_interval = _parse_argv(
+            ["check", "--watch", "--interval=5", "--freshness-interval=60"]
+        )
+    assert res.target == privateer2.cli.watch
+    assert res.kwargs == {
+        "cfg": read_config("example/simple.json"),
+        "name": "bob",
+        "interval": 60,
+        "freshness_interval": 3600,
+        "port": 9100,
+    }
+    assert res_interval.kwargs["interval"] == 5
+    assert res_interval.kwargs["freshness_interval"] == 60
+
+
+def test_can_parse_configure_check():
+    res = _parse_argv(
+        ["configure", "--path=example/simple.json", "alice", "--check"]
+    )
+    assert res.target == privateer2.cli.configure
+    assert res.kwargs == {
+        "cfg": read_config("example/simple.json"),
+        "name": "alice",
+        "check": True,
+    }
+
+
+def test_can_parse_configure_many():
+    cfg = read_config("example/simple.json")
+    res = _parse_argv(["configure", "--path=example/simple.json", "a", "b"])
+    assert res.target == privateer2.cli.configure_many
+    assert res.kwargs == {"cfg": cfg, "names": ["a", "b"], "check": False}
+    res = _parse_argv(
+        ["configure", "--path=example/simple.json", "--all-local", "--check"]
+    )
+    assert res.target == privateer2.cli.configure_many
+    assert res.kwargs == {"cfg": cfg, "names": None, "check": True}
+
+
+# Parse a command line in a fresh interpreter (so that we see what it
+# loads, rather than whatever the test suite has loaded already), then
+# import the module that would run it (named by the first argument, if
+# given), as that is where nearly all the cost is.
+_STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+n0 = len(sys.modules)
+import privateer2.cli
+privateer2.cli._parse_argv(sys.argv[2:])
+if sys.argv[1]:
+    privateer2.cli._command(sys.argv[1])
+print(json.dumps({
+    "time": time.perf_counter() - t0,
+    "modules": len(sys.modules) - n0,
+    "loaded": [x for x in sys.modules if "." not in x],
+}))
+"""
+
+
+def _startup(tmp_path, command, args):
+    shutil.copy("example/simple.json", tmp_path / "privateer.json")
+    with open(tmp_path / ".privateer_identity", "w") as f:
+        f.write("alice\n")
+    res = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", _STARTUP_SCRIPT, command, *args],
+        cwd=tmp_path,
+        capture_output=True,
+        check=True,
+    )
+    return json.loads(res.stdout)
+
+
+@pytest.mark.parametrize(
+    ("args", "command", "absent"),
+    [
+        (
+            ["server", "status"],
+            "server_status",
+            ["hvac", "cryptography", "yacron"],
+        ),
+        (
+            ["schedule", "status"],
+            "schedule_status",
+            ["hvac", "cryptography", "yacron"],
+        ),
+        (["check"], "check", ["hvac", "cryptography", "yacron"]),
+        (["backup", "data"], "backup", ["hvac", "cryptography", "yacron"]),
+        (["keygen", "--all"], "keygen_all", ["docker", "yacron"]),
+    ],
+)
+def test_commands_only_import_what_they_need(tmp_path, args, command, absent):
+    res = _startup(tmp_path, command, args)
+    assert not set(absent).intersection(res["loaded"])
+    assert res["modules"] < 500
+
+
+# Timings vary too much between machines to use a fixed limit, so we
+# compare against a command that has to load docker and pydantic.
+def test_version_starts_quickly(tmp_path):
+    res = _startup(tmp_path, "", ["--version"])
+    heavy = ["docker", "hvac", "cryptography", "yacron", "pydantic"]
+    assert not set(heavy).intersection(res["loaded"])
+    assert res["modules"] < 50
+    ref = _startup(tmp_path, "server_status", ["server", "status"])
+    assert res["time"] < ref["time"] / 2
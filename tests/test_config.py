@@ -1,7 +1,10 @@
+import json
+import time
+
 import pytest
 import vault_dev
 
-from privateer2.config import _check_config, find_source, read_config
+from privateer2.config import Config, _check_config, find_source, read_config
 
 
 def test_can_read_config():
@@ -34,8 +37,7 @@ def test_can_create_vault_client():
 def test_validation_is_run_on_load(tmp_path):
     path = tmp_path / "privateer.json"
     with path.open("w") as f:
-        f.write(
-            """{
+        f.write("""{
     "servers": [
         {
             "name": "alice",
@@ -62,8 +64,7 @@ def test_validation_is_run_on_load(tmp_path):
         "url": "http://localhost:8200",
         "prefix": "/secret/privateer"
     }
-}"""
-        )
+}""")
     msg = "Invalid machine listed as both a client and a server: 'alice'"
     with pytest.raises(Exception, match=msg):
         read_config(path)
@@ -110,6 +111,7 @@ def test_can_find_appropriate_source():
     tmp = cfg.clients[0].model_copy()
     tmp.name = "carol"
     cfg.clients.append(tmp)
+    cfg.reindex()
     assert find_source(cfg, "data", "bob") == "bob"
     assert find_source(cfg, "data", "carol") == "carol"
     msg = "Invalid source 'alice': valid options: 'bob', 'carol'"
@@ -173,3 +175,179 @@ def test_can_validate_schedule_backs_up_correct_volume():
     )
     with pytest.raises(Exception, match=msg):
         _check_config(cfg)
+
+
+def test_can_pin_images_by_digest():
+    cfg = read_config("example/simple.json")
+    assert cfg.image("client") == "mrcide/privateer-client:latest"
+    assert cfg.image("server") == "mrcide/privateer-server:latest"
+    digest = f"sha256:{'a' * 64}"
+    cfg.digests = {"server": digest}
+    _check_config(cfg)
+    assert cfg.image("client") == "mrcide/privateer-client:latest"
+    assert cfg.image("server") == f"mrcide/privateer-server@{digest}"
+
+
+def test_can_validate_digests():
+    cfg = read_config("example/simple.json")
+    cfg.digests = {"other": f"sha256:{'a' * 64}"}
+    msg = "Invalid image 'other' in digests: use 'client' or 'server'"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.digests = {"client": "latest"}
+    msg = "Invalid digest for 'client': must start with 'sha256:'"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
+def test_key_type_can_be_set_per_machine():
+    cfg = read_config("example/simple.json")
+    assert cfg.machine_key_type("alice") == "rsa"
+    cfg.key_type = "ed25519"
+    assert cfg.machine_key_type("alice") == "ed25519"
+    cfg.clients[0].key_type = "rsa"
+    _check_config(cfg)
+    assert cfg.machine_key_type("alice") == "ed25519"
+    assert cfg.machine_key_type("bob") == "rsa"
+
+
+def test_can_validate_key_type():
+    cfg = read_config("example/simple.json")
+    cfg.key_type = "dsa"
+    msg = "Invalid key_type 'dsa' for the configuration: use one of 'rsa'"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.key_type = "rsa"
+    cfg.servers[0].key_type = "ecdsa"
+    msg = "Invalid key_type 'ecdsa' for 'alice'"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+
+
+def test_lookups_follow_edits_to_configuration_once_reindexed():
+    cfg = read_config("example/simple.json")
+    assert cfg.machine_config("bob").name == "bob"
+    cfg.clients[0].name = "carol"
+    cfg.reindex()
+    assert cfg.is_client("carol")
+    assert not cfg.is_client("bob")
+    tmp = cfg.servers[0].model_copy()
+    tmp.name = "dave"
+    cfg.servers.append(tmp)
+    cfg.reindex()
+    assert cfg.machine_config("dave") is tmp
+    assert cfg.is_server("dave")
+    cfg.volumes[0].name = "other"
+    cfg.reindex()
+    with pytest.raises(Exception, match="Unknown volume 'data'"):
+        find_source(cfg, "data", None)
+
+
+def test_sources_follow_edits_to_backups_once_reindexed():
+    cfg = read_config("example/simple.json")
+    tmp = cfg.clients[0].model_copy(update={"name": "carol", "backup": []})
+    cfg.clients.append(tmp)
+    cfg.reindex()
+    assert find_source(cfg, "data", None) == "bob"
+    cfg.clients[1].backup.append("data")
+    cfg.reindex()
+    msg = "Please provide a value for source"
+    with pytest.raises(Exception, match=msg):
+        find_source(cfg, "data", None)
+
+
+def test_indexed_configurations_compare_by_value():
+    a = read_config("example/simple.json")
+    b = read_config("example/simple.json")
+    assert a == b
+    b.clients[0].backup = []
+    b.reindex()
+    assert a != b
+
+
+def _synthetic_config(n_servers, n_clients):
+    volumes = [{"name": f"data{i}"} for i in range(n_clients)]
+    servers = [
+        {
+            "name": f"server{i}",
+            "hostname": f"server{i}.example.com",
+            "port": 10022,
+            "key_volume": f"server{i}_keys",
+            "data_volume": f"server{i}_data",
+            "container": f"server{i}",
+        }
+        for i in range(n_servers)
+    ]
+    clients = [
+        {
+            "name": f"client{i}",
+            "backup": [f"data{i}"],
+            "schedule": {
+                "jobs": [
+                    {
+                        "server": f"server{i % n_servers}",
+                        "volume": f"data{i}",
+                        "schedule": "@daily",
+                    }
+                ]
+            },
+        }
+        for i in range(n_clients)
+    ]
+    return {
+        "servers": servers,
+        "clients": clients,
+        "volumes": volumes,
+        "vault": {"url": "http://localhost:8200", "prefix": "/privateer"},
+    }
+
+
+# A fleet of 10k machines and as many volumes: with linear scans this
+# takes tens of seconds, with the index around one.
+def test_config_lookups_scale_to_large_fleets():
+    data = _synthetic_config(100, 9900)
+    t0 = time.perf_counter()
+    cfg = Config(**data)
+    for m in cfg.servers + cfg.clients:
+        assert cfg.machine_config(m.name) is m
+    for v in cfg.volumes:
+        assert find_source(cfg, v.name, None) == f"client{v.name[4:]}"
+    assert sum(cfg.is_server(x.name) for x in cfg.servers + cfg.clients) == 100
+    elapsed = time.perf_counter() - t0
+    assert elapsed < 5
+
+
+def test_reading_config_matches_building_it(tmp_path):
+    data = _synthetic_config(2, 5)
+    path = tmp_path / "privateer.json"
+    with open(path, "w") as f:
+        json.dump(data, f)
+    cfg = read_config(path)
+    assert cfg == Config(**data)
+    assert cfg.machine_config("client3").backup == ["data3"]
+
+
+def test_can_validate_schedule_limits():
+    cfg = read_config("example/schedule.json")
+    cfg.clients[0].schedule.volume_policy = "queue"
+    msg = (
+        "Invalid volume_policy 'queue' for client 'bob': "
+        "use one of 'forbid', 'replace', 'allow'"
+    )
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.clients[0].schedule.volume_policy = "forbid"
+    cfg.clients[0].schedule.jobs[0].concurrency_policy = "Forbid"
+    msg = "Invalid concurrency_policy 'Forbid' for client 'bob'"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.clients[0].schedule.jobs[0].concurrency_policy = None
+    cfg.clients[0].schedule.max_concurrent = 0
+    msg = "Invalid max_concurrent '0' for client 'bob': must be positive"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
+    cfg.clients[0].schedule.max_concurrent = 1
+    cfg.clients[0].schedule.jobs[1].timeout = -1
+    msg = "Invalid timeout '-1' for client 'bob': must be positive"
+    with pytest.raises(Exception, match=msg):
+        _check_config(cfg)
@@ -1,12 +1,33 @@
+import io
+import tarfile
+from unittest.mock import MagicMock, call
+
 import pytest
 import vault_dev
 
 import docker
+import privateer2.configure
 from privateer2.check import check
 from privateer2.config import read_config
-from privateer2.configure import configure
-from privateer2.keys import keygen_all
-from privateer2.util import string_from_volume
+from privateer2.configure import (
+    _create_key_volume,
+    configure,
+    configure_many,
+    files_fingerprint,
+    key_volume_files,
+    local_machines,
+)
+from privateer2.keys import (
+    _create_keypair,
+    key_fingerprint,
+    keygen_all,
+    keys_data,
+)
+from privateer2.util import (
+    string_from_volume,
+    tar_files,
+    transient_docker_client,
+)
 from privateer2.yacron import generate_yacron_yaml
 
 
@@ -32,8 +53,19 @@ def test_can_unpack_keys_for_server(managed_docker):
             "id_rsa",
             "id_rsa.pub",
             "name",
+            "fingerprint",
         }
         assert string_from_volume(vol, "name") == "alice"
+        assert client.volumes.get(vol).attrs["Labels"] == {
+            "privateer.name": "alice"
+        }
+        keys = keys_data(cfg, "alice")
+        files = key_volume_files(cfg, "alice", keys)
+        del files["fingerprint"], files["name"]
+        assert string_from_volume(vol, "fingerprint") == (
+            f"config {files_fingerprint(files)}\n"
+            f"key {key_fingerprint(keys['public'])}\n"
+        )
 
 
 def test_can_unpack_keys_for_client(managed_docker):
@@ -59,8 +91,15 @@ def test_can_unpack_keys_for_client(managed_docker):
             "id_rsa.pub",
             "name",
             "config",
+            "fingerprint",
         }
         assert string_from_volume(vol, "name") == "bob"
+        assert client.volumes.get(vol).attrs["Labels"] == {
+            "privateer.name": "bob"
+        }
+        public = keys_data(cfg, "bob")["public"]
+        fingerprint = string_from_volume(vol, "fingerprint")
+        assert fingerprint.endswith(f"key {key_fingerprint(public)}\n")
         assert check(cfg, "bob").key_volume == vol
         msg = "Configuration is for 'bob', not 'alice'"
         cfg.servers[0].key_volume = vol
@@ -92,7 +131,275 @@ def test_can_write_schedule_for_client(managed_docker):
             "name",
             "config",
             "yacron.yml",
+            "fingerprint",
         }
         schedule = string_from_volume(vol, "yacron.yml")
         expected = generate_yacron_yaml(cfg, "bob")
         assert schedule == "".join([x + "\n" for x in expected])
+
+
+def test_can_create_labelled_key_volume():
+    cl = MagicMock()
+    cl.volumes.get.side_effect = docker.errors.NotFound("not found")
+    _create_key_volume(cl, "vol", "alice")
+    assert cl.volumes.create.call_args == call(
+        "vol", labels={"privateer.name": "alice"}
+    )
+
+
+def test_never_recreate_existing_key_volume():
+    cl = MagicMock()
+    volume = cl.volumes.get.return_value
+    for labels in [{"privateer.name": "alice"}, None]:
+        volume.attrs = {"Labels": labels}
+        _create_key_volume(cl, "vol", "alice")
+    assert volume.remove.call_count == 0
+    assert cl.volumes.create.call_count == 0
+
+
+def test_refuse_to_configure_volume_of_another_machine():
+    cl = MagicMock()
+    volume = cl.volumes.get.return_value
+    volume.attrs = {"Labels": {"privateer.name": "bob"}}
+    msg = (
+        "Volume 'vol' belongs to 'bob', can't configure it as 'alice'.+"
+        "remove it with 'docker volume rm vol' and configure 'alice' again"
+    )
+    with pytest.raises(Exception, match=msg):
+        _create_key_volume(cl, "vol", "alice")
+    assert volume.remove.call_count == 0
+    assert cl.volumes.create.call_count == 0
+
+
+def _mock_key_volume(monkeypatch, cfg, name, existing, labels=None):
+    keys = {
+        "name": name,
+        **_create_keypair(),
+        "authorized_keys": None,
+        "known_hosts": "[alice.example.com]:10022 ssh-rsa AAAA\n",
+        "config": "Host alice\n",
+    }
+    monkeypatch.setattr(
+        privateer2.configure, "keys_data", lambda *_, **__: keys
+    )
+    files = key_volume_files(cfg, name, keys)
+    if labels is None:
+        labels = {"privateer.name": name}
+    client = MagicMock()
+    client.volumes.get.return_value.attrs = {"Labels": labels}
+    # get_archive returns the directory itself, named as mounted
+    container = client.containers.create.return_value
+    container.get_archive.side_effect = lambda path: (
+        [tar_files({f"{path[1:]}/{k}": files[k] for k in existing})],
+        {},
+    )
+    return client, files
+
+
+def _written(container):
+    assert container.put_archive.call_count == 1
+    data = container.put_archive.call_args[0][1]
+    with tarfile.open(fileobj=io.BytesIO(data)) as t:
+        return [x.name for x in t.getmembers()]
+
+
+def test_reconfigure_only_writes_changed_files(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    client, _ = _mock_key_volume(
+        monkeypatch,
+        cfg,
+        "bob",
+        ["id_rsa", "id_rsa.pub", "config", "fingerprint", "name"],
+    )
+    with transient_docker_client(client):
+        assert configure(cfg, "bob") == ["known_hosts"]
+    container = client.containers.create.return_value
+    assert client.containers.create.call_count == 1
+    assert _written(container) == ["known_hosts"]
+    assert client.volumes.create.call_count == 0
+    assert capsys.readouterr().out == (
+        "Copying keypair for 'bob' to volume 'privateer_keys'\n"
+        "  updated 'known_hosts'\n"
+    )
+
+
+def test_unrelated_config_changes_leave_volume_alone(monkeypatch):
+    cfg = read_config("example/simple.json")
+    existing = [
+        "id_rsa",
+        "id_rsa.pub",
+        "known_hosts",
+        "config",
+        "fingerprint",
+        "name",
+    ]
+    client, _ = _mock_key_volume(monkeypatch, cfg, "bob", existing)
+    tmp = cfg.clients[0].model_copy()
+    tmp.name = "carol"
+    cfg.clients.append(tmp)
+    cfg.reindex()
+    with transient_docker_client(client):
+        assert configure(cfg, "bob") == []
+    assert client.volumes.get.return_value.remove.call_count == 0
+    assert client.volumes.create.call_count == 0
+
+
+def test_reconfigure_without_changes_writes_nothing(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    existing = [
+        "id_rsa",
+        "id_rsa.pub",
+        "known_hosts",
+        "config",
+        "fingerprint",
+        "name",
+    ]
+    client, _ = _mock_key_volume(monkeypatch, cfg, "bob", existing)
+    with transient_docker_client(client):
+        assert configure(cfg, "bob") == []
+    container = client.containers.create.return_value
+    assert container.put_archive.call_count == 0
+    assert container.remove.call_count == 1
+    out = capsys.readouterr().out
+    assert out.endswith("  all files already up to date\n")
+
+
+def test_reconfigure_removes_keys_of_another_type(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    existing = [
+        "id_rsa",
+        "id_rsa.pub",
+        "known_hosts",
+        "config",
+        "fingerprint",
+        "name",
+    ]
+    client, files = _mock_key_volume(monkeypatch, cfg, "bob", existing)
+    container = client.containers.create.return_value
+    current = {k: files[k] for k in existing}
+    current["id_ed25519"] = ("old", 0o600, 0, 0)
+    current["id_ed25519.pub"] = ("old", 0o644, 0, 0)
+    container.get_archive.side_effect = lambda path: (
+        [tar_files({f"{path[1:]}/{k}": v for k, v in current.items()})],
+        {},
+    )
+    with transient_docker_client(client):
+        with pytest.raises(Exception, match="has drifted"):
+            configure(cfg, "bob", check=True)
+        assert "  id_ed25519 (old key type)\n" in capsys.readouterr().out
+        assert configure(cfg, "bob") == ["id_ed25519", "id_ed25519.pub"]
+    assert container.put_archive.call_count == 0
+    assert client.containers.run.call_count == 1
+    assert client.containers.run.call_args.kwargs["command"] == [
+        "rm",
+        "-f",
+        "/dest/id_ed25519",
+        "/dest/id_ed25519.pub",
+    ]
+    assert capsys.readouterr().out.endswith(
+        "  removed 'id_ed25519'\n  removed 'id_ed25519.pub'\n"
+    )
+
+
+def test_can_check_for_drift(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    existing = [
+        "id_rsa",
+        "id_rsa.pub",
+        "known_hosts",
+        "config",
+        "fingerprint",
+        "name",
+    ]
+    client, _ = _mock_key_volume(monkeypatch, cfg, "bob", existing)
+    with transient_docker_client(client):
+        assert configure(cfg, "bob", check=True) == []
+    assert capsys.readouterr().out == (
+        "Volume 'privateer_keys' for 'bob' is up to date\n"
+    )
+
+    client, _ = _mock_key_volume(
+        monkeypatch,
+        cfg,
+        "bob",
+        ["id_rsa", "id_rsa.pub", "name"],
+        labels={"privateer.name": "alice"},
+    )
+    with transient_docker_client(client):
+        msg = "Configuration of 'bob' has drifted"
+        with pytest.raises(Exception, match=msg):
+            configure(cfg, "bob", check=True)
+    assert client.containers.create.return_value.put_archive.call_count == 0
+    assert client.volumes.create.call_count == 0
+    assert capsys.readouterr().out == (
+        "Volume 'privateer_keys' for 'bob' differs from configuration:\n"
+        "  known_hosts\n"
+        "  config\n"
+        "  fingerprint\n"
+        "  (name label)\n"
+    )
+
+
+def _two_machine_config():
+    cfg = read_config("example/simple.json")
+    cfg.clients[0].key_volume = "privateer_keys_bob"
+    return cfg
+
+
+def test_configure_many_reads_keys_once_then_writes_in_parallel(monkeypatch):
+    cfg = _two_machine_config()
+    mock_keys_data = MagicMock(side_effect=lambda _, name, **__: {"name": name})
+    mock_configure = MagicMock()
+    monkeypatch.setattr(privateer2.configure, "keys_data", mock_keys_data)
+    monkeypatch.setattr(privateer2.configure, "_configure", mock_configure)
+    configure_many(cfg, ["alice", "bob"])
+    assert mock_keys_data.call_args_list == [
+        call(cfg, "alice", verify=False),
+        call(cfg, "bob", verify=False),
+    ]
+    assert mock_configure.call_count == 2
+    assert call(cfg, "bob", {"name": "bob"}, check=False) in (
+        mock_configure.call_args_list
+    )
+
+
+def test_configure_many_collects_failures(monkeypatch, capsys):
+    cfg = _two_machine_config()
+
+    def fake_configure(cfg, name, keys, *, check):  # noqa: ARG001
+        if name == "alice":
+            msg = "Configuration of 'alice' has drifted"
+            raise Exception(msg)
+
+    monkeypatch.setattr(privateer2.configure, "keys_data", MagicMock())
+    monkeypatch.setattr(privateer2.configure, "_configure", fake_configure)
+    with pytest.raises(Exception, match="Failed to configure 'alice'"):
+        configure_many(cfg, ["alice", "bob"], check=True)
+    assert capsys.readouterr().out == (
+        "Failed to configure 'alice': Configuration of 'alice' has drifted\n"
+    )
+
+
+def test_configure_many_requires_separate_volumes():
+    cfg = read_config("example/simple.json")
+    msg = "Machines 'alice' and 'bob' share key volume 'privateer_keys'"
+    with pytest.raises(Exception, match=msg):
+        configure_many(cfg, ["alice", "bob"])
+
+
+def test_can_find_machines_configured_locally():
+    cfg = _two_machine_config()
+    client = MagicMock()
+    volume = MagicMock()
+    volume.attrs = {"Labels": {"privateer.name": "bob"}}
+    client.volumes.get.side_effect = lambda name: {
+        "privateer_keys": volume,
+        "privateer_keys_bob": volume,
+    }[name]
+    with transient_docker_client(client):
+        assert local_machines(cfg) == ["bob"]
+    client.volumes.get.side_effect = docker.errors.NotFound("missing")
+    with transient_docker_client(client):
+        assert local_machines(cfg) == []
+        with pytest.raises(Exception, match="No configured machines found"):
+            configure_many(cfg)
@@ -1,7 +1,25 @@
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, call
+
+import pytest
 import vault_dev
 
+import privateer2.keys
 from privateer2.config import read_config
-from privateer2.keys import keygen, keygen_all, keys_data
+from privateer2.keys import (
+    _create_keypair,
+    _get_pubkeys,
+    _update_pubkeys,
+    key_filename,
+    key_fingerprint,
+    keygen,
+    keygen_all,
+    keygen_missing,
+    keys_data,
+)
+from privateer2.store import MemoryStore
 
 
 def test_can_create_keys():
@@ -15,6 +33,27 @@ def test_can_create_keys():
         assert set(pair.keys()) == {"private", "public"}
         assert pair["public"].startswith("ssh-rsa")
         assert "PRIVATE KEY" in pair["private"]
+        response = client.secrets.kv.v1.read_secret("/privateer/_public")
+        assert response["data"] == {"alice": pair["public"]}
+
+
+def test_can_create_only_missing_keys():
+    with vault_dev.Server(export_token=True) as server:
+        cfg = read_config("example/simple.json")
+        cfg.vault.url = server.url()
+        keygen(cfg, "alice")
+        client = cfg.vault.client()
+        prev = client.secrets.kv.v1.read_secret("/privateer/alice")["data"]
+        keygen_missing(cfg)
+        alice = client.secrets.kv.v1.read_secret("/privateer/alice")["data"]
+        assert alice == prev
+        bob = client.secrets.kv.v1.read_secret("/privateer/bob")["data"]
+        assert bob["public"].startswith("ssh-rsa")
+        response = client.secrets.kv.v1.read_secret("/privateer/_public")
+        assert response["data"] == {
+            "alice": alice["public"],
+            "bob": bob["public"],
+        }
 
 
 def test_can_generate_server_keys_data():
@@ -39,3 +78,187 @@ def test_can_generate_client_keys_data():
         assert dat["known_hosts"].startswith(
             "[alice.example.com]:10022 ssh-rsa"
         )
+
+
+@pytest.mark.parametrize("key_type", ["rsa", "ed25519"])
+def test_key_fingerprint_matches_ssh_keygen(tmp_path, key_type):
+    public = _create_keypair(key_type)["public"]
+    path = tmp_path / "key.pub"
+    path.write_text(public)
+    res = subprocess.run(  # noqa: S603
+        ["ssh-keygen", "-l", "-f", str(path)],  # noqa: S607
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert res.stdout.split()[1] == key_fingerprint(public)
+
+
+def test_can_create_ed25519_keypair(tmp_path):
+    pair = _create_keypair("ed25519")
+    assert pair["public"].startswith("ssh-ed25519 ")
+    assert key_filename(pair["public"]) == "id_ed25519"
+    assert key_filename(_create_keypair("rsa")["public"]) == "id_rsa"
+    # check that openssh can read the private key we wrote
+    path = tmp_path / "id_ed25519"
+    path.write_text(pair["private"])
+    path.chmod(0o600)
+    res = subprocess.run(  # noqa: S603
+        ["ssh-keygen", "-y", "-f", str(path)],  # noqa: S607
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert res.stdout.split()[:2] == pair["public"].split()[:2]
+
+
+def _mock_store(monkeypatch, secrets):
+    store = MagicMock(wraps=MemoryStore(secrets))
+    monkeypatch.setattr(privateer2.keys, "open_store", lambda _: store)
+    monkeypatch.setattr(privateer2.keys, "_PUBKEYS", {})
+    return store
+
+
+def test_read_public_keys_in_one_request(monkeypatch):
+    cfg = read_config("example/simple.json")
+    store = _mock_store(monkeypatch, {"_public": {"alice": "a", "bob": "b"}})
+    assert _get_pubkeys(cfg, store, ["alice", "bob"]) == {
+        "alice": "a",
+        "bob": "b",
+    }
+    assert _get_pubkeys(cfg, store, ["bob"]) == {"bob": "b"}
+    assert store.read.call_args_list == [call("_public")]
+
+
+def test_read_legacy_public_keys_individually(monkeypatch):
+    cfg = read_config("example/simple.json")
+    secrets = {"_public": {"alice": "a"}, "bob": {"public": "b"}}
+    store = _mock_store(monkeypatch, secrets)
+    assert _get_pubkeys(cfg, store, ["alice", "bob"]) == {
+        "alice": "a",
+        "bob": "b",
+    }
+    assert store.read.call_args_list == [call("_public"), call("bob")]
+    with pytest.raises(Exception, match="No keys found for 'carol'"):
+        _get_pubkeys(cfg, store, ["carol"])
+
+
+def test_can_cache_public_keys_on_disk(monkeypatch, tmp_path):
+    monkeypatch.setattr(privateer2.keys, "PUBKEYS_CACHE_DIR", str(tmp_path))
+    cfg = read_config("example/simple.json")
+    cfg.vault.pubkey_cache_ttl = 60
+    store = _mock_store(monkeypatch, {"_public": {"alice": "a"}})
+    assert _get_pubkeys(cfg, store, ["alice"]) == {"alice": "a"}
+    assert len(list(tmp_path.iterdir())) == 1
+
+    store = _mock_store(monkeypatch, {})
+    assert _get_pubkeys(cfg, store, ["alice"]) == {"alice": "a"}
+    assert store.read.call_count == 0
+
+    cfg.vault.pubkey_cache_ttl = 0
+    store = _mock_store(monkeypatch, {"_public": {"alice": "new"}})
+    assert _get_pubkeys(cfg, store, ["alice"]) == {"alice": "new"}
+
+
+def test_can_get_keys_data_from_store(monkeypatch):
+    cfg = read_config("example/simple.json")
+    _mock_store(monkeypatch, {})
+    cfg.clients[0].key_type = "ed25519"
+    keygen_all(cfg)
+    dat = keys_data(cfg, "bob")
+    assert dat["public"].startswith("ssh-ed25519")
+    assert dat["known_hosts"].startswith("[alice.example.com]:10022 ssh-rsa")
+    dat = keys_data(cfg, "alice")
+    assert dat["authorized_keys"].startswith("ssh-ed25519")
+
+
+def test_keygen_all_writes_keys_concurrently(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    store = _mock_store(monkeypatch, {})
+    cfg.clients[0].key_type = "ed25519"
+    keygen_all(cfg)
+    assert store.write.call_count == 3
+    names = [x.args[0] for x in store.write.call_args_list]
+    assert set(names[:2]) == {"alice", "bob"}
+    assert names[2] == "_public"
+    public = store.read("_public")
+    assert set(public.keys()) == {"alice", "bob"}
+    assert public["alice"].startswith("ssh-rsa ")
+    assert public["bob"].startswith("ssh-ed25519 ")
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[0].startswith("Wrote keypair for alice (keygen ")
+    assert lines[1].startswith("Wrote keypair for bob (keygen ")
+
+
+def test_keys_data_refuses_stale_public_keys(monkeypatch):
+    cfg = read_config("example/simple.json")
+    store = _mock_store(monkeypatch, {})
+    keygen_all(cfg)
+    public = store.read("_public")
+    store.write("_public", {**public, "bob": "ssh-rsa old"})
+    monkeypatch.setattr(privateer2.keys, "_PUBKEYS", {})
+    msg = "Public keys for 'bob' in '_public' do not match their own secrets"
+    with pytest.raises(Exception, match=msg):
+        keys_data(cfg, "bob")
+    # alice's own key is fine, and only a verifying read finds out
+    # that the key she would authorise for bob is stale:
+    assert keys_data(cfg, "alice")["authorized_keys"] == "ssh-rsa old\n"
+    with pytest.raises(Exception, match=msg):
+        keys_data(cfg, "alice", verify=True)
+
+
+def test_concurrent_updates_to_public_keys_are_not_lost(monkeypatch):
+    cfg = read_config("example/simple.json")
+    store = _mock_store(monkeypatch, {})
+    memory = MemoryStore()
+
+    def read(name):
+        ret = memory.read(name)
+        time.sleep(0.01)
+        return ret
+
+    store.read.side_effect = read
+    store.write.side_effect = memory.write
+    names = [f"machine{i}" for i in range(8)]
+    with ThreadPoolExecutor() as pool:
+        for nm in names:
+            pool.submit(_update_pubkeys, cfg, store, {nm: nm})
+    assert set(memory.read("_public").keys()) == set(names)
+
+
+def test_keygen_all_collects_failures(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    store = _mock_store(monkeypatch, {})
+    memory = MemoryStore()
+
+    def write(name, data):
+        if name == "alice":
+            msg = "permission denied"
+            raise Exception(msg)
+        memory.write(name, data)
+
+    store.write.side_effect = write
+    with pytest.raises(
+        Exception, match="Failed to create keypairs for 'alice'"
+    ):
+        keygen_all(cfg)
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines[0] == "Failed to create keypair for alice: permission denied"
+    assert lines[1].startswith("Wrote keypair for bob")
+    assert set(memory.list()) == {"bob", "_public"}
+    assert set(memory.read("_public").keys()) == {"bob"}
+
+
+def test_keygen_missing_lists_secrets_once(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    secrets = {"alice": {"public": "a"}, "bob": {"public": "b"}}
+    store = _mock_store(monkeypatch, secrets)
+    keygen_missing(cfg)
+    assert store.list.call_count == 1
+    assert store.write.call_count == 0
+    assert capsys.readouterr().out == "All machines already have keys\n"
+
+    store = _mock_store(monkeypatch, {"alice": {"public": "a"}})
+    keygen_missing(cfg)
+    assert store.read("alice") == {"public": "a"}
+    assert set(store.list()) == {"alice", "bob", "_public"}
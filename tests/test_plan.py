@@ -0,0 +1,116 @@
+import json
+import shutil
+
+from privateer2.config import Client, ScheduleJob, read_config
+from privateer2.plan import (
+    _parse_cron,
+    peak_concurrency,
+    plan_schedules,
+    schedule_plan,
+)
+
+
+def _crowded_config(n):
+    cfg = read_config("example/schedule.json")
+    template = cfg.clients[0]
+    for i in range(n):
+        cl = Client(
+            name=f"client{i}",
+            backup=["data1"],
+            schedule={
+                "jobs": [
+                    ScheduleJob(
+                        server="alice", volume="data1", schedule="0 2 * * *"
+                    )
+                ]
+            },
+        )
+        cfg.clients.append(cl)
+    cfg.reindex()
+    template.schedule.jobs[0].schedule = "0 2 * * *"
+    template.schedule.jobs[1].schedule = "*/30 * * * *"
+    return cfg
+
+
+def test_can_parse_cron():
+    assert _parse_cron("0 2 * * *") == (0, 2, "*", "*", "*")
+    assert _parse_cron("@weekly") == (0, 0, "*", "*", "0")
+    assert _parse_cron("*/30 * * * *") is None
+    assert _parse_cron("0 24 * * *") is None
+    assert _parse_cron("@reboot") is None
+
+
+def test_can_stagger_jobs_to_a_server():
+    cfg = _crowded_config(11)
+    plan = plan_schedules(cfg, window=60, duration=15)
+    assert len(plan) == 13
+    assert peak_concurrency(plan, "alice", "before") == 12
+    assert peak_concurrency(plan, "alice", "after") == 3
+    fixed = [x for x in plan if x["before"] == "*/30 * * * *"]
+    assert len(fixed) == 1
+    assert fixed[0]["after"] == "*/30 * * * *"
+    for x in plan:
+        if x["after"] != fixed[0]["after"]:
+            minute, hour = _parse_cron(x["after"])[:2]
+            assert hour == 2
+            assert 0 <= minute < 60
+    assert plan_schedules(cfg, window=60, duration=15) == plan
+
+
+def test_planning_again_changes_nothing():
+    cfg = _crowded_config(11)
+    plan = plan_schedules(cfg, window=60, duration=15)
+    for x in plan:
+        schedule = cfg.machine_config(x["client"]).schedule
+        schedule.jobs[x["job"]].schedule = x["after"]
+    again = plan_schedules(cfg, window=60, duration=15)
+    assert all(x["before"] == x["after"] for x in again)
+
+
+def test_durations_come_from_timeouts():
+    cfg = _crowded_config(1)
+    cfg.clients[0].schedule.timeout = 3600
+    cfg.clients[1].schedule.jobs[0].timeout = 90
+    plan = plan_schedules(cfg, window=30, duration=15)
+    assert [x["duration"] for x in plan] == [60, 60, 2]
+
+
+def test_can_show_and_apply_plan(tmp_path, capsys):
+    path = tmp_path / "privateer.json"
+    shutil.copy("example/schedule.json", path)
+    cfg = read_config(path)
+    cfg.clients[0].schedule.jobs[1].schedule = "@daily"
+    with open(path) as f:
+        data = json.load(f)
+    data["clients"][0]["schedule"]["jobs"][1]["schedule"] = "@daily"
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+    schedule_plan(cfg, str(path), window=60, duration=15)
+    lines = capsys.readouterr().out.strip().split("\n")
+    assert lines == [
+        "Planned 2 job(s) across 1 server(s):",
+        "  alice: peak 2 -> 1 concurrent backups",
+        "  bob 'data1' to alice: '@daily' -> '15 0 * * *'",
+        f"Run again with '--apply' to write these schedules to '{path}'",
+    ]
+    assert read_config(path) == cfg
+
+    schedule_plan(cfg, str(path), window=60, duration=15, apply=True)
+    out = capsys.readouterr().out
+    assert f"Wrote schedules to '{path}'" in out
+    with open(path) as f:
+        res = json.load(f)
+    jobs = res["clients"][0]["schedule"]["jobs"]
+    assert [x["schedule"] for x in jobs] == ["15 0 * * *", "@daily"]
+    assert res["clients"][0]["restore"] == ["data1", "data2"]
+
+    schedule_plan(read_config(path), str(path), window=60, duration=15)
+    out = capsys.readouterr().out
+    assert "All schedules are already planned" in out
+
+
+def test_plan_without_schedules(capsys):
+    cfg = read_config("example/simple.json")
+    assert schedule_plan(cfg, "privateer.json") == []
+    assert capsys.readouterr().out == "No scheduled jobs to plan\n"
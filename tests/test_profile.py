@@ -0,0 +1,154 @@
+import json
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from privateer2.profile import (
+    _request_path,
+    format_profile,
+    instrument_session,
+    phase,
+    profiling,
+    write_profile,
+)
+from privateer2.util import ChunkReader
+
+
+def _response(method, url, *, body=None, length=None, elapsed=0.5):
+    response = MagicMock()
+    response.request.method = method
+    response.request.url = url
+    response.request.body = body
+    response.headers = {} if length is None else {"Content-Length": length}
+    response.elapsed.total_seconds.return_value = elapsed
+    return response
+
+
+def test_phases_are_noop_without_profiling():
+    with phase("a"):
+        pass
+
+
+def test_can_collect_phases_and_calls():
+    session = MagicMock()
+    session.hooks = {"response": []}
+    instrument_session(session, "docker")
+    hook = session.hooks["response"][0]
+    hook(_response("GET", "http+docker://localhost/v1.43/containers/abc/json"))
+    with profiling() as p:
+        with phase("outer"):
+            hook(_response("POST", "http://x/v1.43/images/create", length="7"))
+            with phase("inner"):
+                hook(_response("GET", "http://x/volumes/v", body=b"12345"))
+                hook(_response("GET", "http://x/volumes/w"))
+        data = p.data()
+    assert [x["name"] for x in data["phases"]] == ["outer/inner", "outer"]
+    assert data["phases"][0]["calls"] == 2
+    assert data["phases"][0]["bytes"] == 5
+    assert data["phases"][1]["calls"] == 3
+    assert data["phases"][1]["call_time"] == 1.5
+    assert data["phases"][1]["bytes"] == 12
+    assert data["calls"] == [
+        {
+            "phase": "outer",
+            "kind": "docker",
+            "name": "POST /images/create",
+            "count": 1,
+            "time": 0.5,
+            "bytes": 7,
+        },
+        {
+            "phase": "outer/inner",
+            "kind": "docker",
+            "name": "GET /volumes/*",
+            "count": 2,
+            "time": 1.0,
+            "bytes": 5,
+        },
+    ]
+    lines = format_profile(data)
+    assert lines[0].startswith("Total time: ")
+    assert "  outer: " in "\n".join(lines)
+    assert "  [outer/inner] docker GET /volumes/*: 2 calls" in "\n".join(lines)
+
+
+def test_phase_records_time_on_error():
+    with profiling() as p:
+        with pytest.raises(Exception, match="some error"):
+            with phase("a"):
+                msg = "some error"
+                raise Exception(msg)
+        assert list(p.phases.keys()) == ["a"]
+
+
+def test_phases_are_tracked_separately_per_thread():
+    started = threading.Barrier(2)
+    seen = {}
+
+    def work(name):
+        with phase(name):
+            started.wait()
+            seen[name] = p.current_phase()
+
+    with profiling() as p:
+        threads = [threading.Thread(target=work, args=(x,)) for x in "ab"]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert seen == {"a": "a", "b": "b"}
+        assert sorted(p.phases.keys()) == ["a", "b"]
+        assert p.current_phase() == "(other)"
+
+
+def test_streamed_archives_count_their_bytes():
+    session = MagicMock()
+    session.hooks = {"response": []}
+    instrument_session(session, "docker")
+    hook = session.hooks["response"][0]
+    with profiling() as p:
+        with phase("a"):
+            hook(_response("GET", "http://x/containers/abc/archive"))
+            reader = ChunkReader([b"abc", b"", b"defg"])
+            assert reader.read() == b"abcdefg"
+        data = p.data()
+    assert data["calls"] == [
+        {
+            "phase": "a",
+            "kind": "docker",
+            "name": "GET /containers/*/archive",
+            "count": 1,
+            "time": 0.5,
+            "bytes": 7,
+        }
+    ]
+
+
+def test_can_group_request_paths():
+    assert _request_path("docker", "http://x/v1.43/containers/json") == (
+        "/containers/json"
+    )
+    assert _request_path("docker", "http://x/containers/abc/archive") == (
+        "/containers/*/archive"
+    )
+    assert _request_path("docker", "http://x/images/mrcide/c:latest/json") == (
+        "/images/*/json"
+    )
+    assert _request_path("docker", "http://x/volumes/create") == (
+        "/volumes/create"
+    )
+    assert _request_path("vault", "http://v/v1/secret/privateer/alice") == (
+        "/v1/secret/*"
+    )
+
+
+def test_can_write_profile_as_json(tmp_path):
+    with profiling() as p:
+        with phase("a"):
+            pass
+        data = p.data()
+    path = tmp_path / "profile.json"
+    write_profile(data, str(path))
+    with path.open() as f:
+        assert json.load(f) == data
@@ -69,7 +69,7 @@ def test_can_run_restore(monkeypatch, managed_docker):
         ]
         assert mock_run.call_count == 1
         assert mock_run.call_args == call(
-            "Restore", image, command=command, mounts=mounts
+            "Restore", image, command=command, mounts=mounts, live=False
         )
 
 
@@ -1,12 +1,18 @@
 from unittest.mock import MagicMock, call
 
+import pytest
 import vault_dev
 
 import privateer2.server
 from privateer2.config import read_config
 from privateer2.configure import configure
 from privateer2.keys import keygen_all
-from privateer2.server import server_start, server_status, server_stop
+from privateer2.server import (
+    server_reload,
+    server_start,
+    server_status,
+    server_stop,
+)
 
 
 def test_can_print_instructions_to_start_server(capsys, managed_docker):
@@ -90,6 +96,7 @@ def test_can_start_server_with_local_volume(monkeypatch, managed_docker):
         cfg.servers[0].data_volume = vol_data
         cfg.servers[0].container = name
         cfg.volumes[1].name = vol_other
+        cfg.reindex()
         keygen_all(cfg)
         configure(cfg, "alice")
         server_start(cfg, "alice")
@@ -147,3 +154,52 @@ def test_can_get_server_status(monkeypatch):
     container = mock_check.return_value.container
     assert mock_status.call_count == 1
     assert mock_status.call_args == call(container)
+
+
+def test_reload_signals_sshd_only_for_new_host_keys(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    mock_check = MagicMock()
+    mock_configure = MagicMock(return_value=["authorized_keys"])
+    mock_container = MagicMock()
+    mock_container.status = "running"
+    mock_exists = MagicMock(return_value=mock_container)
+    monkeypatch.setattr(privateer2.server, "check", mock_check)
+    monkeypatch.setattr(privateer2.configure, "configure", mock_configure)
+    monkeypatch.setattr(privateer2.server, "container_if_exists", mock_exists)
+    machine = mock_check.return_value
+    server_reload(cfg, "alice")
+    assert mock_check.call_args == call(cfg, "alice", quiet=True)
+    assert mock_configure.call_args == call(cfg, "alice")
+    assert mock_exists.call_args == call(machine.container)
+    assert mock_container.kill.call_count == 0
+    out = capsys.readouterr().out
+    assert "will use the new keys for new connections" in out
+
+    mock_configure.return_value = ["id_rsa.pub", "id_rsa", "authorized_keys"]
+    server_reload(cfg, "alice")
+    assert mock_container.kill.call_args == call(signal="SIGHUP")
+    assert "to reload host keys" in capsys.readouterr().out
+
+
+def test_reload_of_stopped_server_only_updates_volume(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    mock_configure = MagicMock(return_value=["id_rsa"])
+    monkeypatch.setattr(privateer2.server, "check", MagicMock())
+    monkeypatch.setattr(privateer2.configure, "configure", mock_configure)
+    monkeypatch.setattr(
+        privateer2.server, "container_if_exists", MagicMock(return_value=None)
+    )
+    server_reload(cfg, "alice")
+    assert mock_configure.call_count == 1
+    out = capsys.readouterr().out
+    assert out == "Server 'alice' is not running; changes apply on next start\n"
+
+
+def test_can_only_reload_servers(monkeypatch):
+    cfg = read_config("example/simple.json")
+    mock_configure = MagicMock()
+    monkeypatch.setattr(privateer2.server, "check", MagicMock())
+    monkeypatch.setattr(privateer2.configure, "configure", mock_configure)
+    with pytest.raises(Exception, match="'bob' is not a server"):
+        server_reload(cfg, "bob")
+    assert mock_configure.call_count == 0
@@ -0,0 +1,163 @@
+from unittest.mock import MagicMock, call
+
+import hvac
+import pytest
+from cryptography.fernet import Fernet
+
+import privateer2.store
+from privateer2.config import read_config
+from privateer2.store import (
+    CachedStore,
+    ExpiringStore,
+    FileStore,
+    MemoryStore,
+    VaultKV1Store,
+    VaultKV2Store,
+    open_store,
+)
+from privateer2.util import transient_envvar
+
+
+def test_can_store_secrets_in_encrypted_file(tmp_path):
+    path = tmp_path / "secrets"
+    key = Fernet.generate_key()
+    store = FileStore(str(path), key)
+    assert store.read("alice") is None
+    assert store.list() == []
+    store.write("alice", {"public": "a", "private": "secret"})
+    store.write("bob", {"public": "b"})
+    assert b"secret" not in path.read_bytes()
+    assert path.stat().st_mode & 0o777 == 0o600
+    other = FileStore(str(path), key)
+    assert other.read("alice") == {"public": "a", "private": "secret"}
+    assert other.list() == ["alice", "bob"]
+
+
+def test_can_use_vault_kv1():
+    client = MagicMock()
+    kv = client.secrets.kv.v1
+    store = VaultKV1Store(client, "/privateer")
+    kv.read_secret.return_value = {"data": {"public": "a"}}
+    assert store.read("alice") == {"public": "a"}
+    assert kv.read_secret.call_args == call("/privateer/alice")
+    kv.read_secret.side_effect = hvac.exceptions.InvalidPath()
+    assert store.read("alice") is None
+    store.write("alice", {"public": "a"})
+    assert kv.create_or_update_secret.call_args == call(
+        "/privateer/alice", secret={"public": "a"}
+    )
+    kv.list_secrets.return_value = {"data": {"keys": ["alice"]}}
+    assert store.list() == ["alice"]
+    kv.list_secrets.side_effect = hvac.exceptions.InvalidPath()
+    assert store.list() == []
+
+
+def test_can_use_vault_kv2():
+    client = MagicMock()
+    kv = client.secrets.kv.v2
+    store = VaultKV2Store(client, "/privateer")
+    kv.read_secret_version.return_value = {"data": {"data": {"public": "a"}}}
+    assert store.read("alice") == {"public": "a"}
+    assert kv.read_secret_version.call_args == call(
+        path="/privateer/alice", raise_on_deleted_version=True
+    )
+    kv.read_secret_version.side_effect = hvac.exceptions.InvalidPath()
+    assert store.read("alice") is None
+    store.write("alice", {"public": "a"})
+    assert kv.create_or_update_secret.call_args == call(
+        path="/privateer/alice", secret={"public": "a"}
+    )
+    kv.list_secrets.return_value = {"data": {"keys": ["alice"]}}
+    assert store.list() == ["alice"]
+    assert kv.list_secrets.call_args == call(path="/privateer")
+
+
+def test_cache_reads_through_to_backend():
+    backend = MagicMock(wraps=MemoryStore({"alice": {"public": "a"}}))
+    store = CachedStore(backend)
+    assert store.read("alice") == {"public": "a"}
+    assert store.read("alice") == {"public": "a"}
+    assert store.read("bob") is None
+    assert backend.read.call_args_list == [call("alice"), call("bob")]
+    store.write("bob", {"public": "b"})
+    assert store.read("bob") == {"public": "b"}
+    assert backend.read.call_count == 2
+    assert backend.write.call_args == call("bob", {"public": "b"})
+
+
+def test_open_store_once_per_process(monkeypatch, tmp_path):
+    mock_vault_client = MagicMock()
+    monkeypatch.setattr(privateer2.store, "_STORES", {})
+    monkeypatch.setattr(privateer2.store, "vault_client", mock_vault_client)
+    cfg = read_config("example/simple.json")
+    store = open_store(cfg.vault)
+    assert isinstance(store.backend, VaultKV1Store)
+    assert store.backend.prefix == "/privateer"
+    assert open_store(cfg.vault) is store
+    assert mock_vault_client.call_count == 1
+
+    cfg.vault.kv_version = 2
+    assert isinstance(open_store(cfg.vault).backend, VaultKV2Store)
+
+    cfg.vault.url = f"file://{tmp_path}/secrets"
+    with transient_envvar(PRIVATEER_SECRETS_KEY=None):
+        with pytest.raises(Exception, match="Set 'PRIVATEER_SECRETS_KEY'"):
+            open_store(cfg.vault)
+    key = Fernet.generate_key().decode()
+    with transient_envvar(PRIVATEER_SECRETS_KEY=key):
+        store = open_store(cfg.vault)
+    assert isinstance(store.backend, FileStore)
+    assert store.backend.path == f"{tmp_path}/secrets"
+
+
+def test_file_store_needs_absolute_path(monkeypatch):
+    monkeypatch.setattr(privateer2.store, "_STORES", {})
+    cfg = read_config("example/simple.json")
+    key = Fernet.generate_key().decode()
+    for url in ["file://secrets.enc", "file://./secrets.enc", "file:///"]:
+        cfg.vault.url = url
+        msg = f"Invalid url '{url}': use an absolute path"
+        with transient_envvar(PRIVATEER_SECRETS_KEY=key):
+            with pytest.raises(Exception, match=msg):
+                open_store(cfg.vault)
+    cfg.vault.url = "file://localhost/path/secrets.enc"
+    with transient_envvar(PRIVATEER_SECRETS_KEY=key):
+        assert open_store(cfg.vault).backend.path == "/path/secrets.enc"
+
+
+def test_expiring_store_forgets_old_secrets(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(privateer2.store.time, "time", lambda: now[0])
+    store = ExpiringStore(MemoryStore(), 60)
+    store.write("alice", {"public": "a"})
+    now[0] += 30
+    store.write("bob", {"public": "b"})
+    assert store.read("alice") == {"public": "a"}
+    assert store.list() == ["alice", "bob"]
+    now[0] += 40
+    assert store.read("alice") is None
+    assert store.read("bob") == {"public": "b"}
+    assert store.list() == ["bob"]
+
+
+def test_can_cache_vault_secrets_on_disk(monkeypatch, tmp_path):
+    monkeypatch.setattr(privateer2.store, "SECRETS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(privateer2.store, "vault_client", MagicMock())
+    cfg = read_config("example/simple.json")
+    cfg.vault.secrets_cache_ttl = 60
+    key = Fernet.generate_key().decode()
+    vault = MagicMock(wraps=MemoryStore({"alice": {"public": "a"}}))
+    monkeypatch.setattr(privateer2.store, "VaultKV1Store", lambda *_: vault)
+
+    monkeypatch.setattr(privateer2.store, "_STORES", {})
+    with transient_envvar(PRIVATEER_SECRETS_KEY=key):
+        store = open_store(cfg.vault)
+    assert store.read("alice") == {"public": "a"}
+    assert vault.read.call_count == 1
+    assert len(list(tmp_path.iterdir())) == 1
+
+    monkeypatch.setattr(privateer2.store, "_STORES", {})
+    with transient_envvar(PRIVATEER_SECRETS_KEY=key):
+        store = open_store(cfg.vault)
+    assert store.read("alice") == {"public": "a"}
+    assert vault.read.call_count == 1
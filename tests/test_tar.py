@@ -109,6 +109,7 @@ def test_can_export_local_managed_volume(monkeypatch, managed_docker):
         cfg.servers[0].data_volume = vol_data
         cfg.servers[0].container = name
         cfg.volumes[1].name = vol_other
+        cfg.reindex()
         keygen_all(cfg)
         configure(cfg, "alice")
     path = export_tar(cfg, "alice", vol_other)
@@ -1,6 +1,8 @@
+import io
 import os
 import re
 import tarfile
+from unittest.mock import MagicMock, call
 
 import pytest
 
@@ -64,34 +66,6 @@ def test_can_pull_image_if_required():
     assert image_exists("hello-world:latest")
 
 
-def test_can_tail_logs_from_container(managed_docker):
-    privateer2.util.ensure_image("alpine")
-    name = managed_docker("container")
-    command = ["seq", "1", "10"]
-    cl = docker.from_env()
-    cl.containers.run("alpine", name=name, command=command)
-    assert privateer2.util.log_tail(cl.containers.get(name), 5) == [
-        "(ommitting 5 lines of logs)",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-    ]
-    assert privateer2.util.log_tail(cl.containers.get(name), 100) == [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-    ]
-
-
 def test_can_run_long_command(capsys, managed_docker):
     name = managed_docker("container")
     command = ["seq", "1", "3"]
@@ -194,3 +168,193 @@ def test_can_uniquify_list():
     assert privateer2.util.unique([]) == []
     assert privateer2.util.unique([1, 2, 3]) == [1, 2, 3]
     assert privateer2.util.unique([3, 2, 1, 2, 3]) == [3, 2, 1]
+
+
+def test_docker_client_is_reused():
+    cl = privateer2.util.docker_client()
+    assert privateer2.util.docker_client() is cl
+
+
+def test_can_override_docker_client():
+    outer = MagicMock()
+    inner = MagicMock()
+    with privateer2.util.transient_docker_client(outer):
+        with privateer2.util.transient_docker_client(inner):
+            assert privateer2.util.docker_client() is inner
+            privateer2.util.volume_exists("vol")
+            assert inner.volumes.get.call_count == 1
+        assert privateer2.util.docker_client() is outer
+    assert outer.volumes.get.call_count == 0
+
+
+def test_only_look_up_image_once():
+    client = MagicMock()
+    with privateer2.util.transient_docker_client(client):
+        privateer2.util.ensure_image("img")
+        privateer2.util.ensure_image("img")
+        privateer2.util.ensure_image("other")
+        privateer2.util.ensure_image("other")
+    assert client.images.get.call_count == 2
+    assert client.images.get.call_args_list == [call("img"), call("other")]
+    assert client.images.pull.call_count == 0
+
+
+def test_ensure_image_pulls_missing_images(capsys):
+    client = MagicMock()
+    client.images.get.side_effect = docker.errors.ImageNotFound("img")
+    with privateer2.util.transient_docker_client(client):
+        privateer2.util.ensure_image("img")
+        privateer2.util.ensure_image("img")
+    assert client.images.pull.call_count == 1
+    assert client.images.pull.call_args == call("img")
+    assert capsys.readouterr().out == "Pulling img\n"
+
+
+def test_pull_skips_images_pinned_by_digest_if_present(capsys):
+    img_tag = "mrcide/privateer-client:latest"
+    img_digest = f"mrcide/privateer-server@sha256:{'a' * 64}"
+    client = MagicMock()
+    with privateer2.util.transient_docker_client(client):
+        privateer2.util.pull_images([img_tag, img_digest])
+        assert client.images.pull.call_count == 1
+        assert client.images.pull.call_args == call(img_tag)
+        client.images.get.side_effect = docker.errors.ImageNotFound("img")
+        privateer2.util.pull_image(img_digest)
+        assert client.images.pull.call_count == 2
+        assert client.images.pull.call_args == call(img_digest)
+    out = capsys.readouterr().out
+    assert f"'{img_digest}' already present\n" in out
+    assert f"pulling '{img_tag}'\n" in out
+
+
+def test_can_create_tar_of_several_files():
+    files = {
+        "a": ("hello", 0o600, 0, 0),
+        "b": (["hello", "world"], None, None, None),
+    }
+    t = tarfile.open(fileobj=io.BytesIO(privateer2.util.tar_files(files)))
+    els = t.getmembers()
+    assert [x.name for x in els] == ["a", "b"]
+    assert els[0].mode == 0o600
+    assert els[0].uid == 0
+    assert els[0].gid == 0
+    assert els[1].uid == os.geteuid()
+    assert els[1].gid == os.getegid()
+    assert t.extractfile("a").read() == b"hello"
+    assert t.extractfile("b").read() == b"hello\nworld\n"
+
+
+def test_write_several_files_with_one_container():
+    client = MagicMock()
+    container = client.containers.create.return_value
+    files = {"a": ("hello", None, None, None), "b": ("world", None, 0, 0)}
+    with privateer2.util.transient_docker_client(client):
+        privateer2.util.files_to_volume("vol", files)
+    assert client.containers.create.call_count == 1
+    assert container.put_archive.call_count == 1
+    assert container.put_archive.call_args[0][0] == "/dest"
+    assert container.remove.call_count == 1
+
+
+def test_can_copy_several_files_into_volume(managed_docker):
+    vol = managed_docker("volume")
+    files = {"a": ("hello", None, None, None), "b": ("world", None, 0, 0)}
+    privateer2.util.files_to_volume(vol, files)
+    assert privateer2.util.string_from_volume(vol, "a") == "hello"
+    assert privateer2.util.string_from_volume(vol, "b") == "world"
+
+
+def _chunked(data, n):
+    return [data[i : i + n] for i in range(0, len(data), n)]
+
+
+def test_can_read_file_from_streamed_archive():
+    tar = privateer2.util.tar_files({"path": ("hello" * 1000, None, 0, 0)})
+    container = MagicMock()
+    container.get_archive.return_value = (iter(_chunked(tar, 77)), {})
+    res = privateer2.util.bytes_from_container(container, "/src/path")
+    assert res == b"hello" * 1000
+    assert container.get_archive.call_args == call("/src/path")
+
+
+def test_error_if_file_missing_from_streamed_archive():
+    tar = privateer2.util.tar_files({"other": ("hello", None, 0, 0)})
+    container = MagicMock()
+    container.get_archive.return_value = (iter([tar]), {})
+    with pytest.raises(Exception, match="Did not find 'path' in archive"):
+        privateer2.util.bytes_from_container(container, "/src/path")
+
+
+def test_can_read_several_files_from_container():
+    files = {
+        "src/a": ("hello", None, None, None),
+        "src/b": ("world", None, None, None),
+        "src/c": ("other", None, None, None),
+    }
+    tar = privateer2.util.tar_files(files)
+    container = MagicMock()
+    container.get_archive.return_value = (iter(_chunked(tar, 100)), {})
+    res = privateer2.util.files_from_container(
+        container, "/src", ["a", "b", "d"]
+    )
+    assert res == {"a": "hello", "b": "world", "d": None}
+    assert container.get_archive.call_count == 1
+    assert container.get_archive.call_args == call("/src")
+
+
+def test_can_read_several_files_from_volume(managed_docker):
+    vol = managed_docker("volume")
+    files = {"a": ("hello", None, None, None), "b": ("world", None, 0, 0)}
+    privateer2.util.files_to_volume(vol, files)
+    res = privateer2.util.files_from_volume(vol, ["a", "b", "c"])
+    assert res == {"a": "hello", "b": "world", "c": None}
+
+
+def test_log_buffer_keeps_only_recent_lines():
+    logs = privateer2.util.LogBuffer(3)
+    assert list(logs.add(b"1\n2")) == ["1"]
+    assert list(logs.add(b"\n3\n4\n")) == ["2", "3", "4"]
+    assert list(logs.add(b"5")) == []
+    assert list(logs.flush()) == ["5"]
+    assert list(logs.flush()) == []
+    assert logs.n == 5
+    assert list(logs.lines) == ["3", "4", "5"]
+    assert logs.tail(2) == ["(ommitting 3 lines of logs)", "4", "5"]
+    assert logs.tail(10) == ["(ommitting 2 lines of logs)", "3", "4", "5"]
+
+
+def test_log_buffer_handles_split_and_long_lines():
+    logs = privateer2.util.LogBuffer(3, max_line=4)
+    text = "ü\n".encode()
+    assert list(logs.add(text[:1])) == []
+    assert list(logs.add(text[1:])) == ["ü"]
+    assert list(logs.add(b"abcdefgh")) == ["abcdefgh"]
+    assert logs.tail(5) == ["ü", "abcdefgh"]
+
+
+def test_can_stream_logs_while_running_command(capsys):
+    client = MagicMock()
+    container = client.containers.run.return_value
+    container.name = "nm"
+    container.logs.return_value = iter([b"1\n2", b"\n3\n"])
+    container.wait.return_value = {"StatusCode": 0}
+    callback = MagicMock()
+    with privateer2.util.transient_docker_client(client):
+        privateer2.util.run_container_with_command(
+            "Test", "img", command=["cmd"], live=True, callback=callback
+        )
+    assert container.logs.call_args == call(stream=True, follow=True)
+    assert client.containers.run.call_args == call(
+        "img", command=["cmd"], detach=True
+    )
+    assert capsys.readouterr().out == (
+        "Test command started. Container logs:\n"
+        "1\n2\n3\n"
+        "Test completed successfully!\n"
+    )
+    assert callback.call_args_list == [
+        call({"container": "nm", "line": "1", "n": 1}),
+        call({"container": "nm", "line": "2", "n": 2}),
+        call({"container": "nm", "line": "3", "n": 3}),
+    ]
+    assert container.remove.call_count == 1
@@ -1,5 +1,10 @@
+import json
+import os
+import time
 from unittest.mock import MagicMock, call
 
+import hvac
+
 import privateer2.vault
 from privateer2.util import transient_envvar
 from privateer2.vault import _get_vault_token, vault_client
@@ -37,3 +42,71 @@ def test_can_use_github_auth(monkeypatch):
     assert client == mock_client.return_value
     assert client.auth.github.login.call_count == 1
     assert client.auth.github.login.call_args == call(token)
+
+
+def _mock_hvac(monkeypatch, *, ttl=3600, renewable=True):
+    mock_client = MagicMock()
+    client = mock_client.return_value
+    client.token = "s.token"
+    info = {"data": {"ttl": ttl, "renewable": renewable}}
+    client.auth.token.lookup_self.return_value = info
+    monkeypatch.setattr(privateer2.vault.hvac, "Client", mock_client)
+    return mock_client
+
+
+def test_cache_token_after_login(monkeypatch, tmp_path):
+    monkeypatch.setattr(privateer2.vault, "TOKEN_CACHE_DIR", str(tmp_path))
+    mock_client = _mock_hvac(monkeypatch)
+    addr = "https://vault.example.com:8200"
+    gh = f"ghp_{'x' * 36}"
+    with transient_envvar(VAULT_TOKEN=None, VAULT_AUTH_GITHUB_TOKEN=gh):
+        vault_client(addr)
+        client = mock_client.return_value
+        assert client.auth.github.login.call_count == 1
+        path = privateer2.vault._token_cache_path(addr)
+        assert os.stat(path).st_mode & 0o777 == 0o600
+
+        vault_client(addr)
+        assert client.auth.github.login.call_count == 1
+        assert mock_client.call_args == call(addr, token="s.token")
+        assert client.auth.token.renew_self.call_count == 0
+
+
+def test_renew_cached_token_near_expiry(monkeypatch, tmp_path):
+    monkeypatch.setattr(privateer2.vault, "TOKEN_CACHE_DIR", str(tmp_path))
+    mock_client = _mock_hvac(monkeypatch, ttl=60)
+    addr = "https://vault.example.com:8200"
+    with transient_envvar(VAULT_TOKEN=None, VAULT_AUTH_GITHUB_TOKEN="tok"):
+        vault_client(addr)
+        vault_client(addr)
+    client = mock_client.return_value
+    assert client.auth.token.renew_self.call_count == 1
+
+
+def test_ignore_expired_or_revoked_cached_token(monkeypatch, tmp_path):
+    monkeypatch.setattr(privateer2.vault, "TOKEN_CACHE_DIR", str(tmp_path))
+    mock_client = _mock_hvac(monkeypatch)
+    addr = "https://vault.example.com:8200"
+    path = privateer2.vault._token_cache_path(addr)
+    with transient_envvar(VAULT_TOKEN=None, VAULT_AUTH_GITHUB_TOKEN="tok"):
+        vault_client(addr)
+        with open(path) as f:
+            dat = json.load(f)
+        dat["expires"] = time.time() - 1
+        with open(path, "w") as f:
+            json.dump(dat, f)
+        assert privateer2.vault._cached_vault_client(addr) is None
+
+        vault_client(addr)
+        lookup = mock_client.return_value.auth.token.lookup_self
+        lookup.side_effect = hvac.exceptions.Forbidden()
+        assert privateer2.vault._cached_vault_client(addr) is None
+        assert not os.path.exists(path)
+
+
+def test_do_not_cache_token_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setattr(privateer2.vault, "TOKEN_CACHE_DIR", str(tmp_path))
+    _mock_hvac(monkeypatch)
+    with transient_envvar(VAULT_TOKEN="vt"):
+        vault_client("https://vault.example.com:8200")
+    assert list(tmp_path.iterdir()) == []
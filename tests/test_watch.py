@@ -0,0 +1,197 @@
+import base64
+import urllib.error
+import urllib.request
+from unittest.mock import ANY, MagicMock, call
+
+import pytest
+
+import privateer2.watch
+from privateer2.check import connection_probe_script
+from privateer2.config import read_config
+from privateer2.watch import (
+    BackupFreshness,
+    Metrics,
+    backup_freshness_script,
+    format_metrics,
+    metrics_server,
+    parse_backup_freshness,
+    watch,
+    watch_once,
+)
+
+
+def _b64(x):
+    return base64.b64encode(x.encode()).decode()
+
+
+def _exec_result(output):
+    res = MagicMock()
+    res.output = output.encode()
+    return res
+
+
+def test_can_format_metrics():
+    values = [
+        ("privateer_server_up", {"server": "alice"}, 1),
+        ("privateer_identity_ok", {"machine": "bob"}, 1),
+        ("privateer_server_up", {"server": "carol"}, 0),
+    ]
+    assert format_metrics(values, 100) == (
+        "# TYPE privateer_server_up gauge\n"
+        'privateer_server_up{server="alice"} 1\n'
+        'privateer_server_up{server="carol"} 0\n'
+        "# TYPE privateer_identity_ok gauge\n"
+        'privateer_identity_ok{machine="bob"} 1\n'
+        "# TYPE privateer_watch_last_run_seconds gauge\n"
+        "privateer_watch_last_run_seconds 100\n"
+    )
+
+
+def test_can_parse_backup_freshness():
+    found = _b64("data\t1700000000\nother\t\n")
+    output = f"alice\t{found}\ncarol\t\nnoise\n"
+    assert parse_backup_freshness(output) == {("alice", "data"): 1700000000}
+
+
+def test_backup_freshness_queries_servers_concurrently():
+    script = backup_freshness_script("bob", ["alice", "carol"], ["data"], 5)
+    lines = script.split("\n")
+    assert len(lines) == 3
+    assert all(x.endswith("&") for x in lines[:2])
+    assert "/privateer/volumes/bob/data" in lines[0]
+    assert lines[2] == "wait"
+
+
+def test_can_serve_metrics():
+    metrics = Metrics()
+    metrics.update([("privateer_identity_ok", {"machine": "bob"}, 1)])
+    server = metrics_server(metrics, "127.0.0.1", 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        with urllib.request.urlopen(f"{url}/metrics") as res:  # noqa: S310
+            body = res.read().decode()
+        assert 'privateer_identity_ok{machine="bob"} 1\n' in body
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")  # noqa: S310
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_watch_server_only_checks_identity(monkeypatch):
+    mock_check = MagicMock(side_effect=[None, Exception("oops")])
+    monkeypatch.setattr(privateer2.watch, "check", mock_check)
+    cfg = read_config("example/simple.json")
+    ok = [("privateer_identity_ok", {"machine": "alice"}, 1)]
+    assert watch_once(cfg, "alice", None) == ok
+    fail = [("privateer_identity_ok", {"machine": "alice"}, 0)]
+    assert watch_once(cfg, "alice", None) == fail
+
+
+def test_watch_client_probes_servers_and_backups(monkeypatch):
+    monkeypatch.setattr(privateer2.watch, "check", MagicMock())
+    monkeypatch.setattr(privateer2.watch.time, "time", lambda: 1700000100)
+    cfg = read_config("example/simple.json")
+    probe = MagicMock()
+    found = _b64("data\t1700000000\n")
+    probe.exec_run.side_effect = [
+        _exec_result(f"alice\t0\t123\t{_b64('alice')}\n"),
+        _exec_result(f"alice\t{found}\n"),
+    ]
+    res = watch_once(cfg, "bob", probe, timeout=5)
+    assert res == [
+        ("privateer_identity_ok", {"machine": "bob"}, 1),
+        ("privateer_server_up", {"server": "alice"}, 1),
+        ("privateer_server_latency_seconds", {"server": "alice"}, 0.123),
+        (
+            "privateer_backup_newest_file_seconds",
+            {"server": "alice", "volume": "data"},
+            1700000000,
+        ),
+        (
+            "privateer_backup_age_seconds",
+            {"server": "alice", "volume": "data"},
+            100,
+        ),
+    ]
+    assert probe.exec_run.call_args_list == [
+        call(["bash", "-c", connection_probe_script(["alice"], 5)]),
+        call(
+            [
+                "bash",
+                "-c",
+                backup_freshness_script("bob", ["alice"], ["data"], 5),
+            ]
+        ),
+    ]
+
+
+def test_watch_reuses_one_probe_container(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    mock_docker_client = MagicMock()
+    mock_watch_once = MagicMock(return_value=[])
+    monkeypatch.setattr(privateer2.watch, "check", MagicMock())
+    monkeypatch.setattr(privateer2.watch, "docker_client", mock_docker_client)
+    monkeypatch.setattr(privateer2.watch, "ensure_image", MagicMock())
+    monkeypatch.setattr(privateer2.watch, "watch_once", mock_watch_once)
+    monkeypatch.setattr(privateer2.watch.time, "sleep", MagicMock())
+    watch(cfg, "bob", port=0, iterations=3)
+    client = mock_docker_client.return_value
+    probe = client.containers.run.return_value
+    assert client.containers.run.call_count == 1
+    assert mock_watch_once.call_count == 3
+    assert mock_watch_once.call_args == call(
+        cfg, "bob", probe, timeout=10, freshness=ANY
+    )
+    assert privateer2.watch.time.sleep.call_count == 2
+    assert probe.stop.call_count == 1
+    assert capsys.readouterr().out.startswith("Serving metrics at http://")
+
+
+def test_watch_checks_backup_freshness_less_often(monkeypatch):
+    monkeypatch.setattr(privateer2.watch, "check", MagicMock())
+    now = [1700000100]
+    monkeypatch.setattr(privateer2.watch.time, "time", lambda: now[0])
+    cfg = read_config("example/simple.json")
+    probe = MagicMock()
+    connection = _exec_result(f"alice\t0\t123\t{_b64('alice')}\n")
+    data = _b64("data\t1700000000\n")
+    found = _exec_result(f"alice\t{data}\n")
+    results = [connection, found, connection, connection, found]
+    probe.exec_run.side_effect = results
+    freshness = BackupFreshness(600)
+    watch_once(cfg, "bob", probe, timeout=5, freshness=freshness)
+    now[0] += 300
+    res = watch_once(cfg, "bob", probe, timeout=5, freshness=freshness)
+    assert probe.exec_run.call_count == 3
+    labels = {"server": "alice", "volume": "data"}
+    assert ("privateer_backup_age_seconds", labels, 400) in res
+    now[0] += 300
+    watch_once(cfg, "bob", probe, timeout=5, freshness=freshness)
+    assert probe.exec_run.call_count == 5
+    assert freshness.checked == 1700000700
+
+
+def test_watch_survives_errors_and_restarts_probe(monkeypatch, capsys):
+    cfg = read_config("example/simple.json")
+    mock_docker_client = MagicMock()
+    mock_watch_once = MagicMock(side_effect=[[], Exception("gone"), []])
+    mock_metrics = MagicMock()
+    monkeypatch.setattr(privateer2.watch, "check", MagicMock())
+    monkeypatch.setattr(privateer2.watch, "docker_client", mock_docker_client)
+    monkeypatch.setattr(privateer2.watch, "ensure_image", MagicMock())
+    monkeypatch.setattr(privateer2.watch, "watch_once", mock_watch_once)
+    monkeypatch.setattr(privateer2.watch, "Metrics", mock_metrics)
+    monkeypatch.setattr(privateer2.watch, "metrics_server", MagicMock())
+    monkeypatch.setattr(privateer2.watch.time, "sleep", MagicMock())
+    watch(cfg, "bob", port=0, iterations=3)
+    client = mock_docker_client.return_value
+    probe = client.containers.run.return_value
+    assert client.containers.run.call_count == 2
+    assert probe.stop.call_count == 2
+    assert mock_metrics.return_value.update.call_args_list == [
+        call([("privateer_watch_errors", {}, 0)]),
+        call([("privateer_watch_errors", {}, 1)]),
+        call([("privateer_watch_errors", {}, 1)]),
+    ]
+    assert "Error while checking 'bob': gone" in capsys.readouterr().out
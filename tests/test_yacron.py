@@ -14,6 +14,7 @@ def test_can_generate_yacron_yaml():
     expected = [
         "defaults:",
         f'  timezone: "{current_timezone_name()}"',
+        "  concurrencyPolicy: Forbid",
         "jobs:",
         '  - name: "job-1"',
         f"    command: \"{' '.join(backup_command('bob', 'data1', 'alice'))}\"",
@@ -40,6 +41,7 @@ def test_can_add_web_interface():
     expected = [
         "defaults:",
         f'  timezone: "{current_timezone_name()}"',
+        "  concurrencyPolicy: Forbid",
         "web:",
         "  listen:",
         "    - http://0.0.0.0:8080",
@@ -68,3 +70,66 @@ def test_can_check_yacron_config_is_valid():
     # Syntax error:
     with pytest.raises(Exception, match="mapping"):
         _validate_yacron_yaml(valid[1:])
+
+
+def test_can_set_job_limits():
+    cfg = read_config("example/schedule.json")
+    cfg.clients[0].schedule.port = None
+    cfg.clients[0].schedule.concurrency_policy = "replace"
+    cfg.clients[0].schedule.timeout = 3600
+    cfg.clients[0].schedule.jobs[1].concurrency_policy = "allow"
+    cfg.clients[0].schedule.jobs[1].timeout = 86400
+    res = generate_yacron_yaml(cfg, "bob")
+    assert _validate_yacron_yaml(res)
+    assert res[:4] == [
+        "defaults:",
+        f'  timezone: "{current_timezone_name()}"',
+        "  concurrencyPolicy: Replace",
+        "  executionTimeout: 3600",
+    ]
+    assert res[-5:] == [
+        '  - name: "job-2"',
+        f"    command: \"{' '.join(backup_command('bob', 'data2', 'alice'))}\"",
+        '    schedule: "@weekly"',
+        "    concurrencyPolicy: Allow",
+        "    executionTimeout: 86400",
+    ]
+
+
+def test_jobs_sharing_a_volume_take_a_lock():
+    cfg = read_config("example/schedule.json")
+    jobs = cfg.clients[0].schedule.jobs
+    jobs[1].volume = "data1"
+    cmd = " ".join(backup_command("bob", "data1", "alice"))
+    lock = "/tmp/privateer-volume-data1.lock"  # noqa: S108
+    res = generate_yacron_yaml(cfg, "bob")
+    assert _validate_yacron_yaml(res)
+    commands = [x for x in res if x.startswith("    command:")]
+    assert len(commands) == 2
+    assert commands[0] == commands[1]
+    assert commands[0].startswith(
+        f'    command: "exec 9<> {lock}; flock -n 9 ||'
+    )
+    assert "already running" in commands[0]
+    assert commands[0].endswith(f'; exec {cmd}"')
+
+    cfg.clients[0].schedule.volume_policy = "replace"
+    res = generate_yacron_yaml(cfg, "bob")
+    assert f"kill $(cat {lock})" in res[-5]
+
+    cfg.clients[0].schedule.volume_policy = "allow"
+    res = generate_yacron_yaml(cfg, "bob")
+    assert res[-5] == f'    command: "{cmd}"'
+
+
+def test_can_limit_concurrent_jobs():
+    cfg = read_config("example/schedule.json")
+    cfg.clients[0].schedule.max_concurrent = 2
+    res = generate_yacron_yaml(cfg, "bob")
+    assert _validate_yacron_yaml(res)
+    cmd = " ".join(backup_command("bob", "data1", "alice"))
+    assert res[-5] == (
+        '    command: "while :; do for i in 1 2; do '
+        "exec 8<> /tmp/privateer-slot-$i.lock; flock -n 8 && break 2; "
+        f'done; sleep 10; done; exec {cmd}"'
+    )